@@ -14,11 +14,14 @@ from __future__ import print_function
 
 import os
 import sys
+import time
 import types
 import posixpath
+import threading
 import traceback
 from os import path
 from collections import deque
+from contextlib import contextmanager
 
 from six import iteritems, itervalues, text_type
 from six.moves import cStringIO
@@ -35,6 +38,7 @@ from sphinx.errors import SphinxError, SphinxWarning, ExtensionError, \
 from sphinx.domains import ObjType
 from sphinx.domains.std import GenericObject, Target, StandardDomain
 from sphinx.environment import BuildEnvironment
+from sphinx.environment.storage import doctree_storages
 from sphinx.io import SphinxStandaloneReader
 from sphinx.util import pycompat  # noqa: F401
 from sphinx.util import import_object
@@ -44,6 +48,7 @@ from sphinx.util.logging import is_suppressed_warning
 from sphinx.util.console import bold, lightgray, darkgray, darkred, darkgreen, \
     term_width_line
 from sphinx.util.i18n import find_catalog_source_files
+from sphinx.util.profiling import BuildProfiler
 
 # List of all known core events. Maps name to arguments description.
 events = {
@@ -94,6 +99,7 @@ builtin_extensions = (
 
 CONFIG_FILENAME = 'conf.py'
 ENV_PICKLE_FILENAME = 'environment.pickle'
+ENV_DURATIONS_FILENAME = 'durations.pickle'
 
 # list of deprecated extensions. Keys are extension name.
 # Values are Sphinx version that merge the extension.
@@ -105,7 +111,7 @@ class Sphinx(object):
     def __init__(self, srcdir, confdir, outdir, doctreedir, buildername,
                  confoverrides=None, status=sys.stdout, warning=sys.stderr,
                  freshenv=False, warningiserror=False, tags=None, verbosity=0,
-                 parallel=0):
+                 parallel=0, profile=None):
         self.verbosity = verbosity
         self.next_listener_id = 0
         self._extensions = {}
@@ -114,6 +120,8 @@ class Sphinx(object):
         self._listeners = {}
         self._setting_up_extension = ['?']
         self.domains = {}
+        # the built-in doctree storages and those added by the extensions
+        self.doctree_storages = dict(doctree_storages)
         self.buildername = buildername
         self.builderclasses = {}
         self.builder = None
@@ -127,6 +135,14 @@ class Sphinx(object):
 
         self.parallel = parallel
 
+        # if a filename for the profile report is given, record the timings
+        # of the build
+        self.profile = profile
+        if profile:
+            self.profiler = BuildProfiler()
+        else:
+            self.profiler = None
+
         if status is None:
             self._status = cStringIO()
             self.quiet = True
@@ -141,6 +157,11 @@ class Sphinx(object):
         self._warncount = 0
         self.warningiserror = warningiserror
 
+        # the messages of threads inside buffered_output(), and the lock that
+        # keeps the output of several threads from interleaving
+        self._output_buffer = threading.local()
+        self._output_lock = threading.Lock()
+
         self._events = events.copy()
         self._translators = {}
 
@@ -289,6 +310,7 @@ class Sphinx(object):
                 self.info(bold('loading pickled environment... '), nonl=True)
                 self.env = BuildEnvironment.frompickle(
                     self.srcdir, self.config, path.join(self.doctreedir, ENV_PICKLE_FILENAME))
+                self.env.load_durations(path.join(self.doctreedir, ENV_DURATIONS_FILENAME))
                 self.env.set_warnfunc(self.warn)
                 self.env.init_managers()
                 self.env.domains = {}
@@ -340,6 +362,11 @@ class Sphinx(object):
                                 self._warncount != 1 and 's' or '')))
             else:
                 self.info(bold('build %s.' % status))
+            if self.profiler:
+                self.profiler.dump(self.profile)
+                self.info(bold('build profile written to %s' % self.profile))
+                for line in self.profiler.summary():
+                    self.info(line)
         except Exception as err:
             # delete the saved env to force a fresh build next time
             envfile = path.join(self.doctreedir, ENV_PICKLE_FILENAME)
@@ -354,6 +381,14 @@ class Sphinx(object):
     # ---- logging handling ----------------------------------------------------
 
     def _log(self, message, wfile, nonl=False):
+        messages = getattr(self._output_buffer, 'messages', None)
+        if messages is not None:
+            messages.append((message, wfile, nonl))
+            return
+        with self._output_lock:
+            self._write(message, wfile, nonl)
+
+    def _write(self, message, wfile, nonl=False):
         try:
             wfile.write(message)
         except UnicodeEncodeError:
@@ -367,6 +402,23 @@ class Sphinx(object):
             wfile.flush()
         self.messagelog.append(message)
 
+    @contextmanager
+    def buffered_output(self):
+        """Collect the messages the current thread emits in the block, and write
+        them in one piece at its end.
+
+        This keeps the output of tasks that run in threads at the same time
+        from interleaving on the console.
+        """
+        messages = self._output_buffer.messages = []
+        try:
+            yield
+        finally:
+            self._output_buffer.messages = None
+            with self._output_lock:
+                for message, wfile, nonl in messages:
+                    self._write(message, wfile, nonl)
+
     def warn(self, message, location=None, prefix='WARNING: ',
              type=None, subtype=None, colorfunc=darkred):
         """Emit a warning.
@@ -462,6 +514,8 @@ class Sphinx(object):
 
     def old_status_iterator(self, iterable, summary, colorfunc=darkgreen,
                             stringify_func=_display_chunk):
+        if self.profiler:
+            iterable = self.profiler.timed_iterator(iterable, summary, stringify_func)
         l = 0
         for item in iterable:
             if l == 0:
@@ -480,6 +534,8 @@ class Sphinx(object):
                                                  stringify_func):
                 yield item
             return
+        if self.profiler:
+            iterable = self.profiler.timed_iterator(iterable, summary, stringify_func)
         l = 0
         summary = bold(summary)
         for item in iterable:
@@ -585,6 +641,12 @@ class Sphinx(object):
             pass
         results = []
         if event in self._listeners:
+            if self.profiler:
+                for _, callback in iteritems(self._listeners[event]):
+                    starttime = time.time()
+                    results.append(callback(self, *args))
+                    self.profiler.add_handler(event, callback, time.time() - starttime)
+                return results
             for _, callback in iteritems(self._listeners[event]):
                 results.append(callback(self, *args))
         return results
@@ -842,6 +904,15 @@ class Sphinx(object):
                       type='app', subtype='add_source_parser')
         self._additional_source_parsers[suffix] = parser
 
+    def add_doctree_storage(self, storage):
+        self.debug('[app] adding doctree storage: %r', storage)
+        if self.doctree_storages.get(storage.name, storage) is not storage:
+            self.warn('while setting up extension %s: doctree storage %r is '
+                      'already registered, it will be overridden' %
+                      (self._setting_up_extension[-1], storage.name),
+                      type='app', subtype='add_doctree_storage')
+        self.doctree_storages[storage.name] = storage
+
 
 class TemplateBridge(object):
     """
@@ -10,6 +10,7 @@
 """
 
 import os
+import time
 from os import path
 
 try:
@@ -23,8 +24,9 @@ from sphinx.util import i18n, path_stabilize
 from sphinx.util.osutil import SEP, relative_uri
 from sphinx.util.i18n import find_catalog
 from sphinx.util.console import bold, darkgreen
-from sphinx.util.parallel import ParallelTasks, SerialTasks, make_chunks, \
-    parallel_available
+from sphinx.util.parallel import ConcurrentTasks, ParallelTasks, SerialTasks, \
+    make_chunks, parallel_available
+from sphinx.util.profiling import profile_phase
 
 # side effect: registers roles and directives
 from sphinx import roles       # noqa
@@ -80,6 +82,8 @@ class Builder(object):
         # these get set later
         self.parallel_ok = False
         self.finish_tasks = None
+        # true while parallel write workers call collect_doc_data()
+        self.writing_in_workers = False
 
         # load default translator class
         self.translator_class = app._translators.get(self.name)
@@ -257,20 +261,25 @@ class Builder(object):
         """
         if summary:
             self.info(bold('building [%s]' % self.name) + ': ' + summary)
+        profiler = self.app.profiler
 
         # while reading, collect all warnings from docutils
         warnings = []
         self.env.set_warnfunc(lambda *args, **kwargs: warnings.append((args, kwargs)))
-        updated_docnames = set(self.env.update(self.config, self.srcdir,
-                                               self.doctreedir, self.app))
+        with profile_phase(profiler, 'read'):
+            updated_docnames = set(self.env.update(self.config, self.srcdir,
+                                                   self.doctreedir, self.app))
         self.env.set_warnfunc(self.warn)
         for warning, kwargs in warnings:
             self.warn(*warning, **kwargs)
+        if profiler:
+            profiler.add_documents('read', updated_docnames, self.env.read_durations)
 
         doccount = len(updated_docnames)
         self.info(bold('looking for now-outdated files... '), nonl=1)
-        for docname in self.env.check_dependents(updated_docnames):
-            updated_docnames.add(docname)
+        with profile_phase(profiler, 'check dependents'):
+            for docname in self.env.check_dependents(updated_docnames):
+                updated_docnames.add(docname)
         outdated = len(updated_docnames) - doccount
         if outdated:
             self.info('%d found' % outdated)
@@ -281,12 +290,14 @@ class Builder(object):
             # save the environment
             from sphinx.application import ENV_PICKLE_FILENAME
             self.info(bold('pickling environment... '), nonl=True)
-            self.env.topickle(path.join(self.doctreedir, ENV_PICKLE_FILENAME))
+            with profile_phase(profiler, 'pickle environment'):
+                self.env.topickle(path.join(self.doctreedir, ENV_PICKLE_FILENAME))
             self.info('done')
 
             # global actions
             self.info(bold('checking consistency... '), nonl=True)
-            self.env.check_consistency()
+            with profile_phase(profiler, 'check consistency'):
+                self.env.check_consistency()
             self.info('done')
         else:
             if method == 'update' and not docnames:
@@ -312,20 +323,34 @@ class Builder(object):
                     break
 
         #  create a task executor to use for misc. "finish-up" tasks
-        # if self.parallel_ok:
-        #     self.finish_tasks = ParallelTasks(self.app.parallel)
-        # else:
-        # for now, just execute them serially
-        self.finish_tasks = SerialTasks()
+        if self.parallel_ok:
+            self.finish_tasks = ConcurrentTasks(self.app.parallel,
+                                                thread_context=self.app.buffered_output)
+        else:
+            self.finish_tasks = SerialTasks()
+        if profiler:
+            self.finish_tasks = profiler.wrap_tasks(self.finish_tasks)
 
         # write all "normal" documents (or everything for some builders)
-        self.write(docnames, list(updated_docnames), method)
+        with profile_phase(profiler, 'write'):
+            self.write(docnames, list(updated_docnames), method)
+
+        # the environment has been pickled before writing, so save the
+        # write durations separately for the next build
+        from sphinx.application import ENV_DURATIONS_FILENAME
+        self.env.dump_durations(path.join(self.doctreedir, ENV_DURATIONS_FILENAME))
 
         # finish (write static files etc.)
-        self.finish()
+        with profile_phase(profiler, 'finish'):
+            self.finish()
+
+            # wait for all tasks
+            self.finish_tasks.join()
 
-        # wait for all tasks
-        self.finish_tasks.join()
+        cache = self.env.doctree_cache
+        if cache.hits or cache.misses:
+            self.info(bold('doctree cache: ') + '%d hits, %d misses' %
+                      (cache.hits, cache.misses))
 
     def write(self, build_docnames, updated_docnames, method='update'):
         if build_docnames is None or build_docnames == ['__all__']:
@@ -346,7 +371,8 @@ class Builder(object):
         docnames.add(self.config.master_doc)
 
         self.info(bold('preparing documents... '), nonl=True)
-        self.prepare_writing(docnames)
+        with profile_phase(self.app.profiler, 'prepare writing'):
+            self.prepare_writing(docnames)
         self.info('done')
 
         warnings = []
@@ -359,51 +385,81 @@ class Builder(object):
         else:
             self._write_serial(sorted(docnames), warnings)
         self.env.set_warnfunc(self.warn)
+        if self.app.profiler:
+            self.app.profiler.add_documents('write', docnames, self.env.write_durations)
 
     def _write_serial(self, docnames, warnings):
         for docname in self.app.status_iterator(
                 docnames, 'writing output... ', darkgreen, len(docnames)):
-            doctree = self.env.get_and_resolve_doctree(docname, self)
+            starttime = time.time()
+            with profile_phase(self.app.profiler, 'resolve references'):
+                doctree = self.env.get_and_resolve_doctree(docname, self)
             self.write_doc_serialized(docname, doctree)
             self.write_doc(docname, doctree)
+            self.env.write_durations[docname] = time.time() - starttime
         for warning, kwargs in warnings:
             self.warn(*warning, **kwargs)
 
     def _write_parallel(self, docnames, warnings, nproc):
+        durations = self.env.write_durations
+
         def write_process(docs):
             local_warnings = []
+            local_durations = {}
+            local_data = {}
 
             def warnfunc(*args, **kwargs):
                 local_warnings.append((args, kwargs))
             self.env.set_warnfunc(warnfunc)
             for docname, doctree in docs:
+                starttime = time.time()
+                data = self.collect_doc_data(docname, doctree)
+                if data is not None:
+                    local_data[docname] = data
                 self.write_doc(docname, doctree)
-            return local_warnings
+                local_durations[docname] = time.time() - starttime
+            return local_warnings, local_durations, local_data
 
-        def add_warnings(docs, wlist):
+        def add_warnings(docs, result):
+            wlist, wdurations, wdata = result
             warnings.extend(wlist)
+            for docname, duration in wdurations.items():
+                durations[docname] = durations.get(docname, 0) + duration
+            for docname, data in sorted(wdata.items()):
+                self.merge_doc_data(docname, data)
 
         # warm up caches/compile templates using the first document
         firstname, docnames = docnames[0], docnames[1:]
-        doctree = self.env.get_and_resolve_doctree(firstname, self)
+        starttime = time.time()
+        with profile_phase(self.app.profiler, 'resolve references'):
+            doctree = self.env.get_and_resolve_doctree(firstname, self)
         self.write_doc_serialized(firstname, doctree)
         self.write_doc(firstname, doctree)
+        durations[firstname] = time.time() - starttime
 
         tasks = ParallelTasks(nproc)
-        chunks = make_chunks(docnames, nproc)
-
-        for chunk in self.app.status_iterator(
-                chunks, 'writing output... ', darkgreen, len(chunks)):
-            arg = []
-            for i, docname in enumerate(chunk):
-                doctree = self.env.get_and_resolve_doctree(docname, self)
-                self.write_doc_serialized(docname, doctree)
-                arg.append((docname, doctree))
-            tasks.add_task(write_process, arg, add_warnings)
+        # balance the chunks by the time the docs took to write the last time
+        chunks = make_chunks(docnames, nproc, costs=durations)
 
-        # make sure all threads have finished
-        self.info(bold('waiting for workers...'))
-        tasks.join()
+        self.writing_in_workers = True
+        try:
+            for chunk in self.app.status_iterator(
+                    chunks, 'writing output... ', darkgreen, len(chunks)):
+                arg = []
+                for i, docname in enumerate(chunk):
+                    starttime = time.time()
+                    with profile_phase(self.app.profiler, 'resolve references'):
+                        doctree = self.env.get_and_resolve_doctree(docname, self)
+                    self.write_doc_serialized(docname, doctree)
+                    durations[docname] = time.time() - starttime
+                    arg.append((docname, doctree))
+                tasks.add_task(write_process, arg, add_warnings)
+
+            # make sure all threads have finished
+            self.info(bold('waiting for workers...'))
+            tasks.join()
+        finally:
+            self.writing_in_workers = False
 
         for warning, kwargs in warnings:
             self.warn(*warning, **kwargs)
@@ -422,6 +478,22 @@ class Builder(object):
         """
         pass
 
+    def collect_doc_data(self, docname, doctree):
+        """Gather data about a document in a parallel write worker, before
+        write_doc is called.  If the return value is not None, it is sent back
+        to :meth:`merge_doc_data` in the main process, so it must be picklable.
+
+        While the workers run, :attr:`writing_in_workers` is true, so that
+        write_doc_serialized can leave work to this method.
+        """
+        return None
+
+    def merge_doc_data(self, docname, data):
+        """Add the data returned by :meth:`collect_doc_data` for *docname*
+        in the main process.
+        """
+        pass
+
     def finish(self):
         """Finish the building process.
 
@@ -114,6 +114,8 @@ class Epub3Builder(EpubBuilder):
     # Finish by building the epub file
     def handle_finish(self):
         """Create the metainfo files and finally the epub."""
+        # the content file lists all files of the output directory
+        self.finish_tasks.join()
         self.get_toc()
         self.build_mimetype(self.outdir, 'mimetype')
         self.build_container(self.outdir, 'META-INF/container.xml')
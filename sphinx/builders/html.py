@@ -9,6 +9,7 @@
     :license: BSD, see LICENSE for details.
 """
 
+import os
 import re
 import sys
 import zlib
@@ -34,12 +35,14 @@ from sphinx.util.osutil import SEP, os_path, relative_uri, ensuredir, \
 from sphinx.util.nodes import inline_all_toctrees
 from sphinx.util.fileutil import copy_asset
 from sphinx.util.matching import patmatch, Matcher, DOTFILES
+from sphinx.util.profiling import profile_phase
 from sphinx.config import string_classes
 from sphinx.locale import _, l_
-from sphinx.search import js_index
+from sphinx.search import IndexBuilder, binary, js_index, dump_js_shard
 from sphinx.theming import Theme
 from sphinx.builders import Builder
 from sphinx.application import ENV_PICKLE_FILENAME
+from sphinx.environment import get_shards_dir
 from sphinx.highlighting import PygmentsBridge
 from sphinx.util.console import bold, darkgreen, brown
 from sphinx.writers.html import HTMLWriter, HTMLTranslator, \
@@ -87,6 +90,7 @@ class StandaloneHTMLBuilder(Builder):
     allow_sharp_as_current_path = True
     embedded = False  # for things like HTML help or Qt help: suppresses sidebar
     search = True  # for things like HTML help and Apple help: suppress search
+    search_dump_in_process = True  # dump the search index in a forked process
     download_support = True  # enable download role
 
     # This is a class attribute because it is mutated by Sphinx.add_javascript.
@@ -215,8 +219,8 @@ class StandaloneHTMLBuilder(Builder):
             except Exception:
                 targetmtime = 0
             try:
-                srcmtime = max(path.getmtime(self.env.doc2path(docname)),
-                               template_mtime)
+                srcmtime = max(self.env.get_file_mtime(
+                    docname, self.env.doc2path(docname, None)), template_mtime)
                 if srcmtime > targetmtime:
                     yield docname
             except EnvironmentError:
@@ -251,14 +255,23 @@ class StandaloneHTMLBuilder(Builder):
     def prepare_writing(self, docnames):
         # create the search indexer
         self.indexer = None
+        # docname -> (filename, title) of the pages whose words are collected
+        # by the parallel write workers
+        self.pending_index_pages = {}
         if self.search:
-            from sphinx.search import IndexBuilder, languages
+            from sphinx.search import languages
             lang = self.config.html_search_language or self.config.language
             if not lang or lang not in languages:
                 lang = 'en'
+            ranking = self.config.html_search_ranking
+            if ranking not in IndexBuilder.rankings:
+                self.warn('unknown html_search_ranking %r, using the default' % ranking)
+                ranking = None
             self.indexer = IndexBuilder(self.env, lang,
                                         self.config.html_search_options,
-                                        self.config.html_search_scorer)
+                                        self.config.html_search_scorer,
+                                        ranking,
+                                        self.config.html_search_stem_cache_size)
             self.load_indexer(docnames)
 
         self.docwriter = HTMLWriter(self)
@@ -464,14 +477,35 @@ class StandaloneHTMLBuilder(Builder):
         title = title and self.render_partial(title)['title'] or ''
         self.index_page(docname, doctree, title)
 
+    def collect_doc_data(self, docname, doctree):
+        if self.indexer is not None and hasattr(self.indexer, 'collect_terms'):
+            # send back only the stems computed for this document, not those
+            # inherited from the main process
+            self.indexer.stem_cache.take_new()
+            terms, title_terms = self.indexer.collect_terms(doctree)
+            return terms, title_terms, self.indexer.stem_cache.take_new()
+
+    def merge_doc_data(self, docname, data):
+        terms, title_terms, stems = data
+        self.indexer.stem_cache.merge(stems)
+        if docname in self.pending_index_pages:
+            filename, title = self.pending_index_pages.pop(docname)
+            self.indexer.add_terms(docname, filename, title, terms, title_terms)
+
     def finish(self):
-        self.finish_tasks.add_task(self.gen_indices)
-        self.finish_tasks.add_task(self.gen_additional_pages)
-        self.finish_tasks.add_task(self.copy_image_files)
-        self.finish_tasks.add_task(self.copy_download_files)
-        self.finish_tasks.add_task(self.copy_static_files)
-        self.finish_tasks.add_task(self.copy_extra_files)
-        self.finish_tasks.add_task(self.write_buildinfo)
+        # the tasks only wait for the tasks whose output they touch; pages are
+        # rendered one after the other since html-page-context handlers need
+        # not be thread-safe
+        indices = self.finish_tasks.add_task(self.gen_indices, depends=())
+        pages = self.finish_tasks.add_task(self.gen_additional_pages,
+                                           depends=(indices,))
+        images = self.finish_tasks.add_task(self.copy_image_files, depends=())
+        downloads = self.finish_tasks.add_task(self.copy_download_files, depends=())
+        static = self.finish_tasks.add_task(self.copy_static_files, depends=())
+        # extra files may overwrite any of the generated files
+        extra = self.finish_tasks.add_task(self.copy_extra_files,
+                                           depends=(pages, images, downloads, static))
+        self.finish_tasks.add_task(self.write_buildinfo, depends=(extra,))
 
         # dump the search index
         self.handle_finish()
@@ -698,21 +732,42 @@ class StandaloneHTMLBuilder(Builder):
                 node.replace_self(reference)
                 reference.append(node)
 
+    def get_search_state_filename(self):
+        """Return the file name of the saved state of the search indexer."""
+        return path.join(self.doctreedir, 'searchindex-%s.pickle' % self.name)
+
+    def get_stem_cache_filename(self):
+        """Return the file name of the saved stem cache of the search indexer;
+        the builders share it.
+        """
+        return path.join(self.doctreedir, 'stemcache-%s.pickle' % self.indexer.lang.lang)
+
     def load_indexer(self, docnames):
         keep = set(self.env.all_docs) - set(docnames)
+        if isinstance(self.indexer, IndexBuilder):
+            try:
+                with open(self.get_stem_cache_filename(), 'rb') as f:
+                    self.indexer.stem_cache.load(f)
+            except (IOError, OSError, ValueError, EOFError, pickle.UnpicklingError):
+                pass
         try:
-            searchindexfn = path.join(self.outdir, self.searchindex_filename)
-            if self.indexer_dumps_unicode:
-                f = codecs.open(searchindexfn, 'r', encoding='utf-8')
-            else:
-                f = open(searchindexfn, 'rb')
-            with f:
-                self.indexer.load(f, self.indexer_format)
-        except (IOError, OSError, ValueError):
-            if keep:
-                self.warn('search index couldn\'t be loaded, but not all '
-                          'documents will be built: the index will be '
-                          'incomplete.')
+            # the saved state allows updating the index incrementally
+            with open(self.get_search_state_filename(), 'rb') as f:
+                self.indexer.load_state(f)
+        except (IOError, OSError, ValueError, EOFError, pickle.UnpicklingError):
+            try:
+                searchindexfn = path.join(self.outdir, self.searchindex_filename)
+                if self.indexer_dumps_unicode:
+                    f = codecs.open(searchindexfn, 'r', encoding='utf-8')
+                else:
+                    f = open(searchindexfn, 'rb')
+                with f:
+                    self.indexer.load(f, self.indexer_format)
+            except (IOError, OSError, ValueError):
+                if keep:
+                    self.warn('search index couldn\'t be loaded, but not all '
+                              'documents will be built: the index will be '
+                              'incomplete.')
         # delete all entries for files that will be rebuilt
         self.indexer.prune(keep)
 
@@ -720,6 +775,11 @@ class StandaloneHTMLBuilder(Builder):
         # only index pages with title
         if self.indexer is not None and title:
             filename = self.env.doc2path(pagename, base=None)
+            if self.writing_in_workers and hasattr(self.indexer, 'collect_terms'):
+                # the words are collected by the write worker and added in
+                # merge_doc_data()
+                self.pending_index_pages[pagename] = (filename, title)
+                return
             try:
                 self.indexer.feed(pagename, filename, title, doctree)
             except TypeError:
@@ -817,7 +877,8 @@ class StandaloneHTMLBuilder(Builder):
             templatename = newtmpl
 
         try:
-            output = self.templates.render(templatename, ctx)
+            with profile_phase(self.app.profiler, 'render templates'):
+                output = self.templates.render(templatename, ctx)
         except UnicodeError:
             self.warn("a Unicode error occurred when rendering the page %s. "
                       "Please make sure all config values that contain "
@@ -842,8 +903,17 @@ class StandaloneHTMLBuilder(Builder):
 
     def handle_finish(self):
         if self.indexer:
-            self.finish_tasks.add_task(self.dump_search_index)
-        self.finish_tasks.add_task(self.dump_inventory)
+            # the search adapters of the websupport builder have no stem cache
+            if isinstance(self.indexer, IndexBuilder):
+                stem_cache = self.indexer.stem_cache
+                if stem_cache.misses:
+                    self.info(bold('stem cache: ') + '%d hits, %d misses, %.3fs stemming' %
+                              (stem_cache.hits, stem_cache.misses, stem_cache.time))
+                if self.app.profiler:
+                    self.app.profiler.add_phase('stemming', stem_cache.time)
+            self.finish_tasks.add_task(self.dump_search_index, depends=(),
+                                       process=self.search_dump_in_process)
+        self.finish_tasks.add_task(self.dump_inventory, depends=(), process=True)
 
     def dump_inventory(self):
         def safe_name(string):
@@ -888,10 +958,43 @@ class StandaloneHTMLBuilder(Builder):
         else:
             f = open(searchindexfn + '.tmp', 'wb')
         with f:
-            self.indexer.dump(f, self.indexer_format)
+            nshards = self.config.html_search_shards
+            if nshards and self.indexer_format is js_index:
+                # the shards are written first, since the new index refers
+                # to them
+                frozen, shards = self.indexer.freeze_shards(nshards)
+                self.dump_search_shards(shards)
+                js_index.dump(frozen, f)
+            else:
+                self.indexer.dump(f, self.indexer_format)
         movefile(searchindexfn + '.tmp', searchindexfn)
+        statefn = self.get_search_state_filename()
+        with open(statefn + '.tmp', 'wb') as f:
+            self.indexer.dump_state(f)
+        movefile(statefn + '.tmp', statefn)
+        if isinstance(self.indexer, IndexBuilder):
+            stemcachefn = self.get_stem_cache_filename()
+            with open(stemcachefn + '.tmp', 'wb') as f:
+                self.indexer.stem_cache.dump(f)
+            movefile(stemcachefn + '.tmp', stemcachefn)
         self.info('done')
 
+    def dump_search_shards(self, shards):
+        # searchtools.js loads the shards from this directory next to the
+        # search index
+        sharddir = path.join(self.outdir, '_searchindex')
+        ensuredir(sharddir)
+        for number, shard in enumerate(shards):
+            shardfn = path.join(sharddir, 'shard%d.js' % number)
+            with codecs.open(shardfn + '.tmp', 'w', encoding='utf-8') as f:
+                dump_js_shard(number, shard, f)
+            movefile(shardfn + '.tmp', shardfn)
+        # remove the shards of a previous build with more shards
+        for filename in os.listdir(sharddir):
+            match = re.match(r'shard(\d+)\.js$', filename)
+            if match and int(match.group(1)) >= len(shards):
+                os.unlink(path.join(sharddir, filename))
+
 
 class DirectoryHTMLBuilder(StandaloneHTMLBuilder):
     """
@@ -1111,6 +1214,10 @@ class SerializingHTMLBuilder(StandaloneHTMLBuilder):
         self.init_templates()
         self.init_highlighter()
         self.use_index = self.get_builder_config('use_index', 'html')
+        if self.config.html_search_binary_index:
+            self.indexer_format = binary
+            self.indexer_dumps_unicode = False
+            self.searchindex_filename = 'searchindex.bin'
 
     def get_target_uri(self, docname, typ=None):
         if docname == 'index':
@@ -1158,11 +1265,14 @@ class SerializingHTMLBuilder(StandaloneHTMLBuilder):
 
         # super here to dump the search index
         StandaloneHTMLBuilder.handle_finish(self)
+        self.finish_tasks.join()
 
-        # copy the environment file from the doctree dir to the output dir
-        # as needed by the web app
-        copyfile(path.join(self.doctreedir, ENV_PICKLE_FILENAME),
-                 path.join(self.outdir, ENV_PICKLE_FILENAME))
+        # copy the environment file and its shards from the doctree dir to the
+        # output dir as needed by the web app
+        envfile = path.join(self.doctreedir, ENV_PICKLE_FILENAME)
+        outenvfile = path.join(self.outdir, ENV_PICKLE_FILENAME)
+        copyfile(envfile, outenvfile)
+        copy_asset(get_shards_dir(envfile), get_shards_dir(outenvfile))
 
         # touch 'last build' file, used by the web application to determine
         # when to reload its environment and clear the cache
@@ -1258,6 +1368,10 @@ def setup(app):
     app.add_config_value('html_search_language', None, 'html', string_classes)
     app.add_config_value('html_search_options', {}, 'html')
     app.add_config_value('html_search_scorer', '', None)
+    app.add_config_value('html_search_shards', 0, 'html')
+    app.add_config_value('html_search_ranking', None, 'html', string_classes)
+    app.add_config_value('html_search_stem_cache_size', 100000, 'html')
+    app.add_config_value('html_search_binary_index', False, 'html')
     app.add_config_value('html_scaled_image_link', True, 'html')
 
     return {
@@ -196,6 +196,8 @@ class HTMLHelpBuilder(StandaloneHTMLBuilder):
                            self.encoding, 'xmlcharrefreplace')
 
     def handle_finish(self):
+        # the project file lists all files of the output directory
+        self.finish_tasks.join()
         self.build_hhx(self.outdir, self.config.htmlhelp_basename)
 
     def write_doc(self, docname, doctree):
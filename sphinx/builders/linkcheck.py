@@ -10,20 +10,25 @@
 """
 
 import re
+import time
+import heapq
 import socket
 import codecs
 import threading
+import warnings
 from os import path
+from collections import deque
 
 from requests.exceptions import HTTPError
-from six.moves import queue, html_parser
-from six.moves.urllib.parse import unquote
+from six import iteritems
+from six.moves import queue, html_parser, cPickle as pickle
+from six.moves.urllib.parse import unquote, urlsplit
 from docutils import nodes
 
 # 2015-06-25 barry@python.org.  This exception was deprecated in Python 3.3 and
 # removed in Python 3.5, however for backward compatibility reasons, we're not
 # going to just remove it.  If it doesn't exist, define an exception that will
-# never be caught but leaves the code in check_anchor() intact.
+# never be caught but leaves the code in collect_anchors() intact.
 try:
     from six.moves.html_parser import HTMLParseError
 except ImportError:
@@ -31,46 +36,143 @@ except ImportError:
         pass
 
 from sphinx.builders import Builder
+from sphinx.deprecation import RemovedInSphinx17Warning
 from sphinx.util import encode_uri, requests
 from sphinx.util.console import purple, red, darkgreen, darkgray, \
     darkred, turquoise
 from sphinx.util.requests import is_ssl_error
 
 
-class AnchorCheckParser(html_parser.HTMLParser):
-    """Specialized HTML parser that looks for a specific anchor."""
+class AnchorCollector(html_parser.HTMLParser):
+    """Specialized HTML parser that collects the ids and names of all
+    elements.
+    """
 
-    def __init__(self, search_anchor):
+    def __init__(self):
         html_parser.HTMLParser.__init__(self)
 
-        self.search_anchor = search_anchor
-        self.found = False
+        self.anchors = set()
 
     def handle_starttag(self, tag, attrs):
         for key, value in attrs:
-            if key in ('id', 'name') and value == self.search_anchor:
-                self.found = True
-                break
+            if key in ('id', 'name') and value:
+                self.anchors.add(value)
 
 
-def check_anchor(response, anchor):
-    """Reads HTML data from a response object `response` searching for `anchor`.
-    Returns True if anchor was found, False otherwise.
+def collect_anchors(response):
+    """Reads HTML data from a response object `response` and returns the set
+    of all anchors in it.
     """
-    parser = AnchorCheckParser(anchor)
+    parser = AnchorCollector()
     try:
-        # Read file in chunks. If we find a matching anchor, we break
-        # the loop early in hopes not to have to download the whole thing.
         for chunk in response.iter_content(chunk_size=4096, decode_unicode=True):
             parser.feed(chunk)
-            if parser.found:
-                break
         parser.close()
     except HTMLParseError:
         # HTMLParser is usually pretty good with sloppy HTML, but it tends to
-        # choke on EOF. But we're done then anyway.
+        # choke on EOF (see the note on HTMLParseError above).  But we're done
+        # then anyway.
         pass
-    return parser.found
+    return parser.anchors
+
+
+def check_anchor(response, anchor):
+    """Reads HTML data from a response object `response` searching for `anchor`.
+    Returns True if anchor was found, False otherwise.
+    """
+    warnings.warn('check_anchor() is deprecated, use collect_anchors() instead',
+                  RemovedInSphinx17Warning, stacklevel=2)
+    return anchor in collect_anchors(response)
+
+
+class HostQueue(object):
+    """A queue of links to check, which hands the links of each host out so
+    that at most *concurrency* of them are checked at the same time, and
+    their checks start at most *rate* times per second, if given.
+
+    The links of other hosts are handed out meanwhile, so that the workers
+    are not blocked by a slow or rate limited host.
+    """
+
+    def __init__(self, concurrency, rate=None):
+        self.concurrency = max(concurrency, 1)
+        self.interval = rate and 1.0 / rate or 0
+        self._cond = threading.Condition()
+        # host -> deque of the waiting links
+        self._waiting = {}
+        # host -> number of links being checked
+        self._running = {}
+        # host -> earliest time the next check may start
+        self._next = {}
+        # hosts whose next link can be handed out now
+        self._ready = deque()
+        # heap of (start time, host) of the rate limited hosts
+        self._delayed = []
+        # hosts in _ready or _delayed
+        self._scheduled = set()
+        self._closed = False
+
+    def _schedule(self, host, now):
+        if host in self._scheduled or host not in self._waiting or \
+           self._running.get(host, 0) >= self.concurrency:
+            return
+        self._scheduled.add(host)
+        start = self._next.get(host, 0)
+        if start <= now:
+            self._ready.append(host)
+        else:
+            heapq.heappush(self._delayed, (start, host))
+
+    def put(self, host, item):
+        with self._cond:
+            self._waiting.setdefault(host, deque()).append(item)
+            self._schedule(host, time.time())
+            self._cond.notify()
+
+    def get(self):
+        """Return the host and the next link that may be checked, waiting
+        until there is one; return ``(None, None)`` once the queue is closed.
+        """
+        with self._cond:
+            while not self._closed:
+                now = time.time()
+                while self._delayed and self._delayed[0][0] <= now:
+                    self._ready.append(heapq.heappop(self._delayed)[1])
+                if self._ready:
+                    host = self._ready.popleft()
+                    self._scheduled.discard(host)
+                    waiting = self._waiting[host]
+                    item = waiting.popleft()
+                    if not waiting:
+                        del self._waiting[host]
+                    self._running[host] = self._running.get(host, 0) + 1
+                    self._next[host] = now + self.interval
+                    self._schedule(host, now)
+                    return host, item
+                if self._delayed:
+                    self._cond.wait(self._delayed[0][0] - now)
+                else:
+                    self._cond.wait()
+            return None, None
+
+    def task_done(self, host):
+        """Mark a link of *host* returned by :meth:`get` as checked."""
+        with self._cond:
+            self._running[host] -= 1
+            if not self._running[host]:
+                del self._running[host]
+            self._schedule(host, time.time())
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+#: the name of the file in the output directory that keeps the results
+LINKCHECK_CACHE_FILENAME = 'linkcheck.pickle'
+LINKCHECK_CACHE_VERSION = 1
 
 
 class CheckExternalLinksBuilder(Builder):
@@ -86,13 +188,31 @@ class CheckExternalLinksBuilder(Builder):
         self.good = set()
         self.broken = {}
         self.redirected = {}
+        # URIs being checked -> (docname, lineno) of the links to them
+        self.pending = {}
+        # docname -> (uri, lineno) of the links checked in this build
+        self.doc_links = {}
+        # uri -> (status, info, code, time of the check)
+        self.results = {}
+        # URL -> (final URL, status code of the last redirect, anchors) of the
+        # pages whose anchors are checked
+        self.anchor_pages = {}
+        # URL -> lock held while the page is downloaded
+        self.anchor_page_locks = {}
+        self.anchor_lock = threading.Lock()
+        self.start_time = time.time()
+        self.load_cache()
         # set a timeout for non-responding servers
         socket.setdefaulttimeout(5.0)
         # create output file
         open(path.join(self.outdir, 'output.txt'), 'w').close()
 
-        # create queues and worker threads
-        self.wqueue = queue.Queue()
+        # create queues and worker threads, which share the connections
+        host_workers = self.app.config.linkcheck_host_workers
+        self.session = requests.create_session(
+            pool_connections=max(self.app.config.linkcheck_workers, 10),
+            pool_maxsize=host_workers)
+        self.wqueue = HostQueue(host_workers, self.app.config.linkcheck_host_rate)
         self.rqueue = queue.Queue()
         self.workers = []
         for i in range(self.app.config.linkcheck_workers):
@@ -102,12 +222,27 @@ class CheckExternalLinksBuilder(Builder):
             self.workers.append(thread)
 
     def check_thread(self):
-        kwargs = {}
+        kwargs = {'session': self.session}
         if self.app.config.linkcheck_timeout:
             kwargs['timeout'] = self.app.config.linkcheck_timeout
 
         kwargs['allow_redirects'] = True
 
+        def get_anchor_page(req_url):
+            # download and parse each page only once for all anchors into it;
+            # only what the checks need is kept, not the response.  Failed
+            # downloads are not kept, so that a retry goes to the server again
+            with self.anchor_lock:
+                lock = self.anchor_page_locks.setdefault(req_url, threading.Lock())
+            with lock:
+                if req_url not in self.anchor_pages:
+                    response = requests.get(req_url, stream=True,
+                                            config=self.app.config, **kwargs)
+                    anchors = collect_anchors(response)
+                    code = response.history and response.history[-1].status_code or 0
+                    self.anchor_pages[req_url] = (response.url, code, anchors)
+            return self.anchor_pages[req_url]
+
         def check_uri():
             # split off anchor
             if '#' in uri:
@@ -129,11 +264,8 @@ class CheckExternalLinksBuilder(Builder):
             try:
                 if anchor and self.app.config.linkcheck_anchors:
                     # Read the whole document and see if #anchor exists
-                    response = requests.get(req_url, stream=True, config=self.app.config,
-                                            **kwargs)
-                    found = check_anchor(response, unquote(anchor))
-
-                    if not found:
+                    url, code, anchors = get_anchor_page(req_url)
+                    if unquote(anchor) not in anchors:
                         raise Exception("Anchor '%s' not found" % anchor)
                 else:
                     try:
@@ -147,6 +279,9 @@ class CheckExternalLinksBuilder(Builder):
                         response = requests.get(req_url, stream=True, config=self.app.config,
                                                 **kwargs)
                         response.raise_for_status()
+                    url = response.url
+                    # history contains any redirects, get last
+                    code = response.history and response.history[-1].status_code or 0
             except HTTPError as err:
                 if err.response.status_code == 401:
                     # We'll take "Unauthorized" as working.
@@ -158,56 +293,136 @@ class CheckExternalLinksBuilder(Builder):
                     return 'ignored', str(err), 0
                 else:
                     return 'broken', str(err), 0
-            if response.url.rstrip('/') == req_url.rstrip('/'):
+            if url.rstrip('/') == req_url.rstrip('/'):
                 return 'working', '', 0
             else:
-                new_url = response.url
+                new_url = url
                 if anchor:
                     new_url += '#' + anchor
-                # history contains any redirects, get last
-                if response.history:
-                    code = response.history[-1].status_code
-                    return 'redirected', new_url, code
-                else:
-                    return 'redirected', new_url, 0
+                return 'redirected', new_url, code
 
         def check():
-            # check for various conditions without bothering the network
-            if len(uri) == 0 or uri.startswith(('#', 'mailto:', 'ftp:')):
-                return 'unchecked', '', 0
-            elif not uri.startswith(('http:', 'https:')):
-                return 'local', '', 0
-            elif uri in self.good:
-                return 'working', 'old', 0
-            elif uri in self.broken:
-                return 'broken', self.broken[uri], 0
-            elif uri in self.redirected:
-                return 'redirected', self.redirected[uri][0], self.redirected[uri][1]
-            for rex in self.to_ignore:
-                if rex.match(uri):
-                    return 'ignored', '', 0
-
-            # need to actually check the URI
             for _ in range(self.app.config.linkcheck_retries):
                 status, info, code = check_uri()
                 if status != "broken":
                     break
+            return (status, info, code)
 
+        while True:
+            host, uri = self.wqueue.get()
+            if host is None:
+                break
+            try:
+                status, info, code = check()
+            finally:
+                self.wqueue.task_done(host)
+            self.rqueue.put((uri, status, info, code))
+
+    def load_cache(self):
+        """Load the results of earlier builds."""
+        self.cached_time = 0
+        self.cached_docs = {}
+        self.cached_results = {}
+        try:
+            with open(path.join(self.outdir, LINKCHECK_CACHE_FILENAME), 'rb') as f:
+                cache = pickle.load(f)
+            if cache['version'] != LINKCHECK_CACHE_VERSION:
+                return
+        except Exception:
+            # missing, unreadable or of an older format: check everything
+            return
+        self.cached_time = cache['time']
+        self.cached_docs = cache['docs']
+        self.cached_results = cache['results']
+
+    def save_cache(self):
+        """Save the results of the links in this and the earlier builds."""
+        for docname in set(self.cached_docs) - set(self.doc_links):
+            if docname in self.env.found_docs:
+                self.doc_links[docname] = self.cached_docs[docname]
+        uris = set(uri for links in self.doc_links.values() for uri, lineno in links)
+        results = self.cached_results.copy()
+        results.update(self.results)
+        cache = dict(version=LINKCHECK_CACHE_VERSION, time=self.start_time,
+                     docs=self.doc_links,
+                     results=dict((uri, result) for uri, result in iteritems(results)
+                                  if uri in uris))
+        with open(path.join(self.outdir, LINKCHECK_CACHE_FILENAME), 'wb') as f:
+            pickle.dump(cache, f, pickle.HIGHEST_PROTOCOL)
+
+    def get_cached_result(self, uri, now):
+        """Return the result of *uri* from an earlier build if it has not yet
+        expired, else ``None``.
+        """
+        result = self.cached_results.get(uri)
+        if result is None:
+            return None
+        ttl = {
+            'working': self.app.config.linkcheck_working_ttl,
+            'redirected': self.app.config.linkcheck_redirected_ttl,
+            'broken': self.app.config.linkcheck_broken_ttl,
+        }[result[0]]
+        if result[3] + ttl <= now:
+            return None
+        return result
+
+    def check_known(self, uri):
+        """Return the status, info and code of *uri* if it need not be
+        checked with a request, else ``None``.
+        """
+        # check for various conditions without bothering the network
+        if len(uri) == 0 or uri.startswith(('#', 'mailto:', 'ftp:')):
+            return 'unchecked', '', 0
+        elif not uri.startswith(('http:', 'https:')):
+            return 'local', '', 0
+        elif uri in self.good:
+            return 'working', 'old', 0
+        elif uri in self.broken:
+            return 'broken', self.broken[uri], 0
+        elif uri in self.redirected:
+            return 'redirected', self.redirected[uri][0], self.redirected[uri][1]
+        for rex in self.to_ignore:
+            if rex.match(uri):
+                return 'ignored', '', 0
+        result = self.get_cached_result(uri, time.time())
+        if result is None:
+            return None
+        self.results[uri] = result
+        status, info, code = result[:3]
+        if status == 'working':
+            self.good.add(uri)
+            return 'working', 'old', 0
+        elif status == 'broken':
+            self.broken[uri] = info
+        else:
+            self.redirected[uri] = (info, code)
+        return status, info, code
+
+    def process_results(self, block):
+        """Process the results of the checked links.  If *block* is true, wait
+        until all links have been checked.
+        """
+        while self.pending:
+            try:
+                uri, status, info, code = self.rqueue.get(block)
+            except queue.Empty:
+                break
             if status == "working":
                 self.good.add(uri)
             elif status == "broken":
                 self.broken[uri] = info
             elif status == "redirected":
                 self.redirected[uri] = (info, code)
+            if status in ("working", "broken", "redirected"):
+                self.results[uri] = (status, info, code, time.time())
+            for docname, lineno in self.pending.pop(uri):
+                self.process_result((uri, docname, lineno, status, info, code))
+                if status == "working":
+                    # like the links to a URI that has been checked before
+                    info = 'old'
 
-            return (status, info, code)
-
-        while True:
-            uri, docname, lineno = self.wqueue.get()
-            if uri is None:
-                break
-            status, info, code = check()
-            self.rqueue.put((uri, docname, lineno, status, info, code))
+        if self.broken:
+            self.app.statuscode = 1
 
     def process_result(self, result):
         uri, docname, lineno, status, info, code = result
@@ -250,14 +465,25 @@ class CheckExternalLinksBuilder(Builder):
         return ''
 
     def get_outdated_docs(self):
-        return self.env.found_docs
+        if not self.app.config.linkcheck_incremental:
+            return self.env.found_docs
+        # only the documents that have been changed since the last build and
+        # those with links whose results have expired
+        now = time.time()
+        outdated = []
+        for docname in self.env.found_docs:
+            if docname not in self.cached_docs or \
+               self.env.all_docs.get(docname, now) > self.cached_time or \
+               any(self.get_cached_result(uri, now) is None
+                   for uri, lineno in self.cached_docs[docname]):
+                outdated.append(docname)
+        return outdated
 
     def prepare_writing(self, docnames):
         return
 
     def write_doc(self, docname, doctree):
         self.info()
-        n = 0
         for node in doctree.traverse(nodes.reference):
             if 'refuri' not in node:
                 continue
@@ -268,15 +494,24 @@ class CheckExternalLinksBuilder(Builder):
                 if node is None:
                     break
                 lineno = node.line
-            self.wqueue.put((uri, docname, lineno), False)
-            n += 1
-        done = 0
-        while done < n:
-            self.process_result(self.rqueue.get())
-            done += 1
-
-        if self.broken:
-            self.app.statuscode = 1
+            self.check_link(uri, docname, lineno)
+        self.doc_links.setdefault(docname, [])
+        self.process_results(block=False)
+
+    def check_link(self, uri, docname, lineno):
+        result = self.check_known(uri)
+        if result is not None:
+            self.process_result((uri, docname, lineno) + result)
+            if result[0] not in ('working', 'broken', 'redirected'):
+                return
+        elif uri in self.pending:
+            self.pending[uri].append((docname, lineno))
+        else:
+            # the links of all documents are checked at the same time;
+            # their results are processed as they come in
+            self.pending[uri] = [(docname, lineno)]
+            self.wqueue.put(urlsplit(uri)[1].lower(), uri)
+        self.doc_links.setdefault(docname, []).append((uri, lineno))
 
     def write_entry(self, what, docname, line, uri):
         output = codecs.open(path.join(self.outdir, 'output.txt'), 'a', 'utf-8')
@@ -285,8 +520,16 @@ class CheckExternalLinksBuilder(Builder):
         output.close()
 
     def finish(self):
-        for worker in self.workers:
-            self.wqueue.put((None, None, None), False)
+        if self.app.config.linkcheck_incremental:
+            # report the links of the documents that have not been checked
+            # again from the results of the earlier builds
+            for docname in sorted(set(self.cached_docs) - set(self.doc_links)):
+                if docname in self.env.found_docs:
+                    for uri, lineno in self.cached_docs[docname]:
+                        self.check_link(uri, docname, lineno)
+        self.process_results(block=True)
+        self.wqueue.close()
+        self.save_cache()
 
 
 def setup(app):
@@ -296,6 +539,12 @@ def setup(app):
     app.add_config_value('linkcheck_retries', 1, None)
     app.add_config_value('linkcheck_timeout', None, None, [int])
     app.add_config_value('linkcheck_workers', 5, None)
+    app.add_config_value('linkcheck_host_workers', 4, None)
+    app.add_config_value('linkcheck_host_rate', None, None, [int, float])
+    app.add_config_value('linkcheck_working_ttl', 0, None, [int, float])
+    app.add_config_value('linkcheck_redirected_ttl', 0, None, [int, float])
+    app.add_config_value('linkcheck_broken_ttl', 0, None, [int, float])
+    app.add_config_value('linkcheck_incremental', False, None)
     app.add_config_value('linkcheck_anchors', True, None)
     # Anchors starting with ! are ignored since they are
     # commonly used for dynamic pages
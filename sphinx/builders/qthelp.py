@@ -125,6 +125,8 @@ class QtHelpBuilder(StandaloneHTMLBuilder):
         return self.config.qthelp_theme, self.config.qthelp_theme_options
 
     def handle_finish(self):
+        # the project file lists all files of the output directory
+        self.finish_tasks.join()
         self.build_qhp(self.outdir, self.config.qthelp_basename)
 
     def build_qhp(self, outdir, outname):
@@ -40,7 +40,8 @@ class TextBuilder(Builder):
             except Exception:
                 targetmtime = 0
             try:
-                srcmtime = path.getmtime(self.env.doc2path(docname))
+                srcmtime = self.env.get_file_mtime(docname,
+                                                   self.env.doc2path(docname, None))
                 if srcmtime > targetmtime:
                     yield docname
             except EnvironmentError:
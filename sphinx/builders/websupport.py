@@ -28,6 +28,7 @@ class WebSupportBuilder(PickleHTMLBuilder):
     name = 'websupport'
     versioning_method = 'commentable'
     versioning_compare = True  # for commentable node's uuid stability.
+    search_dump_in_process = False  # the search adapter is fed in this process
 
     def init(self):
         PickleHTMLBuilder.init(self)
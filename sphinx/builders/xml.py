@@ -46,7 +46,8 @@ class XMLBuilder(Builder):
             except Exception:
                 targetmtime = 0
             try:
-                srcmtime = path.getmtime(self.env.doc2path(docname))
+                srcmtime = self.env.get_file_mtime(docname,
+                                                   self.env.doc2path(docname, None))
                 if srcmtime > targetmtime:
                     yield docname
             except EnvironmentError:
@@ -128,6 +128,9 @@ def main(argv):
                      '(default: outdir/.doctrees)')
     group.add_option('-j', metavar='N', default=1, type='int', dest='jobs',
                      help='build in parallel with N processes where possible')
+    group.add_option('--profile-build', metavar='FILE', dest='profile',
+                     help='write the timings of the build phases, documents and '
+                     'event handlers to FILE as JSON and show a summary')
     # this option never gets through to this point (it is intercepted earlier)
     # group.add_option('-M', metavar='BUILDER', dest='make_mode',
     #                 help='"make" mode -- as used by Makefile, like '
@@ -292,7 +295,8 @@ def main(argv):
         with docutils_namespace():
             app = Sphinx(srcdir, confdir, outdir, doctreedir, opts.builder,
                          confoverrides, status, warning, opts.freshenv,
-                         opts.warningiserror, opts.tags, opts.verbosity, opts.jobs)
+                         opts.warningiserror, opts.tags, opts.verbosity, opts.jobs,
+                         opts.profile)
             app.build(opts.force_all, filenames)
             return app.statuscode
     except (Exception, KeyboardInterrupt) as exc:
@@ -94,6 +94,10 @@ class Config(object):
         templates_path = ([], 'html'),
         template_bridge = (None, 'html', string_classes),
         keep_warnings = (False, 'env'),
+        content_digests = (False, 'env'),
+        doctree_cache_size = (16 * 1024 * 1024, None),
+        doctree_storage = ('pickle', 'env'),
+        doctree_compression = (False, 'env'),
         suppress_warnings = ([], 'env'),
         modindex_common_prefix = ([], 'html'),
         rst_epilog = (None, 'env', string_classes),
@@ -11,11 +11,13 @@
 """
 
 import copy
+import threading
 
 from six import iteritems
 
 from sphinx.errors import SphinxError
 from sphinx.locale import _
+from sphinx.util import DocnameIndexedDict
 
 
 class ObjType(object):
@@ -120,7 +122,9 @@ class Domain(object):
     environment object; the `domaindata` dict must then either be nonexistent or
     a dictionary whose 'version' key is equal to the domain class'
     :attr:`data_version` attribute.  Otherwise, `IOError` is raised and the
-    pickled environment is discarded.
+    pickled environment is discarded.  The data of a saved environment is set
+    up by :meth:`setup_data` when `self.data` is first used, so that it is
+    only loaded for the domains that need it.
     """
 
     #: domain name: should be short, but unique
@@ -142,18 +146,28 @@ class Domain(object):
     initial_data = {}
     #: data version, bump this when the format of `self.data` changes
     data_version = 0
+    #: keys of the tables in `self.data` whose values are docnames or tuples
+    #: starting with a docname; they are kept as
+    #: :class:`~sphinx.util.DocnameIndexedDict` and cleared and merged by the
+    #: default :meth:`clear_doc` and :meth:`merge_domaindata`
+    indexed_data = ()
+
+    # guards the setup of the data, which may be triggered by the threads of
+    # concurrent tasks
+    _data_lock = threading.Lock()
 
     def __init__(self, env):
         self.env = env
-        if self.name not in env.domaindata:
-            assert isinstance(self.initial_data, dict)
-            new_data = copy.deepcopy(self.initial_data)
-            new_data['version'] = self.data_version
-            self.data = env.domaindata[self.name] = new_data
-        else:
-            self.data = env.domaindata[self.name]
-            if self.data['version'] != self.data_version:
+        # the version of the data saved in the environment is checked without
+        # loading the data; data that has not been saved is set up right away,
+        # so that it can also be filled through `env.domaindata`
+        versions = getattr(env.domaindata, 'versions', {})
+        if self.name in versions:
+            if versions[self.name] != self.data_version:
                 raise IOError('data of %r domain out of date' % self.label)
+            self._data = None
+        else:
+            self._data = self.setup_data()
         self._role_cache = {}
         self._directive_cache = {}
         self._role2type = {}
@@ -165,6 +179,35 @@ class Domain(object):
         self.objtypes_for_role = self._role2type.get
         self.role_for_objtype = self._type2role.get
 
+    @property
+    def data(self):
+        if self._data is None:
+            with self._data_lock:
+                if self._data is None:
+                    self._data = self.setup_data()
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+
+    def setup_data(self):
+        """Return the data of the domain in the environment, created from
+        :attr:`initial_data` if there is none yet.
+        """
+        if self.name not in self.env.domaindata:
+            assert isinstance(self.initial_data, dict)
+            new_data = copy.deepcopy(self.initial_data)
+            new_data['version'] = self.data_version
+            self.env.domaindata[self.name] = new_data
+        data = self.env.domaindata[self.name]
+        if data['version'] != self.data_version:
+            raise IOError('data of %r domain out of date' % self.label)
+        for key in self.indexed_data:
+            if not isinstance(data[key], DocnameIndexedDict):
+                data[key] = DocnameIndexedDict(data[key])
+        return data
+
     def role(self, name):
         """Return a role adapter function that always gives the registered
         role its full name ('domain:name') as the first argument.
@@ -203,16 +246,27 @@ class Domain(object):
     # methods that should be overwritten
 
     def clear_doc(self, docname):
-        """Remove traces of a document in the domain-specific inventories."""
-        pass
+        """Remove traces of a document in the domain-specific inventories.
+
+        The default implementation clears the tables named in
+        :attr:`indexed_data`.
+        """
+        for key in self.indexed_data:
+            self.data[key].purge_doc(docname)
 
     def merge_domaindata(self, docnames, otherdata):
         """Merge in data regarding *docnames* from a different domaindata
         inventory (coming from a subprocess in parallel builds).
+
+        The default implementation merges the tables named in
+        :attr:`indexed_data`, if there are any.
         """
-        raise NotImplementedError('merge_domaindata must be implemented in %s '
-                                  'to be able to do parallel builds!' %
-                                  self.__class__)
+        if not self.indexed_data:
+            raise NotImplementedError('merge_domaindata must be implemented in %s '
+                                      'to be able to do parallel builds!' %
+                                      self.__class__)
+        for key in self.indexed_data:
+            self.data[key].merge_other(docnames, otherdata[key])
 
     def process_doc(self, env, docname, document):
         """Process a document after it is read by the environment."""
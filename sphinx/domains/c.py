@@ -263,17 +263,7 @@ class CDomain(Domain):
     initial_data = {
         'objects': {},  # fullname -> docname, objtype
     }
-
-    def clear_doc(self, docname):
-        for fullname, (fn, _l) in list(self.data['objects'].items()):
-            if fn == docname:
-                del self.data['objects'][fullname]
-
-    def merge_domaindata(self, docnames, otherdata):
-        # XXX check duplicates
-        for fullname, (fn, objtype) in otherdata['objects'].items():
-            if fn in docnames:
-                self.data['objects'][fullname] = (fn, objtype)
+    indexed_data = ('objects',)
 
     def resolve_xref(self, env, fromdocname, builder,
                      typ, target, node, contnode):
@@ -181,17 +181,7 @@ class JavaScriptDomain(Domain):
     initial_data = {
         'objects': {},  # fullname -> docname, objtype
     }
-
-    def clear_doc(self, docname):
-        for fullname, (fn, _l) in list(self.data['objects'].items()):
-            if fn == docname:
-                del self.data['objects'][fullname]
-
-    def merge_domaindata(self, docnames, otherdata):
-        # XXX check duplicates
-        for fullname, (fn, objtype) in otherdata['objects'].items():
-            if fn in docnames:
-                self.data['objects'][fullname] = (fn, objtype)
+    indexed_data = ('objects',)
 
     def find_obj(self, env, obj, name, typ, searchorder=0):
         if name[-2:] == '()':
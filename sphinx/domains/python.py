@@ -20,6 +20,7 @@ from sphinx.roles import XRefRole
 from sphinx.locale import l_, _
 from sphinx.domains import Domain, ObjType, Index
 from sphinx.directives import ObjectDescription
+from sphinx.util import DocnameIndexedDict
 from sphinx.util.nodes import make_refnode
 from sphinx.util.compat import Directive
 from sphinx.util.docfields import Field, GroupedField, TypedField
@@ -642,6 +643,67 @@ class PythonModuleIndex(Index):
         return content, collapse
 
 
+class PythonObjects(DocnameIndexedDict):
+    """
+    The object table of the Python domain.  For the "fuzzy" searching of
+    cross-references, the full names can also be looked up by their last
+    component; that index is built on the first such search.
+    """
+    def __init__(self, *args, **kwds):
+        self._lastnames = None  # last name component -> full names
+        DocnameIndexedDict.__init__(self, *args, **kwds)
+
+    def _add_name(self, fullname):
+        self._lastnames.setdefault(fullname.rpartition('.')[2], set()).add(fullname)
+
+    def _remove_name(self, fullname):
+        lastname = fullname.rpartition('.')[2]
+        fullnames = self._lastnames[lastname]
+        fullnames.remove(fullname)
+        if not fullnames:
+            del self._lastnames[lastname]
+
+    def __setitem__(self, key, value):
+        if self._lastnames is not None and key not in self:
+            self._add_name(key)
+        DocnameIndexedDict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        DocnameIndexedDict.__delitem__(self, key)
+        if self._lastnames is not None:
+            self._remove_name(key)
+
+    def popitem(self):
+        key, value = DocnameIndexedDict.popitem(self)
+        if self._lastnames is not None:
+            self._remove_name(key)
+        return key, value
+
+    def clear(self):
+        DocnameIndexedDict.clear(self)
+        self._lastnames = None
+
+    def purge_doc(self, docname):
+        if self._lastnames is not None:
+            for fullname in self.keys_of(docname):
+                self._remove_name(fullname)
+        DocnameIndexedDict.purge_doc(self, docname)
+
+    def find_suffix(self, name):
+        """Return the full names that end with ``'.' + name``, sorted, so that
+        the first of several matches does not depend on the order in which the
+        objects were added.
+        """
+        if self._lastnames is None:
+            self._lastnames = {}
+            for fullname in self:
+                self._add_name(fullname)
+        searchname = '.' + name
+        return sorted(fullname for fullname
+                      in self._lastnames.get(name.rpartition('.')[2], ())
+                      if fullname.endswith(searchname))
+
+
 class PythonDomain(Domain):
     """Python language domain."""
     name = 'py'
@@ -687,26 +749,16 @@ class PythonDomain(Domain):
         'objects': {},  # fullname -> docname, objtype
         'modules': {},  # modname -> docname, synopsis, platform, deprecated
     }
+    indexed_data = ('objects', 'modules')
     indices = [
         PythonModuleIndex,
     ]
 
-    def clear_doc(self, docname):
-        for fullname, (fn, _l) in list(self.data['objects'].items()):
-            if fn == docname:
-                del self.data['objects'][fullname]
-        for modname, (fn, _x, _x, _x) in list(self.data['modules'].items()):
-            if fn == docname:
-                del self.data['modules'][modname]
-
-    def merge_domaindata(self, docnames, otherdata):
-        # XXX check duplicates?
-        for fullname, (fn, objtype) in otherdata['objects'].items():
-            if fn in docnames:
-                self.data['objects'][fullname] = (fn, objtype)
-        for modname, data in otherdata['modules'].items():
-            if data[0] in docnames:
-                self.data['modules'][modname] = data
+    def setup_data(self):
+        data = Domain.setup_data(self)
+        if not isinstance(data['objects'], PythonObjects):
+            data['objects'] = PythonObjects(data['objects'])
+        return data
 
     def find_obj(self, env, modname, classname, name, type, searchmode=0):
         """Find a Python object for "name", perhaps using the given module
@@ -741,10 +793,9 @@ class PythonDomain(Domain):
                         newname = name
                     else:
                         # "fuzzy" searching mode
-                        searchname = '.' + name
-                        matches = [(oname, objects[oname]) for oname in objects
-                                   if oname.endswith(searchname) and
-                                   objects[oname][1] in objtypes]
+                        matches = [(oname, objects[oname])
+                                   for oname in objects.find_suffix(name)
+                                   if objects[oname][1] in objtypes]
         else:
             # NOTE: searching for exact match, object type is not considered
             if name in objects:
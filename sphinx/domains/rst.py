@@ -117,17 +117,7 @@ class ReSTDomain(Domain):
     initial_data = {
         'objects': {},  # fullname -> docname, objtype
     }
-
-    def clear_doc(self, docname):
-        for (typ, name), doc in list(self.data['objects'].items()):
-            if doc == docname:
-                del self.data['objects'][typ, name]
-
-    def merge_domaindata(self, docnames, otherdata):
-        # XXX check duplicates
-        for (typ, name), doc in otherdata['objects'].items():
-            if doc in docnames:
-                self.data['objects'][typ, name] = doc
+    indexed_data = ('objects',)
 
     def resolve_xref(self, env, fromdocname, builder, typ, target, node,
                      contnode):
@@ -480,6 +480,7 @@ class StandardDomain(Domain):
             'search':   ('search', ''),
         },
     }
+    indexed_data = ('progoptions', 'objects', 'citations', 'labels', 'anonlabels')
 
     dangling_warnings = {
         'term': 'term not in glossary: %(target)s',
@@ -497,41 +498,6 @@ class StandardDomain(Domain):
         nodes.container: ('code-block', None),
     }
 
-    def clear_doc(self, docname):
-        for key, (fn, _l) in list(self.data['progoptions'].items()):
-            if fn == docname:
-                del self.data['progoptions'][key]
-        for key, (fn, _l) in list(self.data['objects'].items()):
-            if fn == docname:
-                del self.data['objects'][key]
-        for key, (fn, _l) in list(self.data['citations'].items()):
-            if fn == docname:
-                del self.data['citations'][key]
-        for key, (fn, _l, _l) in list(self.data['labels'].items()):
-            if fn == docname:
-                del self.data['labels'][key]
-        for key, (fn, _l) in list(self.data['anonlabels'].items()):
-            if fn == docname:
-                del self.data['anonlabels'][key]
-
-    def merge_domaindata(self, docnames, otherdata):
-        # XXX duplicates?
-        for key, data in otherdata['progoptions'].items():
-            if data[0] in docnames:
-                self.data['progoptions'][key] = data
-        for key, data in otherdata['objects'].items():
-            if data[0] in docnames:
-                self.data['objects'][key] = data
-        for key, data in otherdata['citations'].items():
-            if data[0] in docnames:
-                self.data['citations'][key] = data
-        for key, data in otherdata['labels'].items():
-            if data[0] in docnames:
-                self.data['labels'][key] = data
-        for key, data in otherdata['anonlabels'].items():
-            if data[0] in docnames:
-                self.data['anonlabels'][key] = data
-
     def process_doc(self, env, docname, document):
         self.note_citations(env, docname, document)
         self.note_labels(env, docname, document)
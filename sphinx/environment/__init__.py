@@ -15,6 +15,7 @@ import sys
 import time
 import types
 import codecs
+import shutil
 import fnmatch
 from os import path
 from glob import glob
@@ -31,23 +32,29 @@ from docutils.frontend import OptionParser
 
 from sphinx import addnodes
 from sphinx.io import SphinxStandaloneReader, SphinxDummyWriter, SphinxFileInput
-from sphinx.util import get_matching_docs, docname_join, FilenameUniqDict
+from sphinx.util import get_matching_docs, docname_join, FilenameUniqDict, \
+    DocnameIndexedDict
 from sphinx.util.nodes import clean_astext, WarningStream, is_translatable, \
     process_only_nodes
-from sphinx.util.osutil import SEP, getcwd, fs_encoding, ensuredir
+from sphinx.util.osutil import SEP, getcwd, fs_encoding, ensuredir, file_digest
 from sphinx.util.images import guess_mimetype
 from sphinx.util.i18n import find_catalog_files, get_image_filename_for_language, \
     search_image_for_language
 from sphinx.util.console import bold, purple
 from sphinx.util.docutils import sphinx_domains
 from sphinx.util.matching import compile_matchers
-from sphinx.util.parallel import ParallelTasks, parallel_available, make_chunks
+from sphinx.util.cache import LRUCache
+from sphinx.util.parallel import ParallelPool, parallel_available, make_chunks
 from sphinx.util.websupport import is_commentable
-from sphinx.errors import SphinxError, ExtensionError
+from sphinx.errors import SphinxError, ExtensionError, ConfigError
 from sphinx.versioning import add_uids, merge_doctrees
 from sphinx.transforms import SphinxContentsFilter
 from sphinx.environment.managers.indexentries import IndexEntries
 from sphinx.environment.managers.toctree import Toctree
+from sphinx.environment.storage import PickleStorage, doctree_storages, \
+    load_doctree
+from sphinx.environment.shards import DOC_BUCKETS, Shards, ShardDict, \
+    DomainDataDict, doc_bucket, read_shard, write_shard
 
 
 default_settings = {
@@ -66,7 +73,7 @@ default_settings = {
 # or changed to properly invalidate pickle files.
 #
 # NOTE: increase base version by 2 to have distinct numbers for Py2 and 3
-ENV_VERSION = 50 + (sys.version_info[0] - 2)
+ENV_VERSION = 62 + (sys.version_info[0] - 2)
 
 
 dummy_reporter = Reporter('', 4, 4)
@@ -83,6 +90,13 @@ class NoUri(Exception):
     pass
 
 
+def get_shards_dir(filename):
+    """Return the directory that holds the shards of the environment pickled
+    into *filename*.
+    """
+    return path.splitext(filename)[0] + '.shards'
+
+
 class BuildEnvironment(object):
     """
     The environment in which the ReST files are translated.
@@ -92,6 +106,15 @@ class BuildEnvironment(object):
 
     # --------- ENVIRONMENT PERSISTENCE ----------------------------------------
 
+    # The environment is saved as a small core pickle plus a directory of
+    # shards (see get_shards_dir()): one per domain holding its data, and a
+    # fixed number of buckets of documents holding the entries of these
+    # docname-keyed attributes (see doc_bucket()).  Only the shards that have
+    # changed since the last save are written, and a shard is loaded the first
+    # time one of its entries is used.
+    doc_shard_attributes = ('metadata', 'titles', 'longtitles', 'tocs',
+                            'toc_num_entries', 'toctree_includes', 'indexentries')
+
     @staticmethod
     def frompickle(srcdir, config, filename):
         with open(filename, 'rb') as picklefile:
@@ -101,6 +124,22 @@ class BuildEnvironment(object):
         if env.srcdir != srcdir:
             raise IOError('source directory has changed')
         env.config.values = config.values
+        # the pickle may have been moved together with its shards
+        shard_dir = env._shard_dir = get_shards_dir(filename)
+
+        def read_docs(bucket):
+            return read_shard(env._doc_shard_path(shard_dir, bucket))
+
+        def read_domain(domainname):
+            return {'domaindata': {
+                domainname: read_shard(env._domain_shard_path(shard_dir, domainname))}}
+
+        doc_shards = Shards(range(DOC_BUCKETS), read_docs)
+        for name in env.doc_shard_attributes:
+            setattr(env, name, ShardDict(doc_shards, name, doc_bucket))
+        # the core pickle only holds the data versions of the domains
+        env.domaindata = DomainDataDict(Shards(env.domaindata, read_domain),
+                                        env.domaindata)
         return env
 
     def topickle(self, filename):
@@ -119,14 +158,124 @@ class BuildEnvironment(object):
                isinstance(val, types.FunctionType) or \
                isinstance(val, class_types):
                 del self.config[key]
+        self.dump_shards(get_shards_dir(filename))
+        # the shards hold the per-document and the domain data; only the data
+        # versions of the domains stay in the core pickle
+        shard_data = dict((name, self.__dict__.pop(name))
+                          for name in self.doc_shard_attributes + ('domaindata',))
+        domaindata = shard_data['domaindata']
+        if isinstance(domaindata, DomainDataDict):
+            self.domaindata = dict(domaindata.versions)
+            loaded = domaindata.data
+        else:
+            self.domaindata = {}
+            loaded = domaindata
+        for domainname, data in iteritems(loaded):
+            self.domaindata[domainname] = data['version']
         with open(filename, 'wb') as picklefile:
             pickle.dump(self, picklefile, pickle.HIGHEST_PROTOCOL)
         # reset attributes
+        self.__dict__.update(shard_data)
         self.attach_managers(managers)
         self.domains = domains
         self.config.values = values
         self.set_warnfunc(warnfunc)
 
+    def dump_shards(self, dirname):
+        """Save the per-document and the domain data into the directory
+        *dirname*.
+
+        Only the buckets of the documents that have been read or removed since
+        the last save are written, and only the domains whose data has been
+        loaded and has changed (see :meth:`domain_data_changed`).
+        """
+        if self._shard_dir != dirname:
+            # not saved there before: write all shards from scratch
+            buckets = set(range(DOC_BUCKETS))
+            domainnames = set(self.domaindata)
+            if path.isdir(dirname):
+                shutil.rmtree(dirname)
+        else:
+            buckets = set(doc_bucket(docname) for docname in self._unsaved_docs)
+            domainnames = set(domainname for domainname, data
+                              in iteritems(self._loaded_domaindata())
+                              if self.domain_data_changed(data))
+        if buckets:
+            shards = dict((bucket, {}) for bucket in buckets)
+            for name in self.doc_shard_attributes:
+                entries = getattr(self, name)
+                if isinstance(entries, ShardDict):
+                    for bucket in buckets:
+                        entries.shards.load(bucket)
+                    entries = entries.data
+                for docname, value in iteritems(entries):
+                    bucket = doc_bucket(docname)
+                    if bucket in shards:
+                        shards[bucket].setdefault(name, {})[docname] = value
+            ensuredir(path.join(dirname, 'docs'))
+            for bucket, data in iteritems(shards):
+                write_shard(self._doc_shard_path(dirname, bucket), data)
+        if domainnames:
+            ensuredir(path.join(dirname, 'domains'))
+            for domainname in domainnames:
+                write_shard(self._domain_shard_path(dirname, domainname),
+                            self.domaindata[domainname])
+        for data in itervalues(self._loaded_domaindata()):
+            for table in itervalues(data):
+                if isinstance(table, DocnameIndexedDict):
+                    table.mark_saved()
+        self._unsaved_docs = set()
+        self._shard_dir = dirname
+
+    def domain_data_changed(self, data):
+        """Return whether the domain *data* may have changed since the last
+        save.
+
+        The tables of the domains that keep all their data in
+        :attr:`~sphinx.domains.Domain.indexed_data` tell whether their entries
+        have changed; for other domains, any document read or removed since may
+        have changed the data.
+        """
+        tables = [value for key, value in iteritems(data) if key != 'version']
+        if all(isinstance(table, DocnameIndexedDict) for table in tables):
+            return any(table.changed() for table in tables)
+        return bool(self._unsaved_docs)
+
+    def _loaded_domaindata(self):
+        if isinstance(self.domaindata, ShardDict):
+            return self.domaindata.data
+        return self.domaindata
+
+    def _doc_shard_path(self, dirname, bucket):
+        return path.join(dirname, 'docs', '%d.pickle' % bucket)
+
+    def _domain_shard_path(self, dirname, domainname):
+        return path.join(dirname, 'domains', domainname + '.pickle')
+
+    def dump_durations(self, filename):
+        """Save the read and write durations of the documents.
+
+        They are saved apart from the environment because the environment is
+        pickled before the documents are written.
+        """
+        with open(filename, 'wb') as picklefile:
+            pickle.dump((self.read_durations, self.write_durations),
+                        picklefile, pickle.HIGHEST_PROTOCOL)
+
+    def load_durations(self, filename):
+        """Load the durations saved by :meth:`dump_durations`, if any."""
+        try:
+            with open(filename, 'rb') as picklefile:
+                read_durations, write_durations = pickle.load(picklefile)
+        except Exception:
+            # the durations are only estimates; go on without them
+            return
+        for docname in self.found_docs:
+            if docname in read_durations:
+                self.read_durations[docname] = read_durations[docname]
+            if docname in write_durations:
+                self.write_durations[docname] = write_durations[docname]
+
     # --------- ENVIRONMENT INITIALIZATION -------------------------------------
 
     def __init__(self, srcdir, doctreedir, config):
@@ -154,6 +303,11 @@ class BuildEnvironment(object):
         # this is to invalidate old pickles
         self.version = ENV_VERSION
 
+        # the directory of the shards this environment was saved to and the
+        # documents read or removed since; see dump_shards()
+        self._shard_dir = None
+        self._unsaved_docs = set()
+
         # All "docnames" here are /-separated and relative and exclude
         # the source suffix.
 
@@ -165,6 +319,17 @@ class BuildEnvironment(object):
         self.included = set()       # docnames included from other documents
         self.reread_always = set()  # docnames to re-read unconditionally on
                                     # next build
+        self.file_digests = {}      # docname -> dict of filename -> (digest,
+                                    # mtime) of the source and dependency
+                                    # files at the time of reading and the
+                                    # last mtime the digest was checked for
+                                    # (if content_digests)
+        self.read_durations = {}    # docname -> seconds it took to read the
+                                    # document the last time
+        self.write_durations = {}   # docname -> seconds it took to write the
+                                    # document the last time
+        # (the durations are estimates for scheduling parallel builds and
+        # survive clear_doc(); they are only dropped for removed documents)
 
         # File metadata
         self.metadata = {}          # docname -> dict of metadata items
@@ -200,6 +365,13 @@ class BuildEnvironment(object):
         self.images = FilenameUniqDict()
         self.dlfiles = FilenameUniqDict()
 
+        # the doctree storages that can be selected, the format of the doctree
+        # files, and the doctrees kept in memory between reading and writing;
+        # all are set from the application and the config in update()
+        self.doctree_storages = doctree_storages
+        self.doctree_storage = PickleStorage()
+        self.doctree_cache = LRUCache(0)
+
         # temporary data storage while reading a document
         self.temp_data = {}
         # context for cross-references (e.g. current module or class)
@@ -266,11 +438,14 @@ class BuildEnvironment(object):
 
     def clear_doc(self, docname):
         """Remove all traces of a source file in the inventory."""
+        self._unsaved_docs.add(docname)
+        self.doctree_cache.discard(docname)
         if docname in self.all_docs:
             self.all_docs.pop(docname, None)
             self.reread_always.discard(docname)
             self.metadata.pop(docname, None)
             self.dependencies.pop(docname, None)
+            self.file_digests.pop(docname, None)
             self.titles.pop(docname, None)
             self.longtitles.pop(docname, None)
             self.images.purge_doc(docname)
@@ -293,6 +468,10 @@ class BuildEnvironment(object):
         This possibly comes from a parallel build process.
         """
         docnames = set(docnames)
+        self._merge_core_info(docnames, other)
+        app.emit('env-merge-info', self, docnames, other)
+
+    def _merge_core_info(self, docnames, other):
         for docname in docnames:
             self.all_docs[docname] = other.all_docs[docname]
             if docname in other.reread_always:
@@ -300,8 +479,12 @@ class BuildEnvironment(object):
             self.metadata[docname] = other.metadata[docname]
             if docname in other.dependencies:
                 self.dependencies[docname] = other.dependencies[docname]
+            if docname in other.file_digests:
+                self.file_digests[docname] = other.file_digests[docname]
             self.titles[docname] = other.titles[docname]
             self.longtitles[docname] = other.longtitles[docname]
+            if docname in other.read_durations:
+                self.read_durations[docname] = other.read_durations[docname]
 
         self.images.merge_other(docnames, other.images)
         self.dlfiles.merge_other(docnames, other.dlfiles)
@@ -314,7 +497,31 @@ class BuildEnvironment(object):
             manager.merge_other(docnames, other)
         for domainname, domain in self.domains.items():
             domain.merge_domaindata(docnames, other.domaindata[domainname])
-        app.emit('env-merge-info', self, docnames, other)
+
+    def extract_info(self, docnames):
+        """Return a new environment that only holds the global information
+        gathered about *docnames*.
+
+        This is the counterpart of :meth:`merge_info_from`; it is used by the
+        parallel reading workers to send back only what they have read instead
+        of the whole environment.  The returned environment has neither
+        domains nor managers attached, so it can be pickled as it is.
+
+        The attributes that extensions have added to the environment are
+        passed on unchanged; the ``env-merge-info`` handlers pick the
+        information about *docnames* from them in the main process.
+        """
+        other = BuildEnvironment(self.srcdir, self.doctreedir, None)
+        other.set_warnfunc(None)
+        for domainname, domain in iteritems(self.domains):
+            other.domains[domainname] = domain.__class__(other)
+        other._merge_core_info(set(docnames), self)
+        for name, value in iteritems(self.__dict__):
+            if name not in other.__dict__:
+                other.__dict__[name] = value
+        other.detach_managers()
+        del other.domains
+        return other
 
     def path2doc(self, filename):
         """Return the docname for the filename if the file is document.
@@ -442,7 +649,7 @@ class BuildEnvironment(object):
                     continue
                 # check the mtime of the document
                 mtime = self.all_docs[docname]
-                newmtime = path.getmtime(self.doc2path(docname))
+                newmtime = self.get_file_mtime(docname, self.doc2path(docname, None))
                 if newmtime > mtime:
                     changed.add(docname)
                     continue
@@ -454,7 +661,7 @@ class BuildEnvironment(object):
                         if not path.isfile(deppath):
                             changed.add(docname)
                             break
-                        depmtime = path.getmtime(deppath)
+                        depmtime = self.get_file_mtime(docname, dep)
                         if depmtime > mtime:
                             changed.add(docname)
                             break
@@ -465,6 +672,31 @@ class BuildEnvironment(object):
 
         return added, changed, removed
 
+    def get_file_mtime(self, docname, filename):
+        """Return the modification time of *filename*, the source file or a
+        dependency of *docname*, given relative to the source directory.
+
+        If :confval:`content_digests` is enabled and the content of the file is
+        the same as when *docname* was read, the file counts as modified at the
+        time of reading at the latest.  The modification time the content was
+        last found unchanged at is remembered, so that the file is only read
+        again when its modification time changes again.
+        """
+        filepath = path.join(self.srcdir, filename)
+        mtime = path.getmtime(filepath)
+        readtime = self.all_docs.get(docname)
+        if self.config.content_digests and readtime is not None and \
+           mtime > readtime:
+            digests = self.file_digests.get(docname, {})
+            if filename in digests:
+                digest, checked_mtime = digests[filename]
+                if mtime == checked_mtime:
+                    return readtime
+                if digest == file_digest(filepath):
+                    digests[filename] = (digest, mtime)
+                    return readtime
+        return mtime
+
     def update(self, config, srcdir, doctreedir, app):
         """(Re-)read all files new or changed since last update.
 
@@ -500,6 +732,14 @@ class BuildEnvironment(object):
 
         # this cache also needs to be updated every time
         self._nitpick_ignore = set(self.config.nitpick_ignore)
+        self.doctree_cache = LRUCache(self.config.doctree_cache_size)
+        self.doctree_storages = app.doctree_storages
+        if self.config.doctree_storage not in self.doctree_storages:
+            raise ConfigError('unknown doctree storage %r; use one of %s' %
+                              (self.config.doctree_storage,
+                               ', '.join(sorted(self.doctree_storages))))
+        self.doctree_storage = self.doctree_storages[self.config.doctree_storage](
+            compress=self.config.doctree_compression)
 
         app.info(bold('updating environment: '), nonl=True)
 
@@ -525,6 +765,8 @@ class BuildEnvironment(object):
         for docname in removed:
             app.emit('env-purge-doc', self, docname)
             self.clear_doc(docname)
+            self.read_durations.pop(docname, None)
+            self.write_durations.pop(docname, None)
 
         # read all new and changed files
         docnames = sorted(added | changed)
@@ -576,31 +818,42 @@ class BuildEnvironment(object):
             self.read_doc(docname, app)
 
     def _read_parallel(self, docnames, app, nproc):
+        # balance the chunks by the time the docs took to read the last time
+        chunks = make_chunks(docnames, nproc, costs=self.read_durations)
+
         # clear all outdated docs at once
         for docname in docnames:
             app.emit('env-purge-doc', self, docname)
             self.clear_doc(docname)
 
+        previous_docs = []
+
         def read_process(docs):
+            # the workers are long-lived: forget the docs of the previous chunk,
+            # so that every chunk is read against the same state of the
+            # environment as in the main process
+            for docname in previous_docs:
+                app.emit('env-purge-doc', self, docname)
+                self.clear_doc(docname)
+            previous_docs[:] = docs
+
+            # the doctrees read here are only written by the main process
+            self.doctree_cache.maxsize = 0
             self.app = app
-            self.warnings = []
-            self.set_warnfunc(lambda *args, **kwargs: self.warnings.append((args, kwargs)))
+            local_warnings = []
+            self.set_warnfunc(lambda *args, **kwargs: local_warnings.append((args, kwargs)))
             for docname in docs:
                 self.read_doc(docname, app)
-            # allow pickling self to send it back
-            self.set_warnfunc(None)
-            del self.app
-            del self.domains
-            del self.config.values
-            del self.config
-            return self
+            # only send back the information about the docs just read
+            info = self.extract_info(docs)
+            info.warnings = local_warnings
+            return info
 
         def merge(docs, otherenv):
             warnings.extend(otherenv.warnings)
             self.merge_info_from(docs, otherenv, app)
 
-        tasks = ParallelTasks(nproc)
-        chunks = make_chunks(docnames, nproc)
+        tasks = ParallelPool(nproc)
 
         warnings = []
         for chunk in app.status_iterator(
@@ -639,6 +892,7 @@ class BuildEnvironment(object):
 
     def read_doc(self, docname, app=None):
         """Parse a file and add/update inventory entries for the doctree."""
+        starttime = time.time()
 
         self.temp_data['docname'] = docname
         # defaults to the global default, but can be re-set in a document
@@ -706,6 +960,20 @@ class BuildEnvironment(object):
         self.all_docs[docname] = max(
             time.time(), path.getmtime(self.doc2path(docname)))
 
+        if self.config.content_digests:
+            digests = self.file_digests[docname] = {}
+            for filename in [self.doc2path(docname, None)] + \
+                    sorted(self.dependencies.get(docname, ())):
+                filepath = path.join(self.srcdir, filename)
+                try:
+                    # the mtime is taken first, so that a change while the
+                    # digest is made shows as a newer mtime later
+                    mtime = path.getmtime(filepath)
+                    digests[filename] = (file_digest(filepath), mtime)
+                except EnvironmentError:
+                    # nonexisting dependencies count as changed anyway
+                    pass
+
         if self.versioning_condition:
             old_doctree = None
             if self.versioning_compare:
@@ -713,7 +981,7 @@ class BuildEnvironment(object):
                 try:
                     with open(self.doc2path(docname,
                                             self.doctreedir, '.doctree'), 'rb') as f:
-                        old_doctree = pickle.load(f)
+                        old_doctree = load_doctree(f.read(), self.doctree_storages)
                 except EnvironmentError:
                     pass
 
@@ -740,8 +1008,14 @@ class BuildEnvironment(object):
         doctree_filename = self.doc2path(docname, self.doctreedir,
                                          '.doctree')
         ensuredir(path.dirname(doctree_filename))
+        data = self.doctree_storage.dumps(doctree)
         with open(doctree_filename, 'wb') as f:
-            pickle.dump(doctree, f, pickle.HIGHEST_PROTOCOL)
+            f.write(data)
+        # the document is likely to be written soon: keep the doctree, weighed
+        # by its stored size, so that get_doctree() need not load it again
+        self.doctree_cache.put(docname, doctree, len(data))
+
+        self.read_durations[docname] = time.time() - starttime
 
     # utilities to use while reading a document
 
@@ -983,10 +1257,15 @@ class BuildEnvironment(object):
     # --------- RESOLVING REFERENCES AND TOCTREES ------------------------------
 
     def get_doctree(self, docname):
-        """Read the doctree for a file from the pickle and return it."""
-        doctree_filename = self.doc2path(docname, self.doctreedir, '.doctree')
-        with open(doctree_filename, 'rb') as f:
-            doctree = pickle.load(f)
+        """Read the doctree for a file from the doctree directory and return it."""
+        # a doctree that has just been read is handed out once, instead of
+        # being loaded again; it is not kept any longer, since callers may
+        # modify the doctree they get, and copying it is slower than loading
+        doctree = self.doctree_cache.take(docname)
+        if doctree is None:
+            doctree_filename = self.doc2path(docname, self.doctreedir, '.doctree')
+            with open(doctree_filename, 'rb') as f:
+                doctree = load_doctree(f.read(), self.doctree_storages)
         doctree.settings.env = self
         doctree.reporter = Reporter(self.doc2path(docname), 2, 5,
                                     stream=WarningStream(self._warnfunc))
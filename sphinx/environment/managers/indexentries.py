@@ -24,9 +24,8 @@ from sphinx.environment.managers import EnvironmentManager
 class IndexEntries(EnvironmentManager):
     name = 'indices'
 
-    def __init__(self, env):
-        super(IndexEntries, self).__init__(env)
-        self.data = env.indexentries
+    # looked up in the environment each time, see Toctree
+    data = property(lambda self: self.env.indexentries)
 
     def clear_doc(self, docname):
         self.data.pop(docname, None)
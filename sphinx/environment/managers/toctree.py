@@ -22,14 +22,17 @@ from sphinx.environment.managers import EnvironmentManager
 class Toctree(EnvironmentManager):
     name = 'toctree'
 
+    # the per-document data is looked up in the environment each time, since
+    # it may only be loaded from the environment's shards when it is used
+    tocs = property(lambda self: self.env.tocs)
+    toc_num_entries = property(lambda self: self.env.toc_num_entries)
+    toctree_includes = property(lambda self: self.env.toctree_includes)
+
     def __init__(self, env):
         super(Toctree, self).__init__(env)
 
-        self.tocs = env.tocs
-        self.toc_num_entries = env.toc_num_entries
         self.toc_secnumbers = env.toc_secnumbers
         self.toc_fignumbers = env.toc_fignumbers
-        self.toctree_includes = env.toctree_includes
         self.files_to_rebuild = env.files_to_rebuild
         self.glob_toctrees = env.glob_toctrees
         self.numbered_toctrees = env.numbered_toctrees
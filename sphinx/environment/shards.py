@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinx.environment.shards
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    The parts of a saved environment that are loaded when they are first used.
+
+    :copyright: Copyright 2007-2017 by the Sphinx team, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import zlib
+import threading
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+from six import iteritems
+from six.moves import cPickle as pickle
+
+# the number of buckets the per-document data of the environment is split into
+DOC_BUCKETS = 64
+
+
+def doc_bucket(docname):
+    """Return the bucket that holds the per-document data of *docname*; it is
+    the same for all builds.
+    """
+    return (zlib.crc32(docname.encode('utf-8')) & 0xffffffff) % DOC_BUCKETS
+
+
+def read_shard(filename):
+    with open(filename, 'rb') as picklefile:
+        return pickle.load(picklefile)
+
+
+def write_shard(filename, data):
+    with open(filename, 'wb') as picklefile:
+        pickle.dump(data, picklefile, pickle.HIGHEST_PROTOCOL)
+
+
+class Shards(object):
+    """The shards of a saved environment, which are loaded into the
+    :class:`ShardDict` instances created for them when one of their entries
+    is first used.
+
+    *shards* are the names of the shards, and *read* is a function that
+    returns the entries of a shard as a dict of ``{dict name: entries}``.
+    """
+
+    def __init__(self, shards, read):
+        self.pending = set(shards)
+        self.read = read
+        self.dicts = {}
+        # guards the loading, which may be triggered by the threads of
+        # concurrent tasks
+        self.lock = threading.Lock()
+
+    def load(self, shard):
+        if shard not in self.pending:
+            return
+        with self.lock:
+            if shard in self.pending:
+                for name, entries in iteritems(self.read(shard)):
+                    self.dicts[name].data.update(entries)
+                self.pending.discard(shard)
+
+    def load_all(self):
+        for shard in sorted(self.pending):
+            self.load(shard)
+
+
+class ShardDict(MutableMapping):
+    """A dictionary whose entries are loaded from :class:`Shards`: a key is
+    looked up after loading the shard it belongs to, and all shards are loaded
+    before the dictionary is iterated over.  :attr:`data` holds the entries
+    that have been loaded so far.
+
+    The dictionary is filled with the entries called *name* in the shards;
+    *shard_of* returns the shard of a key.
+    """
+
+    def __init__(self, shards, name, shard_of):
+        self.shards = shards
+        self.shard_of = shard_of
+        self.data = {}
+        shards.dicts[name] = self
+
+    def __getitem__(self, key):
+        self.shards.load(self.shard_of(key))
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.shards.load(self.shard_of(key))
+        self.data[key] = value
+
+    def __delitem__(self, key):
+        self.shards.load(self.shard_of(key))
+        del self.data[key]
+
+    def __contains__(self, key):
+        self.shards.load(self.shard_of(key))
+        return key in self.data
+
+    def get(self, key, default=None):
+        self.shards.load(self.shard_of(key))
+        return self.data.get(key, default)
+
+    def __iter__(self):
+        self.shards.load_all()
+        return iter(self.data)
+
+    def __len__(self):
+        self.shards.load_all()
+        return len(self.data)
+
+    def __repr__(self):
+        self.shards.load_all()
+        return '%s(%r)' % (self.__class__.__name__, self.data)
+
+
+class DomainDataDict(ShardDict):
+    """The data of the domains of a saved environment, one shard per domain.
+    :attr:`versions` holds the data versions of the saved domains, so that
+    they can be checked without loading the data.
+    """
+
+    def __init__(self, shards, versions):
+        ShardDict.__init__(self, shards, 'domaindata', lambda name: name)
+        self.versions = versions
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinx.environment.storage
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Storage formats for the doctrees in the doctree directory.
+
+    :copyright: Copyright 2007-2017 by the Sphinx team, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import gc
+import sys
+import zlib
+import marshal
+from io import BytesIO
+from importlib import import_module
+from contextlib import contextmanager
+
+from six import text_type, binary_type, integer_types, iteritems
+from six.moves import cPickle as pickle
+from docutils import nodes
+
+# marks a doctree that is not stored as a plain pickle; it is followed by the
+# name of the storage, a NUL byte and a compression flag
+MAGIC = b'\x00SDT'
+
+# types of values that are stored by marshal in the compact storage
+plain_types = set([text_type, binary_type, bool, float, type(None)] + list(integer_types))
+
+
+class DoctreeStorage(object):
+    """Base class of the doctree storages.
+
+    A storage converts a doctree into a byte string and back.  Subclasses set
+    :attr:`name` and implement :meth:`encode` and :meth:`decode`; the header
+    identifying the storage, which allows :func:`load_doctree` to read
+    doctrees written by any storage, and the optional zlib compression are
+    added by :meth:`dumps`.
+    """
+    name = None
+
+    def __init__(self, compress=False):
+        self.compress = compress
+
+    def dumps(self, doctree):
+        with paused_gc():
+            data = self.encode(doctree)
+        flag = b'-'
+        if self.compress:
+            data = zlib.compress(data, 1)
+            flag = b'z'
+        return MAGIC + self.name.encode('ascii') + b'\x00' + flag + data
+
+    def encode(self, doctree):
+        raise NotImplementedError
+
+    def decode(self, data):
+        raise NotImplementedError
+
+
+class PickleStorage(DoctreeStorage):
+    """Stores doctrees as pickles."""
+    name = 'pickle'
+
+    def dumps(self, doctree):
+        if self.compress:
+            return DoctreeStorage.dumps(self, doctree)
+        # a plain pickle, as written by earlier versions
+        return self.encode(doctree)
+
+    def encode(self, doctree):
+        return pickle.dumps(doctree, pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data):
+        return pickle.loads(data)
+
+
+class CompactStorage(DoctreeStorage):
+    """Stores doctrees as a flat table of nodes, encoded with :mod:`marshal`.
+
+    Every node is a row of (class number, number of children, text of Text
+    nodes, attributes, instance dict); the parent pointers are restored from
+    the order of the rows.  Repeated strings like attribute names are stored
+    only once by marshal.  Values that marshal cannot store, e.g. the settings
+    of the document or attributes holding arbitrary objects, are pickled
+    apart; references to nodes in them are stored as row numbers.
+    """
+    name = 'compact'
+
+    def encode(self, doctree):
+        classes = {}     # node class -> class number
+        classnames = []  # (module, name) per class number
+        rows = []
+        others = {}      # row number -> dict of values that are pickled
+        rownumbers = {}  # id(node) -> row number
+        stack = [doctree]
+        while stack:
+            node = stack.pop()
+            number = rownumbers[id(node)] = len(rows)
+            cls = node.__class__
+            classnumber = classes.get(cls)
+            if classnumber is None:
+                module = sys.modules.get(cls.__module__)
+                if getattr(module, cls.__name__, None) is not cls:
+                    # a class that cannot be imported by name
+                    return PickleStorage().encode(doctree)
+                classnumber = classes[cls] = len(classnames)
+                classnames.append((cls.__module__, cls.__name__))
+            state = node.__dict__.copy()
+            state.pop('parent', None)
+            isdocument = state.get('document') is doctree
+            if isdocument:
+                del state['document']
+            if isinstance(node, nodes.Text):
+                children = ()
+                text = text_type(node)
+                attributes = None
+            else:
+                children = state.pop('children')
+                text = None
+                attributes = state.pop('attributes')
+                if not is_plain(attributes):
+                    others.setdefault(number, {})['attributes'] = attributes
+                    attributes = None
+            if not is_plain(state):
+                other = others.setdefault(number, {})
+                for key in list(state):
+                    if not is_plain(state[key]):
+                        other[key] = state.pop(key)
+            rows.append((classnumber, len(children), text, attributes, state,
+                         isdocument))
+            stack.extend(reversed(children))
+
+        def persistent_id(obj):
+            if isinstance(obj, nodes.Node):
+                return rownumbers.get(id(obj))
+        otherfile = BytesIO()
+        pickler = pickle.Pickler(otherfile, pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = persistent_id
+        pickler.dump(others)
+        return b'c' + marshal.dumps((classnames, rows, otherfile.getvalue()))
+
+    def decode(self, data):
+        if data[:1] != b'c':
+            # fell back to pickle in encode()
+            return pickle.loads(data)
+        classnames, rows, otherdata = marshal.loads(data[1:])
+        classes = [getattr(import_module(module), name)
+                   for module, name in classnames]
+        allnodes = []
+        doctree = None
+        # the nodes whose children are being read, with the number of
+        # children still missing
+        parents = []
+        for classnumber, nchildren, text, attributes, state, isdocument in rows:
+            cls = classes[classnumber]
+            if text is not None:
+                node = text_type.__new__(cls, text)
+            else:
+                node = object.__new__(cls)
+                state['children'] = []
+                state['attributes'] = attributes
+            if doctree is None:
+                doctree = node
+            if isdocument:
+                state['document'] = doctree
+            if parents:
+                parent = parents[-1]
+                state['parent'] = parent[0]
+                parent[0].children.append(node)
+                parent[1] -= 1
+                if not parent[1]:
+                    parents.pop()
+            node.__dict__.update(state)
+            allnodes.append(node)
+            if nchildren:
+                parents.append([node, nchildren])
+
+        unpickler = pickle.Unpickler(BytesIO(otherdata))
+        unpickler.persistent_load = allnodes.__getitem__
+        for number, other in iteritems(unpickler.load()):
+            allnodes[number].__dict__.update(other)
+        return doctree
+
+
+# the built-in storages; every application starts with a copy of these, to
+# which the extensions add theirs
+doctree_storages = {
+    'pickle': PickleStorage,
+    'compact': CompactStorage,
+}
+
+
+def load_doctree(data, storages=None):
+    """Return the doctree stored in the byte string *data* by any of the
+    *storages*, a dict of storage name -> storage class (the built-in ones by
+    default).
+    """
+    if storages is None:
+        storages = doctree_storages
+    with paused_gc():
+        if not data.startswith(MAGIC):
+            return pickle.loads(data)
+        end = data.index(b'\x00', len(MAGIC))
+        name = data[len(MAGIC):end].decode('ascii')
+        if name not in storages:
+            raise ValueError('unknown doctree storage %r' % name)
+        compressed = data[end + 1:end + 2] == b'z'
+        data = data[end + 2:]
+        if compressed:
+            data = zlib.decompress(data)
+        return storages[name]().decode(data)
+
+
+def is_plain(value):
+    """Return whether *value* can be stored by marshal as it is."""
+    valuetype = type(value)
+    if valuetype in plain_types:
+        return True
+    if valuetype is list or valuetype is tuple:
+        for item in value:
+            if not is_plain(item):
+                return False
+        return True
+    if valuetype is dict:
+        for key, item in iteritems(value):
+            if type(key) not in plain_types or not is_plain(item):
+                return False
+        return True
+    return False
+
+
+@contextmanager
+def paused_gc():
+    """Disable the cyclic garbage collector while the block runs.
+
+    Creating the many objects of a doctree triggers the collector again and
+    again, which makes loading a doctree several times slower, although the
+    doctree creates no garbage.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
@@ -12,12 +12,15 @@
 
 import re
 import codecs
+import shutil
+import tempfile
 import posixpath
 from os import path
 from subprocess import Popen, PIPE
 from hashlib import sha1
+from uuid import uuid4
 
-from six import text_type
+from six import text_type, itervalues
 from docutils import nodes
 from docutils.parsers.rst import directives
 from docutils.statemachine import ViewList
@@ -26,7 +29,8 @@ import sphinx
 from sphinx.errors import SphinxError
 from sphinx.locale import _
 from sphinx.util.i18n import search_image_for_language
-from sphinx.util.osutil import ensuredir, ENOENT, EPIPE, EINVAL
+from sphinx.util.osutil import ensuredir, movefile, ENOENT, EPIPE, EINVAL
+from sphinx.util.parallel import ConcurrentTasks
 from sphinx.util.compat import Directive
 
 
@@ -157,13 +161,126 @@ class GraphvizSimple(Directive):
         return [node]
 
 
+def get_image_filename(code, options, format, config, prefix='graphviz'):
+    """Return the file name of the image of the graphviz *code*.
+
+    The name only depends on the code and on how dot is run, so that the same
+    diagram gets the same name in every builder and in every project.
+    """
+    graphviz_dot = options.get('graphviz_dot', config.graphviz_dot)
+    hashkey = (code + str(options) + str(graphviz_dot) +
+               str(config.graphviz_dot_args)).encode('utf-8')
+    return '%s-%s.%s' % (prefix, sha1(hashkey).hexdigest(), format)
+
+
+def get_cache_dir(builder):
+    """Return the directory of the shared image cache, or None."""
+    if not builder.config.graphviz_cache_dir:
+        return None
+    return path.join(builder.confdir, path.expanduser(builder.config.graphviz_cache_dir))
+
+
+def warn_dot_missing(builder, graphviz_dot):
+    builder.warn('dot command %r cannot be run (needed for graphviz '
+                 'output), check the graphviz_dot setting' % graphviz_dot)
+    if not hasattr(builder, '_graphviz_warned_dot'):
+        builder._graphviz_warned_dot = {}
+    builder._graphviz_warned_dot[graphviz_dot] = True
+
+
+def copy_image(fname, srcdir, destdir):
+    """Copy the image *fname*, and its image map if there is one, from *srcdir*
+    into *destdir*.
+
+    The image is written last and under a temporary name first, so that it
+    only appears once the copy is complete.
+    """
+    ensuredir(destdir)
+    srcfn = path.join(srcdir, fname)
+    outfn = path.join(destdir, fname)
+    if path.isfile(srcfn + '.map'):
+        shutil.copyfile(srcfn + '.map', outfn + '.map')
+    tmpfn = '%s.%s.tmp' % (outfn, uuid4().hex)
+    shutil.copyfile(srcfn, tmpfn)
+    movefile(tmpfn, outfn)
+
+
+def run_dot(code, graphviz_dot, dot_args, format, fname, outdir):
+    """Run dot to render *code* into the image *fname* in *outdir*.
+
+    Return False if the dot command cannot be run.  The output is written to a
+    temporary directory in *outdir* first and moved into place when dot has
+    finished, so that builds sharing *outdir* never see a partial image.
+    """
+    # graphviz expects UTF-8 by default
+    if isinstance(code, text_type):
+        code = code.encode('utf-8')
+
+    ensuredir(outdir)
+    tempdir = tempfile.mkdtemp(dir=outdir)
+    try:
+        tmpfn = path.join(tempdir, fname)
+        dot_args = [graphviz_dot] + list(dot_args)
+        dot_args.extend(['-T' + format, '-o' + tmpfn])
+        if format == 'png':
+            dot_args.extend(['-Tcmapx', '-o%s.map' % tmpfn])
+        try:
+            p = Popen(dot_args, stdout=PIPE, stdin=PIPE, stderr=PIPE)
+        except OSError as err:
+            if err.errno != ENOENT:   # No such file or directory
+                raise
+            return False
+        try:
+            # Graphviz may close standard input when an error occurs,
+            # resulting in a broken pipe on communicate()
+            stdout, stderr = p.communicate(code)
+        except (OSError, IOError) as err:
+            if err.errno not in (EPIPE, EINVAL):
+                raise
+            # in this case, read the standard output and standard error streams
+            # directly, to get the error message(s)
+            stdout, stderr = p.stdout.read(), p.stderr.read()
+            p.wait()
+        if p.returncode != 0:
+            raise GraphvizError('dot exited with error:\n[stderr]\n%s\n'
+                                '[stdout]\n%s' % (stderr, stdout))
+        if not path.isfile(tmpfn):
+            raise GraphvizError('dot did not produce an output file:\n[stderr]\n%s\n'
+                                '[stdout]\n%s' % (stderr, stdout))
+        outfn = path.join(outdir, fname)
+        if path.isfile(tmpfn + '.map'):
+            movefile(tmpfn + '.map', outfn + '.map')
+        movefile(tmpfn, outfn)
+        return True
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+
+def render_image(builder, code, options, format, fname):
+    """Make the image *fname* of *code* available in the image directory of
+    *builder*, taking it from the cache directory if possible.
+
+    Return False if the dot command cannot be run.
+    """
+    config = builder.config
+    graphviz_dot = options.get('graphviz_dot', config.graphviz_dot)
+    imagedir = path.join(builder.outdir, builder.imagedir)
+    cachedir = get_cache_dir(builder)
+    if cachedir is None:
+        return run_dot(code, graphviz_dot, config.graphviz_dot_args,
+                       format, fname, imagedir)
+    if not path.isfile(path.join(cachedir, fname)):
+        if not run_dot(code, graphviz_dot, config.graphviz_dot_args,
+                       format, fname, cachedir):
+            return False
+    copy_image(fname, cachedir, imagedir)
+    return True
+
+
 def render_dot(self, code, options, format, prefix='graphviz'):
     """Render graphviz code into a PNG or PDF output file."""
     graphviz_dot = options.get('graphviz_dot', self.builder.config.graphviz_dot)
-    hashkey = (code + str(options) + str(graphviz_dot) +
-               str(self.builder.config.graphviz_dot_args)).encode('utf-8')
-
-    fname = '%s-%s.%s' % (prefix, sha1(hashkey).hexdigest(), format)
+    fname = get_image_filename(code, options, format, self.builder.config, prefix)
     relfn = posixpath.join(self.builder.imgpath, fname)
     outfn = path.join(self.builder.outdir, self.builder.imagedir, fname)
 
@@ -174,48 +291,92 @@ def render_dot(self, code, options, format, prefix='graphviz'):
        self.builder._graphviz_warned_dot.get(graphviz_dot)):
         return None, None
 
-    ensuredir(path.dirname(outfn))
-
-    # graphviz expects UTF-8 by default
-    if isinstance(code, text_type):
-        code = code.encode('utf-8')
-
-    dot_args = [graphviz_dot]
-    dot_args.extend(self.builder.config.graphviz_dot_args)
-    dot_args.extend(['-T' + format, '-o' + outfn])
-    if format == 'png':
-        dot_args.extend(['-Tcmapx', '-o%s.map' % outfn])
-    try:
-        p = Popen(dot_args, stdout=PIPE, stdin=PIPE, stderr=PIPE)
-    except OSError as err:
-        if err.errno != ENOENT:   # No such file or directory
-            raise
-        self.builder.warn('dot command %r cannot be run (needed for graphviz '
-                          'output), check the graphviz_dot setting' % graphviz_dot)
-        if not hasattr(self.builder, '_graphviz_warned_dot'):
-            self.builder._graphviz_warned_dot = {}
-        self.builder._graphviz_warned_dot[graphviz_dot] = True
+    if not render_image(self.builder, code, options, format, fname):
+        warn_dot_missing(self.builder, graphviz_dot)
         return None, None
-    try:
-        # Graphviz may close standard input when an error occurs,
-        # resulting in a broken pipe on communicate()
-        stdout, stderr = p.communicate(code)
-    except (OSError, IOError) as err:
-        if err.errno not in (EPIPE, EINVAL):
-            raise
-        # in this case, read the standard output and standard error streams
-        # directly, to get the error message(s)
-        stdout, stderr = p.stdout.read(), p.stderr.read()
-        p.wait()
-    if p.returncode != 0:
-        raise GraphvizError('dot exited with error:\n[stderr]\n%s\n'
-                            '[stdout]\n%s' % (stderr, stdout))
-    if not path.isfile(outfn):
-        raise GraphvizError('dot did not produce an output file:\n[stderr]\n%s\n'
-                            '[stdout]\n%s' % (stderr, stdout))
     return relfn, outfn
 
 
+def get_output_format(builder):
+    """Return the image format that *builder* renders graphs in, or None."""
+    if builder.format == 'html':
+        return builder.config.graphviz_output_format
+    elif builder.format == 'latex':
+        return 'pdf'
+    elif builder.format == 'texinfo':
+        return 'png'
+    return None
+
+
+def collect_graphs(app, doctree):
+    """Remember the graphs of a document, to render them before it is written."""
+    env = app.env
+    if not hasattr(env, 'graphviz_graphs'):
+        env.graphviz_graphs = {}
+    graphs = [(node['code'], node['options']) for node in doctree.traverse(graphviz)]
+    if graphs:
+        env.graphviz_graphs[env.docname] = graphs
+    else:
+        env.graphviz_graphs.pop(env.docname, None)
+
+
+def purge_graphs(app, env, docname):
+    if hasattr(env, 'graphviz_graphs'):
+        env.graphviz_graphs.pop(docname, None)
+
+
+def merge_graphs(app, env, docnames, other):
+    if not hasattr(env, 'graphviz_graphs'):
+        env.graphviz_graphs = {}
+    for docname in docnames:
+        if docname in getattr(other, 'graphviz_graphs', {}):
+            env.graphviz_graphs[docname] = other.graphviz_graphs[docname]
+
+
+def render_graphs(app, env):
+    """Render the graphs of all documents that have no image yet, before the
+    documents are written.
+
+    Up to ``graphviz_render_workers`` dot processes run at the same time, so
+    that the writers find the images in place.  Graphs that cannot be rendered
+    are left to :func:`render_dot`, which then reports the error.
+    """
+    builder = app.builder
+    format = get_output_format(builder)
+    if format not in ('png', 'svg', 'pdf') or not hasattr(builder, 'imagedir'):
+        return
+
+    imagedir = path.join(builder.outdir, builder.imagedir)
+    graphs = {}
+    for docgraphs in itervalues(getattr(env, 'graphviz_graphs', {})):
+        for code, options in docgraphs:
+            fname = get_image_filename(code, options, format, builder.config)
+            if fname not in graphs and not path.isfile(path.join(imagedir, fname)):
+                graphs[fname] = (code, options)
+    if not graphs:
+        return
+
+    missing = set()
+
+    def render(args):
+        fname, (code, options) = args
+        graphviz_dot = options.get('graphviz_dot', builder.config.graphviz_dot)
+        if graphviz_dot in missing:
+            return
+        try:
+            if not render_image(builder, code, options, format, fname):
+                missing.add(graphviz_dot)
+        except GraphvizError:
+            pass
+
+    tasks = ConcurrentTasks(max(builder.config.graphviz_render_workers, 1))
+    for item in sorted(graphs.items()):
+        tasks.add_task(render, item, depends=())
+    tasks.join()
+    for graphviz_dot in sorted(missing):
+        warn_dot_missing(builder, graphviz_dot)
+
+
 def warn_for_deprecated_option(self, node):
     if hasattr(self.builder, '_graphviz_warned_inline'):
         return
@@ -356,4 +517,10 @@ def setup(app):
     app.add_config_value('graphviz_dot', 'dot', 'html')
     app.add_config_value('graphviz_dot_args', [], 'html')
     app.add_config_value('graphviz_output_format', 'png', 'html')
+    app.add_config_value('graphviz_render_workers', 4, 'html')
+    app.add_config_value('graphviz_cache_dir', None, 'html')
+    app.connect('doctree-read', collect_graphs)
+    app.connect('env-purge-doc', purge_graphs)
+    app.connect('env-merge-info', merge_graphs)
+    app.connect('env-updated', render_graphs)
     return {'version': sphinx.__display_version__, 'parallel_read_safe': True}
@@ -18,7 +18,7 @@ from os import path
 from subprocess import Popen, PIPE
 from hashlib import sha1
 
-from six import text_type
+from six import text_type, itervalues
 from docutils import nodes
 
 import sphinx
@@ -26,8 +26,10 @@ from sphinx.locale import _
 from sphinx.errors import SphinxError, ExtensionError
 from sphinx.util.png import read_png_depth, write_png_depth
 from sphinx.util.osutil import ensuredir, ENOENT, cd
+from sphinx.util.parallel import ConcurrentTasks
 from sphinx.util.pycompat import sys_encoding
-from sphinx.ext.mathbase import setup_math as mathbase_setup, wrap_displaymath
+from sphinx.ext.mathbase import setup_math as mathbase_setup, wrap_displaymath, \
+    math as math_node, displaymath
 
 
 class MathExtError(SphinxError):
@@ -68,7 +70,77 @@ DOC_BODY_PREVIEW = r'''
 \end{document}
 '''
 
+# in the batch mode, each formula is typeset on its own page, numbered by
+# its position in the batch
+DOC_BATCH = r'''
+\begin{document}
+%s
+\end{document}
+'''
+
+DOC_BATCH_PREVIEW = r'''
+\usepackage[active]{preview}
+\begin{document}
+%s
+\end{document}
+'''
+
+# the definitions made on a page stay local to it, and the equation counter
+# restarts on each page, so that a page looks like the image of its formula
+# rendered by itself
+DOC_PAGE = r'''
+\setcounter{page}{%d}
+\setcounter{equation}{0}
+\begingroup
+\fontsize{%d}{%d}\selectfont %s
+\endgroup
+\clearpage
+'''
+
+DOC_PAGE_PREVIEW = r'''
+\setcounter{page}{%d}
+\setcounter{equation}{0}
+\begin{preview}
+\begingroup
+\fontsize{%s}{%s}\selectfont %s
+\endgroup
+\end{preview}
+'''
+
 depth_re = re.compile(br'\[\d+ depth=(-?\d+)\]')
+page_depth_re = re.compile(br'\[(\d+) depth=(-?\d+)\]')
+
+
+def generate_latex(math, config):
+    """Return the LaTeX document that renders *math* on its own."""
+    font_size = config.imgmath_font_size
+    latex = DOC_HEAD + config.imgmath_latex_preamble
+    latex += (config.imgmath_use_preview and DOC_BODY_PREVIEW or DOC_BODY) % (
+        font_size, int(round(font_size * 1.2)), math)
+    return latex
+
+
+def get_image_filename(latex, config):
+    """Return the file name of the image rendered from the LaTeX document
+    *latex*, which is the same for all builds.
+    """
+    return "%s.%s" % (sha1(latex.encode('utf-8')).hexdigest(),
+                      config.imgmath_image_format)
+
+
+def warn_latex_missing(builder):
+    builder.warn('LaTeX command %r cannot be run (needed for math '
+                 'display), check the imgmath_latex setting' %
+                 builder.config.imgmath_latex)
+    builder._imgmath_warned_latex = True
+
+
+def warn_image_translator_missing(builder, image_translator, image_translator_executable):
+    builder.warn('%s command %r cannot be run (needed for math '
+                 'display), check the imgmath_%s setting' %
+                 (image_translator, image_translator_executable,
+                  image_translator))
+    builder._imgmath_warned_image_translator = True
 
 
 def render_math(self, math):
@@ -90,13 +162,10 @@ def render_math(self, math):
         raise MathExtError(
             'imgmath_image_format must be either "png" or "svg"')
 
-    font_size = self.builder.config.imgmath_font_size
     use_preview = self.builder.config.imgmath_use_preview
-    latex = DOC_HEAD + self.builder.config.imgmath_latex_preamble
-    latex += (use_preview and DOC_BODY_PREVIEW or DOC_BODY) % (
-        font_size, int(round(font_size * 1.2)), math)
+    latex = generate_latex(math, self.builder.config)
 
-    shasum = "%s.%s" % (sha1(latex.encode('utf-8')).hexdigest(), image_format)
+    shasum = get_image_filename(latex, self.builder.config)
     relfn = posixpath.join(self.builder.imgpath, 'math', shasum)
     outfn = path.join(self.builder.outdir, self.builder.imagedir, 'math', shasum)
     if path.isfile(outfn):
@@ -134,10 +203,7 @@ def render_math(self, math):
         except OSError as err:
             if err.errno != ENOENT:   # No such file or directory
                 raise
-            self.builder.warn('LaTeX command %r cannot be run (needed for math '
-                              'display), check the imgmath_latex setting' %
-                              self.builder.config.imgmath_latex)
-            self.builder._imgmath_warned_latex = True
+            warn_latex_missing(self.builder)
             return None, None
 
     stdout, stderr = p.communicate()
@@ -175,11 +241,8 @@ def render_math(self, math):
     except OSError as err:
         if err.errno != ENOENT:   # No such file or directory
             raise
-        self.builder.warn('%s command %r cannot be run (needed for math '
-                          'display), check the imgmath_%s setting' %
-                          (image_translator, image_translator_executable,
-                           image_translator))
-        self.builder._imgmath_warned_image_translator = True
+        warn_image_translator_missing(self.builder, image_translator,
+                                      image_translator_executable)
         return None, None
 
     stdout, stderr = p.communicate()
@@ -198,6 +261,190 @@ def render_math(self, math):
     return relfn, depth
 
 
+def get_math(node, config):
+    """Return the math of the formula *node* as it is rendered."""
+    if isinstance(node, math_node):
+        return '$' + node['latex'] + '$'
+    elif node['nowrap']:
+        return node['latex']
+    else:
+        return wrap_displaymath(node['latex'], None, config.math_number_all)
+
+
+def collect_formulas(app, doctree):
+    """Remember the formulas of the document, for rendering them in a batch."""
+    env = app.env
+    if not hasattr(env, 'imgmath_formulas'):
+        env.imgmath_formulas = {}
+    formulas = [get_math(node, env.config)
+                for node in doctree.traverse(math_node) + doctree.traverse(displaymath)]
+    if formulas:
+        env.imgmath_formulas[env.docname] = formulas
+
+
+def purge_formulas(app, env, docname):
+    if hasattr(env, 'imgmath_formulas'):
+        env.imgmath_formulas.pop(docname, None)
+
+
+def merge_formulas(app, env, docnames, other):
+    if not hasattr(env, 'imgmath_formulas'):
+        env.imgmath_formulas = {}
+    for docname in docnames:
+        if docname in getattr(other, 'imgmath_formulas', {}):
+            env.imgmath_formulas[docname] = other.imgmath_formulas[docname]
+
+
+def render_math_batch(app, env):
+    """Render the formulas of all documents that have no image yet, before the
+    documents are written.
+
+    The formulas are typeset as the pages of one LaTeX document per worker,
+    which are converted with one call of dvipng or dvisvgm each.  Formulas
+    that cannot be rendered like this are left to :func:`render_math`, which
+    then reports the error.
+    """
+    builder = app.builder
+    config = builder.config
+    if not config.imgmath_batch or builder.format != 'html' or \
+       not hasattr(builder, 'imagedir') or \
+       config.imgmath_image_format not in ('png', 'svg'):
+        return
+    if hasattr(builder, '_imgmath_warned_latex') or \
+       hasattr(builder, '_imgmath_warned_image_translator'):
+        return
+
+    imagedir = path.join(builder.outdir, builder.imagedir, 'math')
+    formulas = {}
+    for docformulas in itervalues(getattr(env, 'imgmath_formulas', {})):
+        for math in docformulas:
+            shasum = get_image_filename(generate_latex(math, config), config)
+            if shasum not in formulas and not path.isfile(path.join(imagedir, shasum)):
+                formulas[shasum] = math
+    if not formulas:
+        return
+
+    ensuredir(imagedir)
+    formulas = sorted(formulas.items())
+    nproc = max(app.parallel, 1)
+    missing = []
+    tasks = ConcurrentTasks(nproc)
+    for i in range(min(nproc, len(formulas))):
+        tasks.add_task(render_math_pages, (builder, imagedir, formulas[i::nproc]),
+                       lambda arg, result: missing.append(result), depends=())
+    tasks.join()
+
+    if 'latex' in missing:
+        warn_latex_missing(builder)
+    elif 'dvipng' in missing:
+        warn_image_translator_missing(builder, 'dvipng', config.imgmath_dvipng)
+    elif 'dvisvgm' in missing:
+        warn_image_translator_missing(builder, 'dvisvgm', config.imgmath_dvisvgm)
+
+
+def render_math_pages(args):
+    """Render the (image file name, math) pairs in *formulas* into
+    *imagedir*, as the pages of one LaTeX document.
+
+    If latex or the image translator exits with an error, the formulas are
+    split in halves which are rendered on their own, until the formulas with
+    errors are alone; these are left to :func:`render_math`.
+
+    Return the name of the program that cannot be run, if any.
+    """
+    builder, imagedir, formulas = args
+    batches = [formulas]
+    while batches:
+        formulas = batches.pop()
+        try:
+            missing = render_pages(builder, imagedir, formulas)
+        except MathExtError:
+            if len(formulas) > 1:
+                half = len(formulas) // 2
+                batches.append(formulas[half:])
+                batches.append(formulas[:half])
+            continue
+        if missing:
+            return missing
+
+
+def render_pages(builder, imagedir, formulas):
+    """Typeset the (image file name, math) pairs in *formulas* as the pages
+    of one LaTeX document and move the image of each page into *imagedir*.
+
+    Return the name of the program that cannot be run, if any, and raise
+    MathExtError if one exits with an error.
+    """
+    config = builder.config
+    font_size = config.imgmath_font_size
+    use_preview = config.imgmath_use_preview
+    pages = ''.join((use_preview and DOC_PAGE_PREVIEW or DOC_PAGE) %
+                    (number, font_size, int(round(font_size * 1.2)), math)
+                    for number, (shasum, math) in enumerate(formulas, 1))
+    latex = DOC_HEAD + config.imgmath_latex_preamble
+    latex += (use_preview and DOC_BATCH_PREVIEW or DOC_BATCH) % pages
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        with codecs.open(path.join(tempdir, 'math.tex'), 'w', 'utf-8') as tf:
+            tf.write(latex)
+
+        ltx_args = [config.imgmath_latex, '--interaction=nonstopmode']
+        ltx_args.extend(config.imgmath_latex_args)
+        ltx_args.append('math.tex')
+        try:
+            p = Popen(ltx_args, stdout=PIPE, stderr=PIPE, cwd=tempdir)
+        except OSError as err:
+            if err.errno != ENOENT:   # No such file or directory
+                raise
+            return 'latex'
+        stdout, stderr = p.communicate()
+        if p.returncode != 0:
+            # in nonstopmode, the pages with errors are typeset anyway, but
+            # there is no telling which ones they are
+            raise MathExtError('latex exited with error', stderr, stdout)
+
+        if config.imgmath_image_format == 'png':
+            image_translator = 'dvipng'
+            image_translator_args = [config.imgmath_dvipng, '-o',
+                                     path.join(tempdir, 'page%d.png'), '-T', 'tight', '-z9']
+            image_translator_args.extend(config.imgmath_dvipng_args)
+            if use_preview:
+                image_translator_args.append('--depth')
+        else:
+            image_translator = 'dvisvgm'
+            image_translator_args = [config.imgmath_dvisvgm, '-p', '1-', '-o',
+                                     path.join(tempdir, 'page%p.svg')]
+            image_translator_args.extend(config.imgmath_dvisvgm_args)
+        image_translator_args.append(path.join(tempdir, 'math.dvi'))
+        try:
+            p = Popen(image_translator_args, stdout=PIPE, stderr=PIPE)
+        except OSError as err:
+            if err.errno != ENOENT:   # No such file or directory
+                raise
+            return image_translator
+        stdout, stderr = p.communicate()
+        if p.returncode != 0:
+            raise MathExtError('%s exited with error' % image_translator,
+                               stderr, stdout)
+
+        depths = {}
+        if use_preview and image_translator == 'dvipng':
+            for number, depth in page_depth_re.findall(stdout):
+                depths[int(number)] = int(depth)
+        extension = config.imgmath_image_format
+        for number, (shasum, math) in enumerate(formulas, 1):
+            pagefn = path.join(tempdir, 'page%d.%s' % (number, extension))
+            if not path.isfile(pagefn):
+                continue
+            outfn = path.join(imagedir, shasum)
+            shutil.move(pagefn, outfn)
+            if number in depths:
+                write_png_depth(outfn, depths[number])
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+
 def cleanup_tempdir(app, exc):
     if exc:
         return
@@ -217,7 +464,7 @@ def get_tooltip(self, node):
 
 def html_visit_math(self, node):
     try:
-        fname, depth = render_math(self, '$' + node['latex'] + '$')
+        fname, depth = render_math(self, get_math(node, self.builder.config))
     except MathExtError as exc:
         msg = text_type(exc)
         sm = nodes.system_message(msg, type='WARNING', level=2,
@@ -238,13 +485,8 @@ def html_visit_math(self, node):
 
 
 def html_visit_displaymath(self, node):
-    if node['nowrap']:
-        latex = node['latex']
-    else:
-        latex = wrap_displaymath(node['latex'], None,
-                                 self.builder.config.math_number_all)
     try:
-        fname, depth = render_math(self, latex)
+        fname, depth = render_math(self, get_math(node, self.builder.config))
     except MathExtError as exc:
         msg = text_type(exc)
         sm = nodes.system_message(msg, type='WARNING', level=2,
@@ -287,5 +529,10 @@ def setup(app):
     app.add_config_value('imgmath_latex_preamble', '', 'html')
     app.add_config_value('imgmath_add_tooltips', True, 'html')
     app.add_config_value('imgmath_font_size', 12, 'html')
+    app.add_config_value('imgmath_batch', False, 'html')
+    app.connect('doctree-read', collect_formulas)
+    app.connect('env-purge-doc', purge_formulas)
+    app.connect('env-merge-info', merge_formulas)
+    app.connect('env-updated', render_math_batch)
     app.connect('build-finished', cleanup_tempdir)
     return {'version': sphinx.__display_version__, 'parallel_read_safe': True}
@@ -26,16 +26,26 @@
 
 from __future__ import print_function
 
+import os
 import sys
 import time
 import zlib
 import codecs
+import tempfile
 import functools
 import posixpath
 from os import path
+from hashlib import sha1
+from contextlib import contextmanager
 import re
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 from six import iteritems, string_types
+from six.moves import cPickle as pickle
 from six.moves.urllib.parse import urlsplit, urlunsplit
 from docutils import nodes
 from docutils.utils import relative_path
@@ -44,10 +54,16 @@ import sphinx
 from sphinx.locale import _
 from sphinx.builders.html import INVENTORY_FILENAME
 from sphinx.util import requests
+from sphinx.util.osutil import ensuredir, movefile
+from sphinx.util.parallel import ConcurrentTasks
 
 
 UTF8StreamReader = codecs.lookup('utf-8')[2]
 
+#: returned by :func:`fetch_inventory` if a conditional request found the
+#: inventory not modified
+NOT_MODIFIED = object()
+
 
 def read_inventory_v1(f, uri, join):
     f = UTF8StreamReader(f)
@@ -70,6 +86,12 @@ def read_inventory_v1(f, uri, join):
     return invdata
 
 
+# be careful to handle names with embedded spaces correctly
+_inventory_line_re = re.compile(
+    r'^(.+?)[^\S\n]+(\S*:\S*)[^\S\n]+-?\d+[^\S\n]+(\S+)[^\S\n]+(\S.*?)[^\S\n]*$',
+    re.MULTILINE)
+
+
 def read_inventory_v2(f, uri, join, bufsize=16 * 1024):
     invdata = {}
     line = f.readline()
@@ -80,41 +102,23 @@ def read_inventory_v2(f, uri, join, bufsize=16 * 1024):
     if 'zlib' not in line:
         raise ValueError
 
-    def read_chunks():
-        decompressor = zlib.decompressobj()
-        for chunk in iter(lambda: f.read(bufsize), b''):
-            yield decompressor.decompress(chunk)
-        yield decompressor.flush()
-
-    def split_lines(iter):
-        buf = b''
-        for chunk in iter:
-            buf += chunk
-            lineend = buf.find(b'\n')
-            while lineend != -1:
-                yield buf[:lineend].decode('utf-8')
-                buf = buf[lineend + 1:]
-                lineend = buf.find(b'\n')
-        assert not buf
-
-    for line in split_lines(read_chunks()):
-        # be careful to handle names with embedded spaces correctly
-        m = re.match(r'(?x)(.+?)\s+(\S*:\S*)\s+(-?\d+)\s+(\S+)\s+(.*)',
-                     line.rstrip())
-        if not m:
-            continue
-        name, type, prio, location, dispname = m.groups()
-        if type == 'py:module' and type in invdata and \
-                name in invdata[type]:  # due to a bug in 1.1 and below,
-                                        # two inventory entries are created
-                                        # for Python modules, and the first
-                                        # one is correct
+    # decompress and decode the inventory at once, and parse all its lines
+    # with one pass of a regular expression
+    decompressor = zlib.decompressobj()
+    chunks = [decompressor.decompress(chunk)
+              for chunk in iter(lambda: f.read(bufsize), b'')]
+    chunks.append(decompressor.flush())
+    text = b''.join(chunks).decode('utf-8')
+
+    for name, type, location, dispname in _inventory_line_re.findall(text):
+        objects = invdata.setdefault(type, {})
+        if type == 'py:module' and name in objects:
+            # due to a bug in 1.1 and below, two inventory entries are
+            # created for Python modules, and the first one is correct
             continue
         if location.endswith(u'$'):
             location = location[:-1] + name
-        location = join(uri, location)
-        invdata.setdefault(type, {})[name] = (projname, version,
-                                              location, dispname)
+        objects[name] = (projname, version, join(uri, location), dispname)
     return invdata
 
 
@@ -126,6 +130,17 @@ def read_inventory(f, uri, join, bufsize=16 * 1024):
         return read_inventory_v2(f, uri, join, bufsize=bufsize)
 
 
+def index_inventory(invdata):
+    """Return an index of the inventory data *invdata*, which maps the names
+    of the objects to dicts mapping their object types to the entries.
+    """
+    index = {}
+    for type, objects in iteritems(invdata):
+        for name, entry in iteritems(objects):
+            index.setdefault(name, {})[type] = entry
+    return index
+
+
 def _strip_basic_auth(url):
     """Returns *url* with basic auth credentials removed. Also returns the
     basic auth username and password if they're present in *url*.
@@ -147,7 +162,7 @@ def _strip_basic_auth(url):
     return urlunsplit(frags)
 
 
-def _read_from_url(url, config=None):
+def _read_from_url(url, config=None, headers=None):
     """Reads data from *url* with an HTTP *GET*.
 
     This function supports fetching from resources which use basic HTTP auth as
@@ -159,11 +174,18 @@ def _read_from_url(url, config=None):
 
     :param url: URL of an HTTP resource
     :type url: ``str``
+    :param headers: additional request headers
+    :type headers: ``dict``
 
     :return: data read from resource described by *url*
     :rtype: ``file``-like object
     """
-    r = requests.get(url, stream=True, config=config, timeout=config.intersphinx_timeout)
+    kwargs = {}
+    if headers:
+        kwargs['headers'] = dict(requests.useragent_header)
+        kwargs['headers'].update(headers)
+    r = requests.get(url, stream=True, config=config, timeout=config.intersphinx_timeout,
+                     **kwargs)
     r.raise_for_status()
     r.raw.url = r.url
     # decode content-body based on the header.
@@ -197,8 +219,15 @@ def _get_safe_url(url):
         return urlunsplit(frags)
 
 
-def fetch_inventory(app, uri, inv):
-    """Fetch, parse and return an intersphinx inventory file."""
+def fetch_inventory(app, uri, inv, validator=None):
+    """Fetch, parse and return an intersphinx inventory file.
+
+    If *validator* is given, it is a dict with the ``ETag`` and
+    ``Last-Modified`` headers of an earlier response for a remote *inv*: the
+    request is then made conditional, and :data:`NOT_MODIFIED` is returned if
+    the inventory has not been modified.  Otherwise, *validator* is updated
+    with the headers of the new response.
+    """
     # both *uri* (base URI of the links to generate) and *inv* (actual
     # location of the inventory file) can be local or remote URIs
     localuri = '://' not in uri
@@ -207,13 +236,27 @@ def fetch_inventory(app, uri, inv):
         uri = _strip_basic_auth(uri)
     try:
         if '://' in inv:
-            f = _read_from_url(inv, config=app.config)
+            headers = {}
+            if validator:
+                if validator.get('ETag'):
+                    headers['If-None-Match'] = validator['ETag']
+                if validator.get('Last-Modified'):
+                    headers['If-Modified-Since'] = validator['Last-Modified']
+            f = _read_from_url(inv, config=app.config, headers=headers)
         else:
             f = open(path.join(app.srcdir, inv), 'rb')
     except Exception as err:
         app.warn('intersphinx inventory %r not fetchable due to '
                  '%s: %s' % (inv, err.__class__, err))
         return
+    if validator is not None and hasattr(f, 'url'):
+        if validator and f.status == 304:
+            f.close()
+            return NOT_MODIFIED
+        validator.clear()
+        for header in ('ETag', 'Last-Modified'):
+            if f.headers.get(header):
+                validator[header] = f.headers[header]
     try:
         if hasattr(f, 'url'):
             newinv = f.url
@@ -235,8 +278,99 @@ def fetch_inventory(app, uri, inv):
         return invdata
 
 
+class InventoryCache(object):
+    """A cache of parsed remote inventories in the directory *dirname*, which
+    can be shared by several projects and concurrent builds.
+
+    Each inventory is pickled, together with the time it was fetched and the
+    validator of the response, in a file named after the hash of its URL and
+    the base URI of its links.  The entries are only read and written while
+    they are locked with :meth:`lock`.
+    """
+
+    version = 1
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        ensuredir(dirname)
+
+    def _filename(self, uri, inv):
+        key = ('%s\0%s' % (uri, inv)).encode('utf-8')
+        return path.join(self.dirname, sha1(key).hexdigest())
+
+    @contextmanager
+    def lock(self, uri, inv):
+        """Lock the entry of *inv* for other processes, if :mod:`fcntl` is
+        available; other builds then wait until it has been fetched.
+        """
+        if fcntl is None:
+            yield
+            return
+        with open(self._filename(uri, inv) + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def load(self, uri, inv):
+        """Return the time, validator and data of the cached inventory, or
+        ``None`` if it is not cached.
+        """
+        try:
+            with open(self._filename(uri, inv) + '.pickle', 'rb') as f:
+                entry = pickle.load(f)
+        except Exception:
+            # missing or unreadable
+            return None
+        if not isinstance(entry, dict) or entry.get('version') != self.version or \
+           entry.get('uri') != uri or entry.get('inv') != inv:
+            return None
+        return entry['time'], entry['validator'], entry['invdata']
+
+    def save(self, uri, inv, time, validator, invdata):
+        filename = self._filename(uri, inv) + '.pickle'
+        fd, tmpname = tempfile.mkstemp(dir=self.dirname)
+        with os.fdopen(fd, 'wb') as f:
+            entry = dict(version=self.version, uri=uri, inv=inv, time=time,
+                         validator=validator, invdata=invdata)
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        movefile(tmpname, filename)
+
+
+class _MessageCollector(object):
+    """Stands in for the application in the fetch threads of
+    :func:`load_mappings`, and collects the messages emitted there, so that
+    they can be reported by the main thread.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.messages = []
+
+    def __getattr__(self, name):
+        return getattr(self.app, name)
+
+    def info(self, *args, **kwargs):
+        self.messages.append(('info', args, kwargs))
+
+    def warn(self, *args, **kwargs):
+        self.messages.append(('warn', args, kwargs))
+
+    def report(self):
+        for method, args, kwargs in self.messages:
+            getattr(self.app, method)(*args, **kwargs)
+
+
 def load_mappings(app):
-    """Load all intersphinx mappings into the environment."""
+    """Load all intersphinx mappings into the environment.
+
+    The inventories are fetched concurrently by up to
+    ``intersphinx_fetch_workers`` threads.  Remote inventories are shared with
+    other projects through the :class:`InventoryCache` in
+    ``intersphinx_cache_dir``, if that is set.  The messages of the threads
+    are reported afterwards, in the order of the mapping.
+    """
     now = int(time.time())
     cache_time = now - app.config.intersphinx_cache_limit * 86400
     env = app.builder.env
@@ -244,9 +378,59 @@ def load_mappings(app):
         env.intersphinx_cache = {}
         env.intersphinx_inventory = {}
         env.intersphinx_named_inventory = {}
+    if not hasattr(env, 'intersphinx_validators'):
+        # inventory URL -> ETag and Last-Modified headers of the response
+        env.intersphinx_validators = {}
     cache = env.intersphinx_cache
-    update = False
-    for key, value in iteritems(app.config.intersphinx_mapping):
+    validators = env.intersphinx_validators
+    inv_cache = None
+    cache_dir = getattr(app.config, 'intersphinx_cache_dir', None)
+    if cache_dir:
+        inv_cache = InventoryCache(path.join(app.confdir, path.expanduser(cache_dir)))
+
+    def fetch(args):
+        number, name, uri, invs = args
+        # the messages are reported by the main thread, see below
+        collector = _MessageCollector(app)
+        return collector, fetch_first(collector, uri, invs)
+
+    def fetch_first(app, uri, invs):
+        for inv in invs:
+            if not inv:
+                inv = posixpath.join(uri, INVENTORY_FILENAME)
+            # decide whether the inventory must be read: always read local
+            # files; remote ones only if the cache time is expired
+            if '://' not in inv or uri not in cache \
+                    or cache[uri][1] < cache_time:
+                safe_inv_url = _get_safe_url(inv)
+                app.info(
+                    'loading intersphinx inventory from %s...' % safe_inv_url)
+                if inv_cache is not None and '://' in inv:
+                    invdata, validator = fetch_cached(app, uri, inv)
+                else:
+                    # revalidate the cached inventory with a conditional request
+                    validator = dict(uri in cache and validators.get(inv) or {})
+                    invdata = fetch_inventory(app, uri, inv, validator)
+                if invdata:
+                    return inv, invdata, validator
+
+    def fetch_cached(app, uri, inv):
+        with inv_cache.lock(uri, inv):
+            entry = inv_cache.load(uri, inv)
+            if entry and entry[0] >= cache_time:
+                # fetched recently, maybe by another project
+                return entry[2], entry[1]
+            validator = dict(entry and entry[1] or {})
+            invdata = fetch_inventory(app, uri, inv, validator)
+            if invdata is NOT_MODIFIED:
+                invdata = entry[2]
+            if invdata:
+                inv_cache.save(uri, inv, now, validator, invdata)
+            return invdata, validator
+
+    results = []
+    tasks = ConcurrentTasks(max(getattr(app.config, 'intersphinx_fetch_workers', 10), 1))
+    for number, (key, value) in enumerate(iteritems(app.config.intersphinx_mapping)):
         if isinstance(value, (list, tuple)):
             # new format
             name, (uri, inv) = key, value
@@ -263,26 +447,36 @@ def load_mappings(app):
             invs = (inv, )
         else:
             invs = inv
+        tasks.add_task(fetch, (number, name, uri, invs),
+                       lambda args, result: results.append((args, result)), depends=())
+    tasks.join()
 
-        for inv in invs:
-            if not inv:
-                inv = posixpath.join(uri, INVENTORY_FILENAME)
-            # decide whether the inventory must be read: always read local
-            # files; remote ones only if the cache time is expired
-            if '://' not in inv or uri not in cache \
-                    or cache[uri][1] < cache_time:
-                safe_inv_url = _get_safe_url(inv)
-                app.info(
-                    'loading intersphinx inventory from %s...' % safe_inv_url)
-                invdata = fetch_inventory(app, uri, inv)
-                if invdata:
-                    cache[uri] = (name, now, invdata)
-                    update = True
-                    break
+    update = False
+    for (number, name, uri, invs), (collector, result) in \
+            sorted(results, key=lambda item: item[0][0]):
+        collector.report()
+        if not result:
+            continue
+        inv, invdata, validator = result
+        if invdata is NOT_MODIFIED:
+            cache[uri] = (name, now, cache[uri][2])
+            continue
+        cache[uri] = (name, now, invdata)
+        if validator:
+            validators[inv] = validator
+        else:
+            validators.pop(inv, None)
+        update = True
+    # environments pickled by an older version have no index yet
+    if not hasattr(env, 'intersphinx_index'):
+        update = True
+    # the object types of the references, see _get_objtype_ranks()
+    env.intersphinx_objtypes = {}
 
     if update:
         env.intersphinx_inventory = {}
         env.intersphinx_named_inventory = {}
+        env.intersphinx_named_index = {}
         # Duplicate values in different inventories will shadow each
         # other; which one will override which can vary between builds
         # since they are specified using an unordered dict.  To make
@@ -296,48 +490,72 @@ def load_mappings(app):
         for name, _x, invdata in named_vals + unnamed_vals:
             if name:
                 env.intersphinx_named_inventory[name] = invdata
+                env.intersphinx_named_index[name] = index_inventory(invdata)
             for type, objects in iteritems(invdata):
                 env.intersphinx_inventory.setdefault(
                     type, {}).update(objects)
+        # the objects by name, so that a reference is resolved with one lookup
+        env.intersphinx_index = index_inventory(env.intersphinx_inventory)
 
 
-def missing_reference(app, env, node, contnode):
-    """Attempt to resolve a missing reference via intersphinx references."""
-    target = node['reftarget']
-    if node['reftype'] == 'any':
+def _get_objtype_ranks(env, domain, reftype):
+    """Return a dict mapping the inventory object types a reference of type
+    *reftype* in *domain* can refer to to their priority, lowest first.
+    """
+    key = (domain, reftype)
+    if key in env.intersphinx_objtypes:
+        return env.intersphinx_objtypes[key]
+    if reftype == 'any':
         # we search anything!
         objtypes = ['%s:%s' % (domain.name, objtype)
                     for domain in env.domains.values()
                     for objtype in domain.object_types]
+    elif reftype == 'doc':
+        objtypes = ['std:doc']
+    else:
+        objtypes = ['%s:%s' % (domain, objtype)
+                    for objtype in env.domains[domain].objtypes_for_role(reftype) or ()]
+    if 'std:cmdoption' in objtypes:
+        # until Sphinx-1.6, cmdoptions are stored as std:option
+        objtypes.append('std:option')
+    ranks = {}
+    for rank, objtype in enumerate(objtypes):
+        ranks.setdefault(objtype, rank)
+    env.intersphinx_objtypes[key] = ranks
+    return ranks
+
+
+def missing_reference(app, env, node, contnode):
+    """Attempt to resolve a missing reference via intersphinx references."""
+    target = node['reftarget']
+    if node['reftype'] == 'any':
         domain = None
     elif node['reftype'] == 'doc':
         domain = 'std'  # special case
-        objtypes = ['std:doc']
     else:
         domain = node.get('refdomain')
         if not domain:
             # only objects in domains are in the inventory
             return
-        objtypes = env.domains[domain].objtypes_for_role(node['reftype'])
-        if not objtypes:
-            return
-        objtypes = ['%s:%s' % (domain, objtype) for objtype in objtypes]
-    if 'std:cmdoption' in objtypes:
-        # until Sphinx-1.6, cmdoptions are stored as std:option
-        objtypes.append('std:option')
-    to_try = [(env.intersphinx_inventory, target)]
+    ranks = _get_objtype_ranks(env, domain, node['reftype'])
+    if not ranks:
+        return
+    to_try = [(env.intersphinx_index, target)]
     in_set = None
     if ':' in target:
         # first part may be the foreign doc set name
         setname, newtarget = target.split(':', 1)
-        if setname in env.intersphinx_named_inventory:
+        if setname in env.intersphinx_named_index:
             in_set = setname
-            to_try.append((env.intersphinx_named_inventory[setname], newtarget))
-    for inventory, target in to_try:
-        for objtype in objtypes:
-            if objtype not in inventory or target not in inventory[objtype]:
-                continue
-            proj, version, uri, dispname = inventory[objtype][target]
+            to_try.append((env.intersphinx_named_index[setname], newtarget))
+    for index, target in to_try:
+        # the entries of the object types the reference can refer to, by
+        # the priority of their type
+        found = [(ranks[objtype], entry)
+                 for objtype, entry in iteritems(index.get(target, {}))
+                 if objtype in ranks]
+        if found:
+            proj, version, uri, dispname = min(found)[1]
             if '://' not in uri and node.get('refdoc'):
                 # get correct path in case of subdirectories
                 uri = path.join(relative_path(node['refdoc'], '.'), uri)
@@ -369,6 +587,8 @@ def setup(app):
     app.add_config_value('intersphinx_mapping', {}, True)
     app.add_config_value('intersphinx_cache_limit', 5, False)
     app.add_config_value('intersphinx_timeout', None, False)
+    app.add_config_value('intersphinx_fetch_workers', 10, False)
+    app.add_config_value('intersphinx_cache_dir', None, False)
     app.connect('missing-reference', missing_reference)
     app.connect('builder-inited', load_mappings)
     return {'version': sphinx.__display_version__, 'parallel_read_safe': True}
@@ -9,6 +9,8 @@
     :license: BSD, see LICENSE for details.
 """
 import re
+import time
+import struct
 
 from six import iteritems, itervalues, text_type, string_types
 from six.moves import cPickle as pickle
@@ -18,6 +20,7 @@ from os import path
 import sphinx
 from sphinx.util import jsdump, rpartition
 from sphinx.util.pycompat import htmlescape
+from sphinx.search import binary
 from sphinx.search.jssplitter import splitter_code
 
 class SearchLanguage(object):
@@ -161,7 +164,9 @@ class _JavaScriptIndex(object):
         return jsdump.loads(data)
 
     def dump(self, data, f):
-        f.write(self.dumps(data))
+        f.write(self.PREFIX)
+        jsdump.dump(data, f)
+        f.write(self.SUFFIX)
 
     def load(self, f):
         return self.loads(f.read())
@@ -170,6 +175,136 @@ class _JavaScriptIndex(object):
 js_index = _JavaScriptIndex()
 
 
+def pack_postings(frequencies):
+    """Pack the postings of a term of a ranked index, a dict mapping document
+    indices to the frequency of the term, into a flat list.  The list holds
+    pairs of the difference to the previous document index (the first index
+    itself) and the frequency, so the numbers stay small.
+    """
+    rv = []
+    last = 0
+    for i in sorted(frequencies):
+        rv.append(i - last)
+        rv.append(frequencies[i])
+        last = i
+    return rv
+
+
+def unpack_postings(postings):
+    """Reverse :func:`pack_postings`."""
+    rv = {}
+    i = 0
+    for pos in range(0, len(postings), 2):
+        i += postings[pos]
+        rv[i] = postings[pos + 1]
+    return rv
+
+
+def shard_of(word, nshards):
+    """Return the number of the shard of a sharded search index that holds
+    *word*.  The search JavaScript computes the same hash over the UTF-16 code
+    units of the word.
+    """
+    data = word.encode('utf-16-le')
+    h = 0
+    for unit in struct.unpack('<%dH' % (len(data) // 2), data):
+        h = (h * 31 + unit) & 0xffffffff
+    return h % nshards
+
+
+def dump_js_shard(number, shard, f):
+    """Write the *shard* of a sharded search index as a JavaScript file that
+    registers it with the search object.
+    """
+    f.write(u'Search.setShard(%d, ' % number)
+    jsdump.dump(shard, f)
+    f.write(u')')
+
+
+class StemCache(object):
+    """Memoizes the stems of the words of a search language.
+
+    The cache can be saved and loaded again by the next build.  When it holds
+    more than *maxsize* words, those that have not been looked up since it was
+    loaded are dropped first when it is saved.  The number of hits and misses
+    and the time spent in the stemmer are counted in the ``hits``,
+    ``misses`` and ``time`` attributes.
+    """
+
+    def __init__(self, lang, maxsize=100000):
+        self.lang = lang
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.time = 0
+        # word -> stemmed word
+        self._stems = {}
+        # words looked up since the cache was loaded
+        self._used = set()
+        # the stems, used words and counts to be returned by the next take_new()
+        self._new = {}
+        self._new_used = set()
+        self._new_counts = (0, 0, 0)
+
+    def __len__(self):
+        return len(self._stems)
+
+    def stem(self, word):
+        """Return the lowercased stem of *word*."""
+        try:
+            stemmed_word = self._stems[word]
+            self.hits += 1
+        except KeyError:
+            starttime = time.time()
+            stemmed_word = self.lang.stem(word).lower()
+            self.time += time.time() - starttime
+            self.misses += 1
+            self._stems[word] = self._new[word] = stemmed_word
+        if word not in self._used:
+            self._used.add(word)
+            self._new_used.add(word)
+        return stemmed_word
+
+    def take_new(self):
+        """Return the stems computed, the words looked up and the hits, misses
+        and time counted since the last call, for :meth:`merge` in another
+        process.
+        """
+        hits, misses, duration = self._new_counts
+        rv = (self._new, self._new_used, self.hits - hits, self.misses - misses,
+              self.time - duration)
+        self._new = {}
+        self._new_used = set()
+        self._new_counts = (self.hits, self.misses, self.time)
+        return rv
+
+    def merge(self, new):
+        """Add the stems, used words and counts returned by :meth:`take_new`."""
+        stems, used, hits, misses, duration = new
+        self._stems.update(stems)
+        self._used.update(used)
+        self.hits += hits
+        self.misses += misses
+        self.time += duration
+
+    def dump(self, stream):
+        stems = self._stems
+        if len(stems) > self.maxsize:
+            words = sorted(stems, key=lambda word: word not in self._used)
+            stems = dict((word, stems[word]) for word in words[:self.maxsize])
+        state = dict(lang=self.lang.lang, options=self.lang.options, stems=stems)
+        pickle.dump(state, stream, pickle.HIGHEST_PROTOCOL)
+
+    def load(self, stream):
+        """Add the stems saved by :meth:`dump`."""
+        state = pickle.load(stream)
+        if not isinstance(state, dict) or \
+           state.get('lang') != self.lang.lang or \
+           state.get('options') != self.lang.options:
+            raise ValueError('old format')
+        self._stems.update(state['stems'])
+
+
 class WordCollector(NodeVisitor):
     """
     A special visitor that collects words for the `IndexBuilder`.
@@ -222,11 +357,16 @@ class IndexBuilder(object):
     """
     formats = {
         'jsdump':   jsdump,
-        'pickle':   pickle
+        'pickle':   pickle,
+        'binary':   binary,
     }
+    rankings = (None, 'bm25')
 
-    def __init__(self, env, lang, options, scoring):
+    def __init__(self, env, lang, options, scoring, ranking=None, stem_cache_size=100000):
+        if ranking not in self.rankings:
+            raise ValueError('unknown search ranking: %r' % ranking)
         self.env = env
+        self.ranking = ranking
         # docname -> title
         self._titles = {}
         # docname -> filename
@@ -235,8 +375,10 @@ class IndexBuilder(object):
         self._mapping = {}
         # stemmed words in titles -> set(docname)
         self._title_mapping = {}
-        # word -> stemmed word
-        self._stem_cache = {}
+        # docname -> ({stemmed word: frequency}, stemmed words in titles); the
+        # forward index allows removing a document without looking at all
+        # words, and holds the term frequencies of ranked indices
+        self._doc_terms = {}
         # objtype -> index
         self._objtypes = {}
         # objtype index -> (domain, type, objname (localized))
@@ -253,6 +395,8 @@ class IndexBuilder(object):
         else:
             # it's directly a class (e.g. added by app.add_search_language)
             self.lang = lang_class(options)
+        # memoizes self.lang.stem, also across builds
+        self.stem_cache = StemCache(self.lang, stem_cache_size)
 
         if scoring:
             with open(scoring, 'rb') as fp:
@@ -270,6 +414,9 @@ class IndexBuilder(object):
         if not isinstance(frozen, dict) or \
            frozen.get('envversion') != self.env.version:
             raise ValueError('old format')
+        if 'shards' in frozen:
+            # the terms are in the shard files
+            raise ValueError('sharded index')
         index2fn = frozen['docnames']
         self._filenames = dict(zip(index2fn, frozen['filenames']))
         self._titles = dict(zip(index2fn, frozen['titles']))
@@ -283,10 +430,58 @@ class IndexBuilder(object):
                     rv[k] = set(index2fn[i] for i in v)
             return rv
 
-        self._mapping = load_terms(frozen['terms'])
         self._title_mapping = load_terms(frozen['titleterms'])
+        if 'doclengths' in frozen:
+            frequencies = dict((word, unpack_postings(postings))
+                               for word, postings in iteritems(frozen['terms']))
+            self._mapping = dict((word, set(index2fn[i] for i in freqs))
+                                 for word, freqs in iteritems(frequencies))
+        else:
+            frequencies = {}
+            self._mapping = load_terms(frozen['terms'])
+        self._doc_terms = self._invert_terms(frequencies, index2fn)
         # no need to load keywords/objtypes
 
+    def _invert_terms(self, frequencies, index2fn):
+        doc_terms = dict((docname, ({}, set())) for docname in self._titles)
+        for word, docnames in iteritems(self._mapping):
+            for docname in docnames:
+                if docname in doc_terms:
+                    doc_terms[docname][0][word] = 1
+        for word, freqs in iteritems(frequencies):
+            for i, freq in iteritems(freqs):
+                doc_terms[index2fn[i]][0][word] = freq
+        for word, docnames in iteritems(self._title_mapping):
+            for docname in docnames:
+                if docname in doc_terms:
+                    doc_terms[docname][1].add(word)
+        return doc_terms
+
+    def dump_state(self, stream):
+        """Save the postings and the forward index of the documents to the
+        binary *stream*, so that :meth:`load_state` can restore them for an
+        incremental build.
+        """
+        state = dict(envversion=self.env.version, lang=self.lang.lang,
+                     options=self.lang.options, titles=self._titles,
+                     filenames=self._filenames, terms=self._mapping,
+                     titleterms=self._title_mapping, docterms=self._doc_terms)
+        pickle.dump(state, stream, pickle.HIGHEST_PROTOCOL)
+
+    def load_state(self, stream):
+        """Restore the state saved by :meth:`dump_state`."""
+        state = pickle.load(stream)
+        if not isinstance(state, dict) or \
+           state.get('envversion') != self.env.version or \
+           state.get('lang') != self.lang.lang or \
+           state.get('options') != self.lang.options:
+            raise ValueError('old format')
+        self._titles = state['titles']
+        self._filenames = state['filenames']
+        self._mapping = state['terms']
+        self._title_mapping = state['titleterms']
+        self._doc_terms = state['docterms']
+
     def dump(self, stream, format):
         """Dump the frozen index to a stream."""
         if isinstance(format, string_types):
@@ -352,60 +547,111 @@ class IndexBuilder(object):
         objtypes = dict((v, k[0] + ':' + k[1])
                         for (k, v) in iteritems(self._objtypes))
         objnames = self._objnames
-        return dict(docnames=docnames, filenames=filenames, titles=titles, terms=terms,
-                    objects=objects, objtypes=objtypes, objnames=objnames,
-                    titleterms=title_terms, envversion=self.env.version)
+        frozen = dict(docnames=docnames, filenames=filenames, titles=titles, terms=terms,
+                      objects=objects, objtypes=objtypes, objnames=objnames,
+                      titleterms=title_terms, envversion=self.env.version)
+        if self.ranking is not None:
+            frozen['terms'] = self.get_ranked_terms(docnames)
+            frozen['doclengths'] = [sum(itervalues(self._doc_terms[docname][0]))
+                                    for docname in docnames]
+            frozen['ranking'] = self.ranking
+        return frozen
+
+    def get_ranked_terms(self, docnames):
+        """Return the terms with their postings packed by :func:`pack_postings`."""
+        frequencies = {}
+        for i, docname in enumerate(docnames):
+            for word, freq in iteritems(self._doc_terms[docname][0]):
+                frequencies.setdefault(word, {})[i] = freq
+        return dict((word, pack_postings(freqs)) for word, freqs in iteritems(frequencies))
+
+    def freeze_shards(self, nshards):
+        """Create a usable data structure for serializing, with the terms split
+        into *nshards* shards by :func:`shard_of`.  Return the index without
+        the terms, which only says how many shards there are, and the list of
+        shards.
+        """
+        frozen = self.freeze()
+        shards = [{'terms': {}, 'titleterms': {}} for i in range(nshards)]
+        for key in ('terms', 'titleterms'):
+            for word, postings in iteritems(frozen.pop(key)):
+                shards[shard_of(word, nshards)][key][word] = postings
+        frozen['shards'] = nshards
+        return frozen, shards
 
     def label(self):
         return "%s (code: %s)" % (self.lang.language_name, self.lang.lang)
 
     def prune(self, docnames):
         """Remove data for all docnames not in the list."""
-        new_titles = {}
-        new_filenames = {}
-        for docname in docnames:
-            if docname in self._titles:
-                new_titles[docname] = self._titles[docname]
-                new_filenames[docname] = self._filenames[docname]
-        self._titles = new_titles
-        self._filenames = new_filenames
-        for wordnames in itervalues(self._mapping):
-            wordnames.intersection_update(docnames)
-        for wordnames in itervalues(self._title_mapping):
-            wordnames.intersection_update(docnames)
+        for docname in set(self._titles).difference(docnames):
+            self.remove_doc(docname)
+
+    def remove_doc(self, docname):
+        """Remove the data of *docname* from the index."""
+        self._titles.pop(docname, None)
+        self._filenames.pop(docname, None)
+        terms, title_terms = self._doc_terms.pop(docname, ((), ()))
+        for mapping, words in ((self._mapping, terms),
+                               (self._title_mapping, title_terms)):
+            for word in words:
+                wordnames = mapping[word]
+                wordnames.discard(docname)
+                if not wordnames:
+                    del mapping[word]
 
     def feed(self, docname, filename, title, doctree):
         """Feed a doctree to the index."""
-        self._titles[docname] = title
-        self._filenames[docname] = filename
+        terms, title_terms = self.collect_terms(doctree)
+        self.add_terms(docname, filename, title, terms, title_terms)
+
+    def collect_terms(self, doctree):
+        """Collect the words of *doctree*.  Return a dict mapping the stemmed
+        words of the text to the number of their occurrences and the set of
+        stemmed words in titles.
 
+        This does not change the index, so the parallel write workers of the
+        HTML builder call it and only send the result back to
+        :meth:`add_terms` in the main process.
+        """
         visitor = WordCollector(doctree, self.lang)
         doctree.walk(visitor)
 
-        # memoize self.lang.stem
-        def stem(word):
-            try:
-                return self._stem_cache[word]
-            except KeyError:
-                self._stem_cache[word] = self.lang.stem(word).lower()
-                return self._stem_cache[word]
+        stem = self.stem_cache.stem
         _filter = self.lang.word_filter
 
+        title_terms = set()
         for word in visitor.found_title_words:
             stemmed_word = stem(word)
             if _filter(stemmed_word):
-                self._title_mapping.setdefault(stemmed_word, set()).add(docname)
+                title_terms.add(stemmed_word)
             elif _filter(word): # stemmer must not remove words from search index
-                self._title_mapping.setdefault(word, set()).add(docname)
+                title_terms.add(word)
 
+        terms = {}  # stemmed word -> number of occurrences
         for word in visitor.found_words:
             stemmed_word = stem(word)
             # again, stemmer must not remove words from search index
             if not _filter(stemmed_word) and _filter(word):
                 stemmed_word = word
-            already_indexed = docname in self._title_mapping.get(stemmed_word, [])
-            if _filter(stemmed_word) and not already_indexed:
-                self._mapping.setdefault(stemmed_word, set()).add(docname)
+            if _filter(stemmed_word) and stemmed_word not in title_terms:
+                terms[stemmed_word] = terms.get(stemmed_word, 0) + 1
+        return terms, title_terms
+
+    def add_terms(self, docname, filename, title, terms, title_terms):
+        """Add the words of a document, as returned by :meth:`collect_terms`,
+        to the index.
+        """
+        if docname in self._doc_terms:
+            self.remove_doc(docname)
+        self._titles[docname] = title
+        self._filenames[docname] = filename
+
+        for word in title_terms:
+            self._title_mapping.setdefault(word, set()).add(docname)
+        for word in terms:
+            self._mapping.setdefault(word, set()).add(docname)
+        self._doc_terms[docname] = (terms, title_terms)
 
     def context_for_searchtool(self):
         return dict(
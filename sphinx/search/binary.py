@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinx.search.binary
+    ~~~~~~~~~~~~~~~~~~~~
+
+    A compact binary format of the search index that can be queried without
+    loading it completely, e.g. from a memory-mapped file.
+
+    All integers are unsigned and little-endian.  The file starts with a
+    header of 60 bytes:
+
+    ==========  =========  ================================================
+    magic       8 bytes    ``SPHXSIDX``
+    version     uint32     1
+    flags       uint32     bit 0: the postings hold term frequencies
+    nstrings    uint32     number of strings in the string table
+    strings     uint32     offset of the string table
+    ndocs       uint32     number of documents
+    docs        uint32     offset of the document table
+    nterms      uint32     number of terms
+    terms       uint32     offset of the term dictionary
+    ntitles     uint32     number of title terms
+    titles      uint32     offset of the title term dictionary
+    postings    uint32     offset of the postings
+    meta        uint32     offset of the metadata
+    metalength  uint32     length of the metadata
+    ==========  =========  ================================================
+
+    The *string table* interns all strings: ``nstrings + 1`` uint32 offsets
+    relative to the end of the offsets, followed by the UTF-8 encoded strings;
+    string *i* spans from offset *i* to offset *i + 1*.
+
+    The *document table* holds three uint32 string numbers per document: the
+    document name, the file name and the title.  A missing file name is
+    ``0xffffffff``.
+
+    The *term dictionaries* hold three uint32 per term: the string number of
+    the word, the offset of its postings relative to the postings section and
+    the number of its documents.  The entries are sorted by the UTF-8 encoding
+    of the words, so a word can be found by a binary search.
+
+    The *postings* of the terms follow each other in the order of the term
+    dictionary and then the title term dictionary.  The postings of a term are
+    varints (seven bits per byte, least significant group first, the high bit
+    set on all but the last byte): the document numbers in ascending order,
+    each but the first given as the difference to the previous one.  If the
+    postings hold term frequencies, each document number is followed by the
+    frequency of the term in it.
+
+    The *metadata* is a UTF-8 encoded JSON object with the remaining parts of
+    the frozen index: ``envversion``, ``objects``, ``objtypes`` and
+    ``objnames`` (the latter two as lists of key-value pairs), and
+    ``doclengths`` and ``ranking`` for ranked indices.
+
+    :copyright: Copyright 2007-2017 by the Sphinx team, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import mmap
+import struct
+
+from six import iteritems, integer_types
+
+from sphinx.util import jsonimpl
+
+MAGIC = b'SPHXSIDX'
+VERSION = 1
+FLAG_FREQUENCIES = 1
+NO_STRING = 0xffffffff
+
+_header = struct.Struct('<8sII11I')
+_entry = struct.Struct('<III')
+
+
+def encode_varints(numbers):
+    """Return the bytes of the varints encoding *numbers*."""
+    rv = bytearray()
+    for number in numbers:
+        while number > 0x7f:
+            rv.append((number & 0x7f) | 0x80)
+            number >>= 7
+        rv.append(number)
+    return bytes(rv)
+
+
+def decode_varints(data):
+    """Return the list of numbers encoded by the varints in *data*."""
+    rv = []
+    number = shift = 0
+    for byte in bytearray(data):
+        number |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            rv.append(number)
+            number = shift = 0
+    return rv
+
+
+def dump(data, f):
+    """Write the frozen search index *data* to the binary file *f*."""
+    strings = []
+    string_ids = {}
+
+    def _intern_string(string):
+        if string is None:
+            return NO_STRING
+        try:
+            return string_ids[string]
+        except KeyError:
+            string_ids[string] = len(strings)
+            strings.append(string)
+            return string_ids[string]
+
+    ranked = 'doclengths' in data
+    docs = [(_intern_string(docname), _intern_string(filename), _intern_string(title))
+            for docname, filename, title
+            in zip(data['docnames'], data['filenames'], data['titles'])]
+
+    postings = bytearray()
+
+    def write_terms(terms, frequencies):
+        entries = []
+        # the postings are written in the order of the entries, so those of
+        # an entry end where those of the next one start
+        for key, word in sorted((word.encode('utf-8'), word) for word in terms):
+            docs = terms[word]
+            if frequencies:
+                # packed by sphinx.search.pack_postings already
+                numbers = docs
+                count = len(docs) // 2
+            else:
+                if isinstance(docs, integer_types):
+                    docs = [docs]
+                numbers = [docs[0]] + [b - a for a, b in zip(docs, docs[1:])]
+                count = len(docs)
+            entries.append((_intern_string(word), len(postings), count))
+            postings.extend(encode_varints(numbers))
+        return entries
+
+    terms = write_terms(data['terms'], ranked)
+    titleterms = write_terms(data['titleterms'], False)
+
+    meta = dict(envversion=data['envversion'], objects=data['objects'],
+                objtypes=sorted(iteritems(data['objtypes'])),
+                objnames=sorted(iteritems(data['objnames'])))
+    if ranked:
+        meta['doclengths'] = data['doclengths']
+        meta['ranking'] = data['ranking']
+    meta = jsonimpl.dumps(meta, sort_keys=True).encode('utf-8')
+
+    encoded = [string.encode('utf-8') for string in strings]
+    string_offsets = [0]
+    for string in encoded:
+        string_offsets.append(string_offsets[-1] + len(string))
+
+    offset = _header.size
+    strings_offset = offset
+    offset += 4 * len(string_offsets) + string_offsets[-1]
+    docs_offset = offset
+    offset += _entry.size * len(docs)
+    terms_offset = offset
+    offset += _entry.size * len(terms)
+    titleterms_offset = offset
+    offset += _entry.size * len(titleterms)
+    postings_offset = offset
+    meta_offset = offset + len(postings)
+
+    f.write(_header.pack(MAGIC, VERSION, ranked and FLAG_FREQUENCIES or 0,
+                         len(strings), strings_offset, len(docs), docs_offset,
+                         len(terms), terms_offset, len(titleterms), titleterms_offset,
+                         postings_offset, meta_offset, len(meta)))
+    f.write(struct.pack('<%dI' % len(string_offsets), *string_offsets))
+    f.write(b''.join(encoded))
+    for doc in docs:
+        f.write(_entry.pack(*doc))
+    for entries in (terms, titleterms):
+        for entry in entries:
+            f.write(_entry.pack(*entry))
+    f.write(bytes(postings))
+    f.write(meta)
+
+
+def load(f):
+    """Read the binary file *f* and return the frozen search index."""
+    return BinaryIndex(f.read()).freeze()
+
+
+class BinaryIndex(object):
+    """Gives access to a search index in the binary format, given as a byte
+    string or a memory map, without decoding more of it than needed.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        try:
+            header = _header.unpack_from(data, 0)
+        except struct.error:
+            raise ValueError('not a binary search index')
+        if header[0] != MAGIC or header[1] != VERSION:
+            raise ValueError('not a binary search index of version %d' % VERSION)
+        (flags, self._nstrings, self._strings, self._ndocs, self._docs,
+         self._nterms, self._terms, self._ntitleterms, self._titleterms,
+         self._postings, self._meta, self._metalength) = header[2:]
+        #: true if the postings of the terms hold term frequencies
+        self.frequencies = bool(flags & FLAG_FREQUENCIES)
+        self._string_data = self._strings + 4 * (self._nstrings + 1)
+        self._meta_cache = None
+
+    @classmethod
+    def open(cls, filename):
+        """Memory-map the index in the file *filename*."""
+        with open(filename, 'rb') as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def __len__(self):
+        return self._ndocs
+
+    def _get_bytes(self, number):
+        start, end = struct.unpack_from('<II', self.data, self._strings + 4 * number)
+        return self.data[self._string_data + start:self._string_data + end]
+
+    def get_string(self, number):
+        """Return the string *number* of the string table."""
+        if number == NO_STRING:
+            return None
+        return self._get_bytes(number).decode('utf-8')
+
+    def get_document(self, number):
+        """Return the document name, file name and title of the document
+        *number*.
+        """
+        ids = _entry.unpack_from(self.data, self._docs + _entry.size * number)
+        return tuple(self.get_string(string_id) for string_id in ids)
+
+    @property
+    def meta(self):
+        """The decoded metadata."""
+        if self._meta_cache is None:
+            meta = self.data[self._meta:self._meta + self._metalength]
+            self._meta_cache = jsonimpl.loads(meta.decode('utf-8'))
+        return self._meta_cache
+
+    def _find_entry(self, word, title):
+        key = word.encode('utf-8')
+        low, high = 0, title and self._ntitleterms or self._nterms
+        while low < high:
+            middle = (low + high) // 2
+            found = self._get_bytes(self._get_entry(title, middle)[0])
+            if found < key:
+                low = middle + 1
+            elif found > key:
+                high = middle
+            else:
+                return middle
+        return None
+
+    def _get_entry(self, title, number):
+        start = title and self._titleterms or self._terms
+        return _entry.unpack_from(self.data, start + _entry.size * number)
+
+    def _decode_postings(self, title, number):
+        entry = self._get_entry(title, number)
+        # the postings end where those of the next entry start
+        if number + 1 < (title and self._ntitleterms or self._nterms):
+            end = self._get_entry(title, number + 1)[1]
+        elif not title and self._ntitleterms:
+            end = self._get_entry(True, 0)[1]
+        else:
+            end = self._meta - self._postings
+        numbers = decode_varints(self.data[self._postings + entry[1]:self._postings + end])
+        frequencies = self.frequencies and not title
+        rv = {}
+        number = 0
+        if frequencies:
+            for i in range(0, len(numbers), 2):
+                number += numbers[i]
+                rv[number] = numbers[i + 1]
+        else:
+            for delta in numbers:
+                number += delta
+                rv[number] = 1
+        return rv
+
+    def find(self, word, title=False):
+        """Return a dict mapping the numbers of the documents that contain the
+        stemmed *word* (in a title, if *title* is true) to the frequency of
+        the word in them, or 1 if the index holds no frequencies.
+        """
+        number = self._find_entry(word, title)
+        if number is None:
+            return {}
+        return self._decode_postings(title, number)
+
+    def count(self, word, title=False):
+        """Return the number of documents that contain the stemmed *word*."""
+        number = self._find_entry(word, title)
+        if number is None:
+            return 0
+        return self._get_entry(title, number)[2]
+
+    def freeze(self):
+        """Decode the complete index into the data structure created by
+        :meth:`sphinx.search.IndexBuilder.freeze`.
+        """
+        from sphinx.search import pack_postings
+
+        docs = [self.get_document(i) for i in range(self._ndocs)]
+        meta = self.meta
+        frozen = dict(
+            docnames=tuple(doc[0] for doc in docs),
+            filenames=[doc[1] for doc in docs],
+            titles=tuple(doc[2] for doc in docs),
+            envversion=meta['envversion'],
+            objects=dict((prefix, dict((name, tuple(match))
+                                       for name, match in iteritems(objects)))
+                         for prefix, objects in iteritems(meta['objects'])),
+            objtypes=dict(meta['objtypes']),
+            objnames=dict((key, tuple(value)) for key, value in meta['objnames']),
+        )
+        for key, title in (('terms', False), ('titleterms', True)):
+            frequencies = self.frequencies and not title
+            terms = frozen[key] = {}
+            for number in range(title and self._ntitleterms or self._nterms):
+                word = self.get_string(self._get_entry(title, number)[0])
+                postings = self._decode_postings(title, number)
+                if frequencies:
+                    terms[word] = pack_postings(postings)
+                elif len(postings) == 1:
+                    terms[word], = postings
+                else:
+                    terms[word] = sorted(postings)
+        if self.frequencies:
+            frozen['doclengths'] = meta['doclengths']
+            frozen['ranking'] = meta['ranking']
+        return frozen
@@ -22,7 +22,7 @@ from os import path
 from codecs import BOM_UTF8
 from collections import deque
 
-from six import iteritems, text_type, binary_type
+from six import iteritems, text_type, binary_type, string_types
 from six.moves import range
 from six.moves.urllib.parse import urlsplit, urlunsplit, quote_plus, parse_qsl, urlencode
 from docutils.utils import relative_path
@@ -144,6 +144,126 @@ class FilenameUniqDict(dict):
         self._existing = state
 
 
+class DocnameIndexedDict(dict):
+    """
+    A dictionary whose values are docnames or tuples starting with a docname,
+    which keeps track of the keys of every docname.  Used for the object
+    tables of the domains, so that the entries of a document can be removed
+    or merged without looking at the entries of all other documents.
+
+    It also remembers the entries a document had before they were first
+    changed, so that :meth:`changed` can tell whether the table differs from
+    the state it had when it was created or last passed to :meth:`mark_saved`.
+    """
+    def __init__(self, *args, **kwds):
+        dict.__init__(self)
+        self._keys = {}  # docname -> set of keys
+        self._saved = {}  # docname -> entries before the first change
+        self.update(*args, **kwds)
+        self._saved.clear()
+
+    @staticmethod
+    def _docname(value):
+        if isinstance(value, string_types):
+            return value
+        return value[0]
+
+    def _entries(self, docname):
+        return dict((key, dict.__getitem__(self, key))
+                    for key in self._keys.get(docname, ()))
+
+    def _remember(self, docname):
+        if docname not in self._saved:
+            self._saved[docname] = self._entries(docname)
+
+    def _unindex(self, key, value):
+        docname = self._docname(value)
+        self._remember(docname)
+        keys = self._keys[docname]
+        keys.discard(key)
+        if not keys:
+            del self._keys[docname]
+
+    def __setitem__(self, key, value):
+        if key in self:
+            self._unindex(key, dict.__getitem__(self, key))
+        docname = self._docname(value)
+        self._remember(docname)
+        dict.__setitem__(self, key, value)
+        self._keys.setdefault(docname, set()).add(key)
+
+    def __delitem__(self, key):
+        self._unindex(key, dict.__getitem__(self, key))
+        dict.__delitem__(self, key)
+
+    def pop(self, key, *default):
+        if key not in self:
+            return dict.pop(self, key, *default)
+        value = dict.__getitem__(self, key)
+        del self[key]
+        return value
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self._unindex(key, value)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def update(self, *args, **kwds):
+        for key, value in iteritems(dict(*args, **kwds)):
+            self[key] = value
+
+    def clear(self):
+        for docname in self._keys:
+            self._remember(docname)
+        dict.clear(self)
+        self._keys.clear()
+
+    def copy(self):
+        return self.__class__(self)
+
+    def keys_of(self, docname):
+        """Return the keys of the entries of *docname*."""
+        return set(self._keys.get(docname, ()))
+
+    def purge_doc(self, docname):
+        self._remember(docname)
+        for key in self._keys.pop(docname, ()):
+            dict.__delitem__(self, key)
+
+    def merge_other(self, docnames, other):
+        if isinstance(other, DocnameIndexedDict):
+            for docname in docnames:
+                for key in other._keys.get(docname, ()):
+                    self[key] = other[key]
+        else:
+            for key, value in iteritems(other):
+                if self._docname(value) in docnames:
+                    self[key] = value
+
+    def changed(self):
+        """Return whether the entries of any document differ from the ones it
+        had when the table was created or last marked as saved.  Entries that
+        are removed and added back unchanged, as when a document is read
+        again, do not count.
+        """
+        for docname, entries in iteritems(self._saved):
+            if self._entries(docname) != entries:
+                return True
+        return False
+
+    def mark_saved(self):
+        """Forget the remembered entries; see :meth:`changed`."""
+        self._saved.clear()
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+
 def copy_static_entry(source, targetdir, builder, context={},
                       exclude_matchers=(), level=0):
     """[DEPRECATED] Copy a HTML builder static_path entry from source to targetdir.
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinx.util.cache
+    ~~~~~~~~~~~~~~~~~
+
+    In-memory caches.
+
+    :copyright: Copyright 2007-2017 by the Sphinx team, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """A cache that discards the least recently stored entries once the total
+    size of the cached values exceeds *maxsize*.
+
+    A cached value is handed out only once: :meth:`take` removes it from the
+    cache, so the caller may modify it freely.  The size of a value is given
+    to :meth:`put`, and defaults to its length.  The number of cache hits and
+    misses of :meth:`take` is counted in the ``hits`` and ``misses``
+    attributes.  The cached values are not pickled along with the cache.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # key -> (value, size)
+        self._data = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def take(self, key):
+        """Remove the value for *key* from the cache and return it, or return
+        None if it is not cached.
+        """
+        entry = self._data.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.size -= entry[1]
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, size=None):
+        """Cache *value* for *key*, evicting old entries as needed."""
+        self.discard(key)
+        if size is None:
+            size = len(value)
+        if size > self.maxsize:
+            return
+        self._data[key] = (value, size)
+        self.size += size
+        while self.size > self.maxsize:
+            _, (oldvalue, oldsize) = self._data.popitem(last=False)
+            self.size -= oldsize
+
+    def discard(self, key):
+        """Remove the value for *key* from the cache, if any."""
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def clear(self):
+        self._data.clear()
+        self.size = 0
+
+    def __getstate__(self):
+        return {'maxsize': self.maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(state['maxsize'])
@@ -6,13 +6,19 @@
     This module implements a simple JavaScript serializer.
     Uses the basestring encode function from simplejson by Bob Ippolito.
 
+    The output is a subset of JavaScript that is JSON except for dict keys,
+    which are bare words where possible, so the loader only quotes the bare
+    keys and leaves the rest to the :mod:`json` module.  Data that the json
+    module rejects is read by a slower tokenizer.
+
     :copyright: Copyright 2007-2017 by the Sphinx team, see AUTHORS.
     :license: BSD, see LICENSE for details.
 """
 
 import re
+import json
 
-from six import iteritems, integer_types, string_types
+from six import iteritems, integer_types, string_types, text_type
 
 from sphinx.util.pycompat import u
 
@@ -37,6 +43,10 @@ ESCAPED = re.compile(r'\\u.{4}|\\.')
 
 
 def encode_string(s):
+    if ESCAPE_ASCII.search(s) is None:
+        # nothing to escape
+        return '"' + str(s) + '"'
+
     def replace(match):
         s = match.group(0)
         try:
@@ -76,40 +86,124 @@ do   import   static   with
 double   in   super""".split())
 
 
-def dumps(obj, key=False):
-    if key:
-        if not isinstance(obj, string_types):
-            obj = str(obj)
-        if _nameonly_re.match(obj) and obj not in reswords:
-            return obj  # return it as a bare word
+_number_types = frozenset(integer_types + (float,))
+_string_types = frozenset(string_types + (text_type,))
+
+
+def _encode_key(key):
+    if not isinstance(key, string_types):
+        key = str(key)
+    if _nameonly_re.match(key) and key not in reswords:
+        return key  # a bare word
+    return encode_string(key)
+
+
+def _encode_items(obj):
+    """Return the encoded items of the dict *obj*, sorted by their encoding."""
+    items = []
+    append = items.append
+    match = _nameonly_re.match
+    for key, value in iteritems(obj):
+        # the keys are mostly strings that are valid bare words
+        if type(key) not in _string_types or not match(key) or key in reswords:
+            key = _encode_key(key)
+        if type(value) in _number_types:
+            append(key + ':' + str(value))
         else:
-            return encode_string(obj)
-    if obj is None:
+            append(key + ':' + _encode(value))
+    items.sort()
+    return items
+
+
+def _encode(obj):
+    cls = type(obj)
+    if cls in _string_types:
+        return encode_string(obj)
+    elif cls in _number_types:
+        return str(obj)
+    elif cls is list or cls is tuple:
+        if all(map(_number_types.__contains__, map(type, obj))):
+            # a list of numbers, like the documents of a search term
+            return '[' + ','.join(map(str, obj)) + ']'
+        return '[' + ','.join(map(_encode, obj)) + ']'
+    elif cls is dict:
+        return '{' + ','.join(_encode_items(obj)) + '}'
+    elif obj is None:
         return 'null'
     elif obj is True or obj is False:
         return obj and 'true' or 'false'
+    # subclasses of the types above
     elif isinstance(obj, integer_types + (float,)):
         return str(obj)
     elif isinstance(obj, dict):
-        return '{%s}' % ','.join(sorted('%s:%s' % (
-            dumps(key, True),
-            dumps(value)
-        ) for key, value in iteritems(obj)))
+        return _encode(dict(obj))
     elif isinstance(obj, set):
-        return '[%s]' % ','.join(sorted(dumps(x) for x in obj))
+        return '[%s]' % ','.join(sorted(map(_encode, obj)))
     elif isinstance(obj, (tuple, list)):
-        return '[%s]' % ','.join(dumps(x) for x in obj)
+        return '[%s]' % ','.join(map(_encode, obj))
     elif isinstance(obj, string_types):
         return encode_string(obj)
     raise TypeError(type(obj))
 
 
+def iterencode(obj):
+    """Encode *obj* piece by piece; the items of a dict or a list are yielded
+    one after the other, so the output need not be joined into one string.
+    """
+    if type(obj) is dict:
+        # the items are sorted by their encoding, so they must be encoded
+        # before the first one can be written
+        items = _encode_items(obj)
+    elif type(obj) is list or type(obj) is tuple:
+        items = map(_encode, obj)
+    else:
+        yield _encode(obj)
+        return
+    yield type(obj) is dict and '{' or '['
+    for i, item in enumerate(items):
+        if i:
+            yield ','
+        yield item
+    yield type(obj) is dict and '}' or ']'
+
+
+def dumps(obj, key=False):
+    if key:
+        return _encode_key(obj)
+    return _encode(obj)
+
+
 def dump(obj, f):
-    f.write(dumps(obj))
+    for chunk in iterencode(obj):
+        f.write(chunk)
+
+
+# a string or a bare word key that must be quoted for the json module
+_token_re = re.compile(r'"(?:[^"\\]|\\.)*"|(?<=[{,])([a-zA-Z_]\w*)(?=:)')
+
+
+def _quote_key(match):
+    key = match.group(1)
+    if key is None:
+        return match.group()
+    return '"' + key + '"'
 
 
 def loads(x):
     """Loader that can read the JS subset the indexer produces."""
+    try:
+        if '{' in x:
+            return json.loads(_token_re.sub(_quote_key, x))
+        return json.loads(x)
+    except ValueError:
+        # e.g. the closing brackets are missing
+        return _loads_tokens(x)
+
+
+def _loads_tokens(x):
+    """Loader that can read the JS subset the indexer produces, also if it is
+    truncated or followed by other data.
+    """
     nothing = object()
     i = 0
     n = len(x)
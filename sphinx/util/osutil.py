@@ -21,6 +21,7 @@ import filecmp
 from os import path
 import contextlib
 from io import BytesIO, StringIO
+from hashlib import md5
 
 from six import PY2, text_type
 
@@ -125,6 +126,12 @@ def mtimes_of_files(dirnames, suffix):
                         pass
 
 
+def file_digest(filename):
+    """Return a digest of the content of a file."""
+    with open(filename, 'rb') as f:
+        return md5(f.read()).hexdigest()
+
+
 def movefile(source, dest):
     """Move a file, removing the destination if it exists."""
     if os.path.exists(dest):
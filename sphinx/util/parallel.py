@@ -10,16 +10,25 @@
 """
 
 import os
+import sys
 import time
+import heapq
+import threading
 import traceback
 from math import sqrt
 
 try:
     import multiprocessing
+    try:
+        from multiprocessing import SimpleQueue
+    except ImportError:
+        # Python 2.7 only has it in multiprocessing.queues
+        from multiprocessing.queues import SimpleQueue
 except ImportError:
     multiprocessing = None
 
-from six import iteritems
+from six import iteritems, reraise
+from six.moves import queue
 
 from sphinx.errors import SphinxParallelError
 
@@ -28,18 +37,26 @@ parallel_available = multiprocessing and (os.name == 'posix')
 
 
 class SerialTasks(object):
-    """Has the same interface as ParallelTasks, but executes tasks directly."""
+    """Has the same interface as ParallelTasks, but executes tasks directly.
+
+    The *depends* and *process* arguments of :class:`ConcurrentTasks` are
+    accepted as well; tasks run in the order they are added, which always
+    satisfies the dependencies.
+    """
 
     def __init__(self, nproc=1):
-        pass
+        self._taskid = 0
 
-    def add_task(self, task_func, arg=None, result_func=None):
+    def add_task(self, task_func, arg=None, result_func=None, depends=None,
+                 process=False):
         if arg is not None:
             res = task_func(arg)
         else:
             res = task_func()
         if result_func:
             result_func(res)
+        self._taskid += 1
+        return self._taskid - 1
 
     def join(self):
         pass
@@ -100,18 +117,269 @@ class ParallelTasks(object):
                     raise SphinxParallelError(*result)
                 self._result_funcs.pop(tid)(self._args.pop(tid), result)
                 self._procs[tid].join()
+                self._precvs.pop(tid)
                 self._pworking -= 1
                 break
         else:
             time.sleep(0.02)
         while self._precvsWaiting and self._pworking < self.nproc:
-            newtid, newprecv = self._precvsWaiting.popitem()
+            # start waiting tasks in the order they were added
+            newtid = min(self._precvsWaiting)
+            newprecv = self._precvsWaiting.pop(newtid)
             self._precvs[newtid] = newprecv
             self._procs[newtid].start()
             self._pworking += 1
 
 
-def make_chunks(arguments, nproc, maxbatch=10):
+class ParallelPool(object):
+    """Executes tasks in a pool of *nproc* long-lived worker processes.
+
+    In contrast to :class:`ParallelTasks`, which forks one process per task,
+    the workers are forked once, when the first task is added, and then pull
+    the arguments of all following tasks from a shared queue.  Only arguments
+    and results travel through the queues; the task function is inherited by
+    forking, so it need not be picklable, but it must be the same for all
+    tasks added to one pool.  State a worker keeps between two tasks is
+    preserved.
+    """
+
+    def __init__(self, nproc):
+        self.nproc = nproc
+        # the function performed by all tasks; set by the first add_task()
+        self._task_func = None
+        # (optional) function performed by each task on the result of main task
+        self._result_funcs = {}
+        # task arguments
+        self._args = {}
+        # list of worker processes
+        self._procs = []
+        # queues for task arguments and task results
+        self._taskq = None
+        self._resultq = None
+        # task number of the next task
+        self._taskid = 0
+
+    def _worker(self):
+        while True:
+            task = self._taskq.get()
+            if task is None:
+                break
+            tid, arg = task
+            try:
+                if arg is None:
+                    ret = self._task_func()
+                else:
+                    ret = self._task_func(arg)
+                self._resultq.put((tid, False, ret))
+            except BaseException as err:
+                errmsg = traceback.format_exception_only(err.__class__, err)[0].strip()
+                self._resultq.put((tid, True, (errmsg, traceback.format_exc())))
+
+    def _start(self, task_func):
+        self._task_func = task_func
+        self._taskq = multiprocessing.Queue()
+        # results are pickled right away by a SimpleQueue, so the worker may
+        # modify its state again as soon as a task has returned
+        self._resultq = SimpleQueue()
+        for i in range(self.nproc):
+            proc = multiprocessing.Process(target=self._worker)
+            proc.daemon = True
+            proc.start()
+            self._procs.append(proc)
+
+    def add_task(self, task_func, arg=None, result_func=None):
+        if self._task_func is None:
+            self._start(task_func)
+        elif task_func is not self._task_func:
+            raise ValueError('all tasks of a ParallelPool must use the same function')
+        tid = self._taskid
+        self._taskid += 1
+        self._result_funcs[tid] = result_func or (lambda arg, result: None)
+        self._args[tid] = arg
+        self._taskq.put((tid, arg))
+        # handle results that have already arrived
+        while self._result_funcs and not self._resultq.empty():
+            self._join_one()
+
+    def join(self):
+        try:
+            while self._result_funcs:
+                self._join_one()
+        finally:
+            self._shutdown()
+
+    def _join_one(self):
+        # a worker that dies, e.g. when it is killed, never sends a result for
+        # its task, so the workers are checked while waiting for one
+        while not self._resultq._reader.poll(0.1):
+            for proc in self._procs:
+                if not proc.is_alive():
+                    self._shutdown(terminate=True)
+                    raise SphinxParallelError(
+                        'worker process died with exit code %s' % proc.exitcode, '')
+        tid, exc, result = self._resultq.get()
+        if exc:
+            self._shutdown(terminate=True)
+            raise SphinxParallelError(*result)
+        self._result_funcs.pop(tid)(self._args.pop(tid), result)
+
+    def _shutdown(self, terminate=False):
+        for proc in self._procs:
+            if terminate:
+                proc.terminate()
+            else:
+                self._taskq.put(None)
+        for proc in self._procs:
+            proc.join()
+        self._procs = []
+        self._result_funcs.clear()
+        self._args.clear()
+
+
+class ConcurrentTasks(object):
+    """Executes up to *nproc* tasks at the same time, either in a thread or,
+    for CPU bound tasks, in a forked process.
+
+    :meth:`add_task` returns an id for the task, which can be given in the
+    *depends* argument of later tasks: a task only starts when all tasks it
+    depends on have finished.  If *depends* is not given, the task depends on
+    all tasks added before it, so code that relies on the tasks being run in
+    order keeps working.
+
+    Tasks only start in :meth:`join`, which waits until all tasks added so
+    far have finished and can be called several times.  Tasks with *process*
+    set run in a forked process; their return value is sent back to the main
+    process, but any other change of state in the process is lost.  To make
+    forking safe, a process is only forked while no thread is running.
+
+    If *thread_context* is given, it is called to get a context manager that
+    each thread task runs in, e.g. :meth:`.Sphinx.buffered_output` to keep the
+    console output of the threads apart.
+    """
+
+    def __init__(self, nproc, thread_context=None):
+        self.nproc = nproc
+        self.thread_context = thread_context
+        # task id -> (task_func, arg, result_func, depends, process)
+        self._tasks = {}
+        # ids of the tasks that have not yet been started, in order
+        self._waiting = []
+        # ids of the finished tasks
+        self._done = set()
+        # task id -> thread of the running thread tasks
+        self._threads = {}
+        # task id -> (process, receiving pipe) of the running process tasks
+        self._procs = {}
+        # results of the thread tasks: (task id, exc_info, result)
+        self._thread_results = queue.Queue()
+        self._taskid = 0
+
+    def add_task(self, task_func, arg=None, result_func=None, depends=None,
+                 process=False):
+        tid = self._taskid
+        self._taskid += 1
+        if depends is None:
+            depends = range(tid)
+        depends = set(depends) - self._done
+        if process and not parallel_available:
+            process = False
+        self._tasks[tid] = (task_func, arg, result_func, depends, process)
+        self._waiting.append(tid)
+        return tid
+
+    def join(self):
+        try:
+            while self._waiting or self._threads or self._procs:
+                self._start_ready()
+                self._join_one()
+        except BaseException:
+            # do not leave forked processes behind
+            for proc, _ in self._procs.values():
+                proc.terminate()
+            raise
+
+    def _call(self, tid):
+        task_func, arg = self._tasks[tid][:2]
+        if arg is None:
+            return task_func()
+        return task_func(arg)
+
+    def _thread(self, tid):
+        try:
+            if self.thread_context is None:
+                result = self._call(tid)
+            else:
+                with self.thread_context():
+                    result = self._call(tid)
+            self._thread_results.put((tid, None, result))
+        except BaseException:
+            self._thread_results.put((tid, sys.exc_info(), None))
+
+    def _process(self, pipe, tid):
+        try:
+            pipe.send((False, self._call(tid)))
+        except BaseException as err:
+            errmsg = traceback.format_exception_only(err.__class__, err)[0].strip()
+            pipe.send((True, (errmsg, traceback.format_exc())))
+
+    def _start_ready(self):
+        # fork the processes first, while there may be no thread running yet
+        waiting = sorted(self._waiting, key=lambda tid: not self._tasks[tid][4])
+        for tid in waiting:
+            if len(self._threads) + len(self._procs) >= self.nproc:
+                break
+            depends, process = self._tasks[tid][3:]
+            if not depends <= self._done:
+                continue
+            if process:
+                if self._threads:
+                    continue
+                precv, psend = multiprocessing.Pipe(False)
+                proc = multiprocessing.Process(target=self._process,
+                                               args=(psend, tid))
+                proc.start()
+                self._procs[tid] = (proc, precv)
+            else:
+                thread = threading.Thread(target=self._thread, args=(tid,))
+                thread.daemon = True
+                thread.start()
+                self._threads[tid] = thread
+            self._waiting.remove(tid)
+
+    def _join_one(self):
+        try:
+            tid, exc_info, result = self._thread_results.get_nowait()
+        except queue.Empty:
+            for tid, (proc, pipe) in iteritems(self._procs):
+                if pipe.poll():
+                    exc, result = pipe.recv()
+                    proc.join()
+                    del self._procs[tid]
+                    if exc:
+                        raise SphinxParallelError(*result)
+                    break
+            else:
+                time.sleep(0.02)
+                return
+        else:
+            self._threads.pop(tid).join()
+            if exc_info:
+                reraise(*exc_info)
+        self._done.add(tid)
+        task_func, arg, result_func = self._tasks.pop(tid)[:3]
+        if result_func:
+            result_func(arg, result)
+
+
+def make_chunks(arguments, nproc, maxbatch=10, costs=None):
+    """Partition *arguments* into chunks that are processed by one task each.
+
+    If *costs* is given, it maps arguments to their estimated cost (e.g. the
+    time it took to process them the last time).  The chunks are then
+    balanced by cost instead of by count, and returned largest first, so
+    that the expensive chunks start early and idle workers pick up the
+    cheap ones at the end.
+    """
     # determine how many documents to read in one go
     nargs = len(arguments)
     chunksize = nargs // nproc
@@ -123,5 +391,26 @@ def make_chunks(arguments, nproc, maxbatch=10):
     nchunks, rest = divmod(nargs, chunksize)
     if rest:
         nchunks += 1
+    if costs:
+        known = [costs[arg] for arg in arguments if costs.get(arg) is not None]
+        if known:
+            return _balance_chunks(arguments, nchunks, costs,
+                                   sum(known) / len(known))
     # partition documents in "chunks" that will be written by one Process
     return [arguments[i * chunksize:(i + 1) * chunksize] for i in range(nchunks)]
+
+
+def _balance_chunks(arguments, nchunks, costs, default_cost):
+    def cost(arg):
+        value = costs.get(arg)
+        return default_cost if value is None else value
+
+    # largest-first greedy partitioning: every argument goes into the chunk
+    # with the lowest total cost so far
+    heap = [(0, i, []) for i in range(nchunks)]
+    for arg in sorted(arguments, key=cost, reverse=True):
+        total, i, chunk = heapq.heappop(heap)
+        chunk.append(arg)
+        heapq.heappush(heap, (total + cost(arg), i, chunk))
+    heap.sort(key=lambda item: (-item[0], item[1]))
+    return [chunk for _, _, chunk in heap if chunk]
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinx.util.profiling
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Timing of the phases of a build.
+
+    :copyright: Copyright 2007-2017 by the Sphinx team, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+from six import iteritems
+
+
+def get_callable_name(func):
+    """Return a dotted name for the function or callable object *func*."""
+    name = getattr(func, '__qualname__', None) or getattr(func, '__name__', None)
+    if name is None:
+        # a callable object
+        func = func.__class__
+        name = getattr(func, '__qualname__', func.__name__)
+    module = getattr(func, '__module__', None)
+    if module:
+        return '%s.%s' % (module, name)
+    return name
+
+
+class BuildProfiler(object):
+    """Records how long the phases of a build, the documents, the event
+    handlers, the items of the status iterator loops and the finishing tasks
+    take.
+
+    Work done in the processes of a parallel build, like the event handlers
+    called while reading documents in parallel, is only recorded as part of
+    the time of its document or task.  Timings may be added from several
+    threads, e.g. by the event handlers called in concurrent finishing tasks.
+    """
+
+    def __init__(self):
+        self.starttime = time.time()
+        self.phases = {}     # phase -> seconds
+        self.documents = {}  # docname -> {phase: seconds}
+        self.handlers = {}   # (event, handler name) -> [calls, seconds]
+        self.loops = {}      # summary -> [items, seconds, slowest item, its seconds]
+        self.tasks = {}      # task name -> [calls, seconds]
+        # guards the updates of the entries
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """Add the time the block takes to the phase *name*.  Phases may be
+        nested; the time of the inner phase is part of the outer one.
+        """
+        starttime = time.time()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.time() - starttime)
+
+    def add_phase(self, name, duration):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0) + duration
+
+    def add_documents(self, phase, docnames, durations):
+        """Record the *durations* (a dict docname -> seconds) of *docnames*
+        in *phase*.
+        """
+        with self.lock:
+            for docname in docnames:
+                if docname in durations:
+                    self.documents.setdefault(docname, {})[phase] = durations[docname]
+
+    def add_handler(self, event, callback, duration):
+        key = (event, get_callable_name(callback))
+        with self.lock:
+            entry = self.handlers.get(key)
+            if entry is None:
+                entry = self.handlers[key] = [0, 0]
+            entry[0] += 1
+            entry[1] += duration
+
+    def add_loop_item(self, summary, item, duration):
+        with self.lock:
+            entry = self.loops.get(summary)
+            if entry is None:
+                entry = self.loops[summary] = [0, 0, None, 0]
+            entry[0] += 1
+            entry[1] += duration
+            if duration > entry[3]:
+                entry[2] = item
+                entry[3] = duration
+
+    def add_task(self, name, duration):
+        with self.lock:
+            entry = self.tasks.get(name)
+            if entry is None:
+                entry = self.tasks[name] = [0, 0]
+            entry[0] += 1
+            entry[1] += duration
+
+    def timed_iterator(self, iterable, summary, stringify_func):
+        """Yield the items of *iterable* and record the time until the next
+        item is requested, i.e. the time spent processing each item.
+        """
+        summary = summary.strip()
+        for item in iterable:
+            starttime = time.time()
+            yield item
+            self.add_loop_item(summary, stringify_func(item),
+                               time.time() - starttime)
+
+    def wrap_tasks(self, tasks):
+        """Return a wrapper of the task executor *tasks* that records the
+        time of every task.
+        """
+        return TimedTasks(tasks, self)
+
+    def get_report(self):
+        """Return a copy of the timings as a JSON-serializable dict."""
+        with self.lock:
+            return {
+                'total': time.time() - self.starttime,
+                'phases': dict(self.phases),
+                'documents': dict((docname, dict(durations))
+                                  for docname, durations in iteritems(self.documents)),
+                'handlers': [
+                    {'event': event, 'handler': name, 'calls': calls, 'time': duration}
+                    for (event, name), (calls, duration) in iteritems(self.handlers)],
+                'loops': [
+                    {'summary': summary, 'items': items, 'time': duration,
+                     'slowest': slowest, 'slowest_time': slowest_duration}
+                    for summary, (items, duration, slowest, slowest_duration)
+                    in iteritems(self.loops)],
+                'tasks': [
+                    {'task': name, 'calls': calls, 'time': duration}
+                    for name, (calls, duration) in iteritems(self.tasks)],
+            }
+
+    def dump(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.get_report(), f, indent=1, sort_keys=True)
+
+    def summary(self, count=10):
+        """Return the lines of a summary with the *count* slowest entries of
+        every kind.
+        """
+        report = self.get_report()
+        lines = ['total: %.3fs' % report['total']]
+
+        def section(title, rows):
+            rows = sorted(rows, key=lambda row: -row[1])[:count]
+            if rows:
+                lines.append(title)
+                for name, duration in rows:
+                    lines.append('  %8.3fs  %s' % (duration, name))
+        section('phases:', iteritems(report['phases']))
+        section('documents:', [(docname, sum(durations.values()))
+                               for docname, durations in iteritems(report['documents'])])
+        section('event handlers:', [('%(handler)s (%(event)s, %(calls)d calls)' % entry,
+                                     entry['time']) for entry in report['handlers']])
+        section('tasks:', [('%(task)s (%(calls)d calls)' % entry, entry['time'])
+                           for entry in report['tasks']])
+        return lines
+
+
+class TimedTasks(object):
+    """Wraps a task executor of :mod:`sphinx.util.parallel` and records the
+    time of every task with a :class:`BuildProfiler`.
+
+    The time is measured where the task runs and sent back along with its
+    result, so tasks that run in a forked process are recorded as well.
+    """
+
+    def __init__(self, tasks, profiler):
+        self.tasks = tasks
+        self.profiler = profiler
+
+    def add_task(self, task_func, arg=None, result_func=None, **kwds):
+        name = get_callable_name(task_func)
+
+        def timed_func(*args):
+            starttime = time.time()
+            result = task_func(*args)
+            return time.time() - starttime, result
+
+        def record(*args):
+            # the executors call result_func with (arg, result) or (result)
+            duration, result = args[-1]
+            self.profiler.add_task(name, duration)
+            if result_func:
+                result_func(*(args[:-1] + (result,)))
+        return self.tasks.add_task(timed_func, arg, record, **kwds)
+
+    def join(self):
+        self.tasks.join()
+
+
+@contextmanager
+def profile_phase(profiler, name):
+    """Add the time the block takes to the phase *name* of *profiler*, unless
+    *profiler* is None.
+    """
+    if profiler is None:
+        yield
+        return
+    with profiler.phase(name):
+        yield
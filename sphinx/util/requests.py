@@ -122,27 +122,46 @@ def _get_tls_cacert(url, config):
         return certs.get(hostname, True)
 
 
+def create_session(pool_connections=10, pool_maxsize=10):
+    """Create a session that can be passed to :func:`get` and :func:`head`.
+
+    The session keeps the connections alive and reuses them for later
+    requests: up to *pool_maxsize* connections for each of the last
+    *pool_connections* hosts.  It can be shared by several threads.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections,
+                                            pool_maxsize=pool_maxsize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
 def get(url, **kwargs):
     """Sends a GET request like requests.get().
 
-    This sets up User-Agent header and TLS verification automatically."""
+    This sets up User-Agent header and TLS verification automatically.
+    The request is sent with the *session* keyword argument, if given."""
     kwargs.setdefault('headers', dict(useragent_header))
     config = kwargs.pop('config', None)
     if config:
         kwargs.setdefault('verify', _get_tls_cacert(url, config))
+    session = kwargs.pop('session', None) or requests
 
     with ignore_insecure_warning(**kwargs):
-        return requests.get(url, **kwargs)
+        return session.get(url, **kwargs)
 
 
 def head(url, **kwargs):
     """Sends a HEAD request like requests.head().
 
-    This sets up User-Agent header and TLS verification automatically."""
+    This sets up User-Agent header and TLS verification automatically.
+    The request is sent with the *session* keyword argument, if given."""
     kwargs.setdefault('headers', dict(useragent_header))
     config = kwargs.pop('config', None)
     if config:
         kwargs.setdefault('verify', _get_tls_cacert(url, config))
+    session = kwargs.pop('session', None) or requests
 
     with ignore_insecure_warning(**kwargs):
-        return requests.get(url, **kwargs)
+        return session.head(url, **kwargs)
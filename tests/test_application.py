@@ -9,11 +9,15 @@
     :license: BSD, see LICENSE for details.
 """
 import codecs
+import pickle
+import threading
 
 from docutils import nodes
 
 from sphinx.application import ExtensionError
 from sphinx.domains import Domain
+from sphinx.environment.storage import MAGIC, DoctreeStorage, doctree_storages
+from sphinx.util.parallel import ConcurrentTasks
 
 from util import strip_escseq
 import pytest
@@ -68,6 +72,29 @@ def test_output(app, status, warning):
     assert app._warncount == old_count + 1
 
 
+def test_buffered_output(app, status, warning):
+    started = [threading.Event(), threading.Event()]
+
+    def task(i):
+        app.info('task %d: first' % i)
+        started[i].set()
+        # the other task writes its first message in the meantime
+        assert started[1 - i].wait(10)
+        app.info('task %d: second' % i)
+
+    status.truncate(0)
+    status.seek(0)
+    tasks = ConcurrentTasks(2, thread_context=app.buffered_output)
+    tasks.add_task(task, 0, depends=())
+    tasks.add_task(task, 1, depends=())
+    tasks.join()
+    # the messages of each task are written together
+    lines = status.getvalue().splitlines()
+    assert sorted([lines[:2], lines[2:]]) == [['task 0: first', 'task 0: second'],
+                                              ['task 1: first', 'task 1: second']]
+    assert getattr(app._output_buffer, 'messages', None) is None
+
+
 def test_output_with_unencodable_char(app, status, warning):
 
     class StreamWriter(codecs.StreamWriter):
@@ -116,6 +143,31 @@ def test_domain_override(app, status, warning):
     assert 'new domain not a subclass of registered foo domain' in str(excinfo.value)
 
 
+class OtherStorage(DoctreeStorage):
+    name = 'other'
+
+    def encode(self, doctree):
+        return pickle.dumps(doctree, pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data):
+        return pickle.loads(data)
+
+
+@pytest.mark.sphinx('dummy', testroot='basic')
+def test_add_doctree_storage(app, status, warning):
+    app.add_doctree_storage(OtherStorage)
+    assert app.doctree_storages['other'] is OtherStorage
+    # other applications do not see the storage
+    assert 'other' not in doctree_storages
+
+    app.config.doctree_storage = 'other'
+    app.builder.build_all()
+    with open(app.doctreedir / 'index.doctree', 'rb') as fp:
+        assert fp.read().startswith(MAGIC + b'other')
+    app.env.doctree_cache.clear()
+    assert app.env.get_doctree('index').traverse(nodes.section)
+
+
 @pytest.mark.sphinx(testroot='add_source_parser')
 def test_add_source_parser(app, status, warning):
     assert set(app.config.source_suffix) == set(['.rst', '.md', '.test'])
@@ -9,6 +9,8 @@
     :license: BSD, see LICENSE for details.
 """
 
+import os
+import time
 import pickle
 from docutils import nodes
 import mock
@@ -78,6 +80,37 @@ def test_master_doc_not_found(tempdir, make_app):
         app.builder.build_all()
 
 
+def test_content_digests(tempdir, make_app):
+    (tempdir / 'conf.py').write_text('content_digests = True\n')
+    (tempdir / 'contents.rst').write_text('Title\n=====\n\n.. include:: inc.txt\n')
+    (tempdir / 'inc.txt').write_text('included text\n')
+
+    app = make_app('text', srcdir=tempdir)
+    app.builder.build_all()
+    assert set(app.env.file_digests['contents']) == set(['contents.rst', 'inc.txt'])
+
+    def touch(filename):
+        mtime = time.time() + 10
+        os.utime(tempdir / filename, (mtime, mtime))
+
+    # new modification times alone do not make the document outdated
+    touch('contents.rst')
+    touch('inc.txt')
+    assert app.env.get_outdated_files(False) == (set(), set(), set())
+    assert list(app.builder.get_outdated_docs()) == []
+
+    # the content is only checked again when the modification times change
+    with mock.patch('sphinx.environment.file_digest') as file_digest:
+        assert app.env.get_outdated_files(False) == (set(), set(), set())
+        assert list(app.builder.get_outdated_docs()) == []
+    assert not file_digest.called
+
+    # but a changed dependency does
+    (tempdir / 'inc.txt').write_text('changed text\n')
+    touch('inc.txt')
+    assert app.env.get_outdated_files(False) == (set(), set(['contents']), set())
+
+
 @pytest.mark.sphinx(buildername='text', testroot='circular')
 def test_circular_toctree(app, status, warning):
     app.builder.build_all()
@@ -10,7 +10,14 @@
 """
 from __future__ import print_function
 
+import threading
+import time
+
 import pytest
+from six.moves import BaseHTTPServer, socketserver
+
+from sphinx.builders.linkcheck import HostQueue, check_anchor, collect_anchors
+from sphinx.deprecation import RemovedInSphinx17Warning
 
 
 @pytest.mark.sphinx('linkcheck', testroot='linkcheck', freshenv=True)
@@ -37,3 +44,207 @@ def test_anchors_ignored(app, status, warning):
 
     # expect all ok when excluding #top
     assert not content
+
+
+ANCHORS_PAGE = ('<html><body><h1 id="top">Title</h1><a name="anchor">text</a>' +
+                ''.join('<p id="p%d">%d</p>' % (i, i) for i in range(1000)) +
+                '</body></html>').encode('utf-8')
+
+
+class LinkServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Answers every request after a short delay, with 404 for the paths
+    starting with ``/broken``.  The first request for a path in ``drop`` is
+    answered by closing the connection.  Records the paths, the highest
+    number of requests handled at the same time and the connections.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), LinkHandler)
+        self.lock = threading.Lock()
+        self.paths = []
+        self.running = self.max_running = 0
+        self.connections = set()
+        self.drop = set()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+
+class LinkHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        server = self.server
+        with server.lock:
+            server.paths.append(self.path)
+            server.connections.add(self.client_address)
+            server.running += 1
+            server.max_running = max(server.max_running, server.running)
+        time.sleep(0.05)
+        with server.lock:
+            server.running -= 1
+            if self.path in server.drop:
+                server.drop.discard(self.path)
+                self.close_connection = True
+                return
+        body = b''
+        if self.path.startswith('/anchors') and self.command == 'GET':
+            body = ANCHORS_PAGE
+        self.send_response(self.path.startswith('/broken') and 404 or 200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_HEAD
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def link_server():
+    server = LinkServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_host_limits(tempdir, make_app, link_server):
+    srcdir = tempdir / 'linkcheck-limits'
+    srcdir.makedirs()
+    (srcdir / 'conf.py').write_text('linkcheck_workers = 10\n'
+                                    'linkcheck_host_workers = 2\n')
+    links = ['* `link %d <%spage%d>`_' % (i, link_server.url, i) for i in range(20)]
+    # a link that is checked once only
+    links.append('* `again <%spage0>`_' % link_server.url)
+    (srcdir / 'contents.rst').write_text('\n'.join(links) + '\n')
+
+    app = make_app('linkcheck', srcdir=srcdir)
+    app.builder.build_all()
+    assert (app.outdir / 'output.txt').text() == ''
+    assert app.statuscode == 0
+    assert len(link_server.paths) == 20
+    assert link_server.max_running == 2
+    # the connections are kept alive and reused
+    assert len(link_server.connections) <= 2
+
+
+def test_result_cache(tempdir, make_app, link_server):
+    srcdir = tempdir / 'linkcheck-cache'
+    srcdir.makedirs()
+    (srcdir / 'conf.py').write_text('linkcheck_working_ttl = 3600\n'
+                                    'linkcheck_broken_ttl = 3600\n')
+    (srcdir / 'contents.rst').write_text('.. toctree::\n\n   other\n\n'
+                                         '`good <%spage>`_ `broken <%sbroken>`_\n'
+                                         % (link_server.url, link_server.url))
+    (srcdir / 'other.rst').write_text('Other\n=====\n\n`good <%sother>`_\n'
+                                      % link_server.url)
+
+    app = make_app('linkcheck', srcdir=srcdir)
+    app.builder.build_all()
+    output = (app.outdir / 'output.txt').text()
+    assert 'contents.rst:5: [broken] %sbroken: 404' % link_server.url in output
+    assert len(output.splitlines()) == 1
+    assert sorted(set(link_server.paths)) == ['/broken', '/other', '/page']
+
+    # the results are kept for the next builds
+    del link_server.paths[:]
+    app = make_app('linkcheck', srcdir=srcdir)
+    app.builder.build_all()
+    assert link_server.paths == []
+    assert (app.outdir / 'output.txt').text() == output
+    assert app.statuscode == 1
+
+    # only the documents with expired results are checked again, the others
+    # are reported from the cache
+    app = make_app('linkcheck', srcdir=srcdir,
+                   confoverrides={'linkcheck_incremental': True, 'linkcheck_broken_ttl': 0})
+    assert app.builder.get_outdated_docs() == ['contents']
+    app.builder.build_update()
+    assert set(link_server.paths) == set(['/broken'])
+    assert (app.outdir / 'output.txt').text() == output
+    assert app.statuscode == 1
+
+
+def test_anchors_per_page(tempdir, make_app, link_server):
+    srcdir = tempdir / 'linkcheck-anchors'
+    srcdir.makedirs()
+    (srcdir / 'conf.py').write_text('linkcheck_workers = 10\n')
+    links = ['* `p%d <%sanchors#p%d>`_' % (i, link_server.url, i) for i in range(0, 1000, 50)]
+    links.append('* `top <%sanchors#top>`_' % link_server.url)
+    links.append('* `anchor <%sanchors#anchor>`_' % link_server.url)
+    links.append('* `missing <%sanchors#missing>`_' % link_server.url)
+    (srcdir / 'contents.rst').write_text('\n'.join(links) + '\n')
+
+    app = make_app('linkcheck', srcdir=srcdir)
+    app.builder.build_all()
+    # the page is downloaded once for all anchors
+    assert link_server.paths == ['/anchors']
+    content = (app.outdir / 'output.txt').text()
+    assert "Anchor 'missing' not found" in content
+    assert len(content.splitlines()) == 1
+    # only the anchors of the page are kept, not the response
+    url, code, anchors = app.builder.anchor_pages[link_server.url + 'anchors']
+    assert url == link_server.url + 'anchors' and code == 0
+    assert 'top' in anchors and 'p999' in anchors
+
+
+def test_anchor_page_retries(tempdir, make_app, link_server):
+    srcdir = tempdir / 'linkcheck-anchor-retries'
+    srcdir.makedirs()
+    (srcdir / 'conf.py').write_text('linkcheck_retries = 2\n')
+    (srcdir / 'contents.rst').write_text('* `p0 <%sanchors#p0>`_\n'
+                                         '* `p50 <%sanchors#p50>`_\n'
+                                         % (link_server.url, link_server.url))
+    link_server.drop.add('/anchors')
+
+    app = make_app('linkcheck', srcdir=srcdir)
+    app.builder.build_all()
+    # the failed download is not shared, the retry fetches the page again
+    assert link_server.paths == ['/anchors', '/anchors']
+    assert (app.outdir / 'output.txt').text() == ''
+    assert app.statuscode == 0
+
+
+class FakeResponse(object):
+    def iter_content(self, chunk_size, decode_unicode):
+        page = ANCHORS_PAGE.decode('utf-8')
+        for i in range(0, len(page), chunk_size):
+            yield page[i:i + chunk_size]
+
+
+def test_collect_anchors():
+    anchors = collect_anchors(FakeResponse())
+    assert set(['top', 'anchor', 'p0', 'p999']) <= anchors
+    assert 'missing' not in anchors
+
+    with pytest.warns(RemovedInSphinx17Warning):
+        assert check_anchor(FakeResponse(), 'p500')
+    with pytest.warns(RemovedInSphinx17Warning):
+        assert not check_anchor(FakeResponse(), 'missing')
+
+
+def test_host_queue():
+    hostqueue = HostQueue(1, rate=10)
+    for item in ('a1', 'a2'):
+        hostqueue.put('a', item)
+    hostqueue.put('b', 'b1')
+
+    assert hostqueue.get() == ('a', 'a1')
+    # the second link of a waits until the first one has been checked
+    assert hostqueue.get() == ('b', 'b1')
+    hostqueue.task_done('a')
+    start = time.time()
+    assert hostqueue.get() == ('a', 'a2')
+    # ... and a tenth of a second after it has been started
+    assert time.time() - start > 0.05
+
+    closer = threading.Timer(0.05, hostqueue.close)
+    closer.start()
+    assert hostqueue.get() == (None, None)
@@ -169,3 +169,32 @@ def test_domain_py_find_obj(app, status, warning):
             [(u'NestedParentA.NestedChildA.subchild_1', (u'roles', u'method'))])
     assert (find_obj(None, u'NestedParentA.NestedChildA', u'subchild_1', u'meth') ==
             [(u'NestedParentA.NestedChildA.subchild_1', (u'roles', u'method'))])
+
+
+@pytest.mark.sphinx('dummy', testroot='domain-py')
+def test_domain_py_find_obj_fuzzy(app, status, warning):
+
+    def find_obj(name, obj_type):
+        return app.env.domains['py'].find_obj(
+            app.env, None, None, name, obj_type, 1)
+
+    app.builder.build_all()
+
+    assert (find_obj(u'subchild_1', u'meth') ==
+            [(u'NestedParentA.NestedChildA.subchild_1', (u'roles', u'method'))])
+    assert (find_obj(u'NestedChildA.subchild_2', u'meth') ==
+            [(u'NestedParentA.NestedChildA.subchild_2', (u'roles', u'method'))])
+    # several matches are returned in a fixed order
+    assert (find_obj(u'ModTopLevel', u'class') ==
+            [(u'module_a.submodule.ModTopLevel', (u'module', u'class')),
+             (u'module_b.submodule.ModTopLevel', (u'module', u'class'))])
+    assert find_obj(u'ModTopLevel', u'meth') == []
+
+    # the index follows changes of the objects
+    objects = app.env.domains['py'].data['objects']
+    objects['module_c.subchild_1'] = ('other', 'method')
+    assert len(find_obj(u'subchild_1', u'meth')) == 2
+    app.env.domains['py'].clear_doc('other')
+    del objects['NestedParentA.NestedChildA.subchild_2']
+    assert len(find_obj(u'subchild_1', u'meth')) == 1
+    assert find_obj(u'subchild_2', u'meth') == []
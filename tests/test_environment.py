@@ -9,10 +9,18 @@
     :license: BSD, see LICENSE for details.
 """
 
+import os
+
+import pytest
 from util import SphinxTestApp, path
 
 from sphinx.builders.html import StandaloneHTMLBuilder
+from sphinx.environment import BuildEnvironment
+from sphinx.environment.shards import DOC_BUCKETS, doc_bucket
 from sphinx.builders.latex import LaTeXBuilder
+from sphinx.domains import Domain
+from sphinx.domains.python import PythonDomain
+from sphinx.util.parallel import parallel_available
 
 app = env = None
 warnings = []
@@ -42,6 +50,8 @@ def warning_emitted(file, text):
 def test_first_update():
     updated = env.update(app.config, app.srcdir, app.doctreedir, app)
     assert set(updated) == env.found_docs == set(env.all_docs)
+    # the reading time of every document is recorded
+    assert set(env.read_durations) == env.found_docs
     # test if exclude_patterns works ok
     assert 'subdir/excluded' not in env.found_docs
 
@@ -107,6 +117,24 @@ def test_env_read_docs():
     assert len(read_docnames) == 2
 
 
+def test_doctree_cache():
+    env.doctree_cache.clear()
+    hits, misses = env.doctree_cache.hits, env.doctree_cache.misses
+    doctree = env.get_doctree('images')
+    # a doctree that has just been read is handed out once ...
+    env.doctree_cache.put('images', doctree, 1)
+    assert env.get_doctree('images') is doctree
+    assert 'images' not in env.doctree_cache
+    # ... and loaded again afterwards, since it may have been modified
+    assert env.get_doctree('images') is not doctree
+    assert env.doctree_cache.hits == hits + 1
+    assert env.doctree_cache.misses == misses + 2
+    # the cached doctree is dropped when the document is read again
+    env.doctree_cache.put('images', doctree, 1)
+    env.clear_doc('images')
+    assert 'images' not in env.doctree_cache
+
+
 def test_object_inventory():
     refs = env.domaindata['py']['objects']
 
@@ -130,3 +158,102 @@ def test_object_inventory():
 
     assert env.domains['py'].data is env.domaindata['py']
     assert env.domains['c'].data is env.domaindata['c']
+
+
+def test_pickle_shards():
+    filename = app.doctreedir / 'sharded.pickle'
+    shardsdir = app.doctreedir / 'sharded.shards'
+    env.topickle(filename)
+    assert len((shardsdir / 'docs').listdir()) == DOC_BUCKETS
+    assert (shardsdir / 'domains' / 'py.pickle').isfile()
+
+    newenv = BuildEnvironment.frompickle(app.srcdir, app.config, filename)
+    newenv.init_managers()
+    newenv.domains = {}
+    # the shards are only loaded when their entries are used
+    assert newenv.titles.data == {} and newenv.domaindata.data == {}
+    assert newenv.titles['new'].astext() == 'New file'
+    assert set(newenv.titles.data) == set(docname for docname in env.titles
+                                          if doc_bucket(docname) == doc_bucket('new'))
+    assert newenv.domaindata['py'] == env.domaindata['py']
+    assert list(newenv.domaindata.data) == ['py']
+    assert set(newenv.tocs) == set(env.tocs) == set(newenv.all_docs)
+    assert newenv.indexentries == env.indexentries
+
+    # only the shards that have changed are written again
+    def reset_mtimes():
+        for root, dirs, files in os.walk(shardsdir):
+            for name in files:
+                os.utime(os.path.join(root, name), (0, 0))
+
+    def written():
+        return set(os.path.relpath(os.path.join(root, name), shardsdir)
+                   for root, dirs, files in os.walk(shardsdir)
+                   for name in files if os.path.getmtime(os.path.join(root, name)) > 0)
+
+    reset_mtimes()
+    newenv.topickle(filename)
+    assert written() == set()
+
+    # "new" has no Python objects
+    newenv.domains = {'py': PythonDomain(newenv)}
+    newenv.clear_doc('new')
+    newenv.topickle(filename)
+    assert written() == set([os.path.join('docs', '%d.pickle' % doc_bucket('new'))])
+
+    # entries that are removed and added back unchanged are no change
+    reset_mtimes()
+    objects = newenv.domaindata['py']['objects']
+    entries = dict((key, objects[key]) for key in objects.keys_of('objects'))
+    objects.purge_doc('objects')
+    objects.update(entries)
+    newenv.topickle(filename)
+    assert written() == set()
+    objects.purge_doc('objects')
+    newenv.topickle(filename)
+    assert written() == set([os.path.join('domains', 'py.pickle')])
+    assert 'c' not in newenv.domaindata.data
+
+    newenv = BuildEnvironment.frompickle(app.srcdir, app.config, filename)
+    assert 'new' not in newenv.titles
+    assert newenv.domaindata['py']['objects'].keys_of('objects') == set()
+
+
+def test_domaindata_written_directly():
+    class ThingDomain(Domain):
+        name = 'thing'
+        initial_data = {'objects': {}}
+
+    # a fresh environment
+    newenv = BuildEnvironment(app.srcdir, app.doctreedir, app.config)
+    domain = ThingDomain(newenv)
+    newenv.domaindata['thing']['objects']['spam'] = 'index'
+    assert domain.data['objects'] == {'spam': 'index'}
+
+    # a saved environment that has no data for the domain yet
+    filename = app.doctreedir / 'direct.pickle'
+    env.topickle(filename)
+    newenv = BuildEnvironment.frompickle(app.srcdir, app.config, filename)
+    domain = ThingDomain(newenv)
+    newenv.domaindata['thing']['objects']['spam'] = 'index'
+    assert domain.data['objects'] == {'spam': 'index'}
+    assert 'py' not in newenv.domaindata.data
+
+
+@pytest.mark.skipif(not parallel_available, reason='parallel builds are not available')
+@pytest.mark.sphinx('dummy', testroot='toctree', srcdir='toctree-merge-info')
+def test_parallel_merge_info(app, status, warning):
+    merged = []
+
+    def merge_info(app, env, docnames, other):
+        merged.append((os.getpid(), env.config.project, docnames))
+
+    app.connect('env-merge-info', merge_info)
+    app.parallel = 2
+    app.builder.build_all()
+    assert 'waiting for workers' in status.getvalue()
+    # the handlers run once per chunk of documents, in the main process
+    assert set(pid for pid, _, _ in merged) == set([os.getpid()])
+    assert set(project for _, project, _ in merged) == set([app.config.project])
+    docnames = [docname for _, _, chunk in merged for docname in chunk]
+    assert sorted(docnames) == sorted(app.env.found_docs)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+    test_environment_storage
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Test the sphinx.environment.storage.
+
+    :copyright: Copyright 2007-2017 by the Sphinx team, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+import pickle
+
+import pytest
+from docutils import nodes
+
+from sphinx.environment.storage import CompactStorage, PickleStorage, \
+    load_doctree
+
+
+def get_doctree(app):
+    app.builder.build_all()
+    doctree = app.env.get_doctree('markup')
+    doctree.reporter = None
+    doctree.settings.env = None
+    doctree.settings.warning_stream = None
+    return doctree
+
+
+def check_roundtrip(doctree, newtree):
+    assert newtree.pformat() == doctree.pformat()
+    assert newtree.settings.__dict__ == doctree.settings.__dict__
+    for node, newnode in zip(doctree.traverse(), newtree.traverse()):
+        assert newnode.__class__ is node.__class__
+        if isinstance(node, nodes.Text):
+            assert newnode.rawsource == node.rawsource
+        else:
+            assert newnode.attributes == node.attributes
+        if node.parent is None:
+            assert newnode.parent is None
+        else:
+            assert newnode in newnode.parent.children
+    # references to nodes of the tree point into the new tree
+    treenodes = set(id(node) for node in doctree.traverse())
+    newtreenodes = set(id(node) for node in newtree.traverse())
+    assert set(newtree.ids) == set(doctree.ids)
+    for nodeid, node in doctree.ids.items():
+        assert (id(node) in treenodes) == (id(newtree.ids[nodeid]) in newtreenodes)
+
+
+@pytest.mark.sphinx('dummy')
+@pytest.mark.parametrize('storage', [PickleStorage, CompactStorage])
+@pytest.mark.parametrize('compress', [False, True])
+def test_storage_roundtrip(app, storage, compress):
+    doctree = get_doctree(app)
+    data = storage(compress=compress).dumps(doctree)
+    check_roundtrip(doctree, load_doctree(data))
+    if storage is PickleStorage and not compress:
+        # as written by earlier versions
+        check_roundtrip(doctree, pickle.loads(data))
+
+
+@pytest.mark.sphinx('dummy')
+def test_compact_storage_objects(app):
+    doctree = get_doctree(app)
+    # values that marshal cannot store, including references to nodes
+    section = doctree[0]
+    section['custom'] = (set(['a']), section[0])
+    section.referenced = section
+    newtree = load_doctree(CompactStorage().dumps(doctree))
+    newsection = newtree[0]
+    assert newsection['custom'][0] == set(['a'])
+    assert newsection['custom'][1] is newsection[0]
+    assert newsection.referenced is newsection
+
+
+def test_load_doctree_unknown_storage():
+    data = PickleStorage(compress=True).dumps(nodes.document(None, None))
+    with pytest.raises(ValueError):
+        load_doctree(data.replace(b'pickle', b'pickl2'))
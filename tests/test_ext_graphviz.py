@@ -9,7 +9,9 @@
     :license: BSD, see LICENSE for details.
 """
 
+import os
 import re
+import sys
 
 import pytest
 
@@ -63,3 +65,46 @@ def test_graphviz_i18n(app, status, warning):
     content = (app.outdir / 'index.html').text()
     html = '<img src=".*?" alt="digraph {\n  BAR -&gt; BAZ\n}" />'
     assert re.search(html, content, re.M)
+
+
+FAKE_DOT = '''#!%s
+import sys
+with open(%r, 'a') as log:
+    log.write('run\\n')
+sys.stdin.read()
+for arg in sys.argv[1:]:
+    if arg.startswith('-o'):
+        with open(arg[2:], 'w') as fp:
+            fp.write('<map id="G" name="G">\\n</map>\\n')
+'''
+
+
+@pytest.mark.sphinx('html', testroot='ext-graphviz')
+@pytest.mark.skipif(sys.platform == 'win32', reason='needs an executable script')
+def test_graphviz_cache_dir(tempdir, app, status, warning):
+    # a stand-in for dot that records how often it is run
+    log = tempdir / 'dot.log'
+    fake_dot = tempdir / 'dot'
+    fake_dot.write_text(FAKE_DOT % (sys.executable, str(log)))
+    os.chmod(fake_dot, 0o755)
+    app.config.graphviz_dot = str(fake_dot)
+    app.config.graphviz_cache_dir = tempdir / 'cache'
+
+    app.builder.build_all()
+    # the four diagrams for dot are rendered before the documents are written
+    assert sorted(app.env.graphviz_graphs) == ['index']
+    assert log.text().count('run') == 4
+    images = sorted(name for name in os.listdir(tempdir / 'cache') if name.endswith('.png'))
+    assert len(images) == 4
+    for name in images:
+        assert (app.outdir / '_images' / name).isfile()
+        assert (app.outdir / '_images' / (name + '.map')).isfile()
+    content = (app.outdir / 'index.html').text()
+    assert len(re.findall('<img src="_images/graphviz-\w+.png"', content)) == 4
+
+    # a clean build takes the images from the cache
+    (app.outdir / '_images').rmtree()
+    app.builder.build_all()
+    assert log.text().count('run') == 4
+    for name in images:
+        assert (app.outdir / '_images' / name).isfile()
@@ -10,10 +10,13 @@
 """
 
 import posixpath
+import threading
+import time
 import unittest
 import zlib
 
 from six import BytesIO
+from six.moves import BaseHTTPServer, socketserver
 from docutils import nodes
 import mock
 import pytest
@@ -25,7 +28,7 @@ from sphinx.ext.intersphinx import setup as intersphinx_setup
 from sphinx.ext.intersphinx import read_inventory, \
     load_mappings, missing_reference, _strip_basic_auth, \
     _get_safe_url, fetch_inventory, INVENTORY_FILENAME, \
-    debug
+    debug, InventoryCache, index_inventory
 
 
 inventory_v1 = '''\
@@ -83,6 +86,36 @@ def test_read_inventory_v2():
     assert invdata1['std:term']['a term including:colon'][2] == \
         '/util/glossary.html#term-a-term-including-colon'
 
+def test_read_inventory_v2_lines():
+    data = '''\
+# Sphinx inventory version 2
+# Project: foo
+# Version: 2.0
+# The remainder of this file is compressed with zlib.
+'''.encode('utf-8') + zlib.compress('''\
+mod py:module 0 mod.html#module-$ -
+mod py:module 0 wrong.html#module-$ -
+spaced name std:label -1 spaced.html#$ Spaced  title \r
+not an entry
+
+no-display-name py:function 1 func.html#$
+last py:function 1 last.html#$ -'''.encode('utf-8'))
+    invdata = read_inventory(BytesIO(data), '/util', posixpath.join)
+    assert invdata == {
+        'py:module': {'mod': ('foo', '2.0', '/util/mod.html#module-mod', '-')},
+        'py:function': {'last': ('foo', '2.0', '/util/last.html#last', '-')},
+        'std:label': {'spaced name': ('foo', '2.0', '/util/spaced.html#spaced name',
+                                      'Spaced  title')},
+    }
+
+
+def test_index_inventory():
+    invdata = read_inventory(BytesIO(inventory_v2), '/util', posixpath.join)
+    index = index_inventory(invdata)
+    assert index['module1'] == {'py:module': invdata['py:module']['module1']}
+    assert index['a term'] == {'std:term': invdata['std:term']['a term']}
+    assert len(index) == 6
+
 
 @mock.patch('sphinx.ext.intersphinx.read_inventory')
 @mock.patch('sphinx.ext.intersphinx._read_from_url')
@@ -217,6 +250,42 @@ def test_missing_reference(tempdir, app, status, warning):
     assert rn['refuri'] == '../../../../py3k/foo.html#module-module1'
 
 
+def test_missing_reference_priority(tempdir, app, status, warning):
+    inv_file = tempdir / 'inventory'
+    inv_file.write_bytes('''\
+# Sphinx inventory version 2
+# Project: foo
+# Version: 2.0
+# The remainder of this file is compressed with zlib.
+'''.encode('utf-8') + zlib.compress('''\
+name py:function 1 func.html#$ -
+name py:class 1 class.html#$ -
+prog --opt std:option 1 opt.html#$ -
+'''.encode('utf-8')))
+    app.config.intersphinx_mapping = {'foo': ('https://foo/', inv_file)}
+    intersphinx_setup(app)
+    load_mappings(app)
+
+    def reference_check(domain, type, target):
+        node = addnodes.pending_xref('', reftarget=target, reftype=type, refdomain=domain)
+        contnode = nodes.literal(target, target)
+        node += contnode
+        return missing_reference(app, app.env, node, contnode)
+
+    # the object types of the role are tried in their order
+    objtypes = app.env.domains['py'].objtypes_for_role('obj')
+    assert objtypes.index('function') < objtypes.index('class')
+    assert reference_check('py', 'obj', 'name')['refuri'] == 'https://foo/func.html#name'
+    assert reference_check('py', 'class', 'name')['refuri'] == 'https://foo/class.html#name'
+    assert reference_check('py', 'func', 'foo:name')['refuri'] == \
+        'https://foo/func.html#name'
+    assert reference_check('py', 'mod', 'name') is None
+    assert reference_check('std', 'option', 'prog --opt')['refuri'] == \
+        'https://foo/opt.html#prog --opt'
+    assert reference_check(None, 'any', 'name') is not None
+    assert reference_check(None, 'any', 'other') is None
+
+
 def test_load_mappings_warnings(tempdir, app, status, warning):
     """
     load_mappings issues a warning if new-style mapping
@@ -239,6 +308,163 @@ def test_load_mappings_warnings(tempdir, app, status, warning):
     assert warning.getvalue().count('\n') == 1
 
 
+def test_load_mappings_messages(tempdir, app, status, warning):
+    app.config.intersphinx_mapping = {
+        'a': ('http://example.com/a/', str(tempdir / 'missing-a.inv')),
+        'b': ('http://example.com/b/', str(tempdir / 'missing-b.inv')),
+    }
+    app.config.intersphinx_cache_limit = 0
+    threads = []
+    warn = app.warn
+
+    def record_warn(*args, **kwargs):
+        threads.append(threading.current_thread())
+        warn(*args, **kwargs)
+
+    # the messages of the fetch threads are reported by the main thread
+    with mock.patch.object(app, 'warn', record_warn):
+        load_mappings(app)
+    assert threads == [threading.current_thread()] * 2
+    assert 'missing-a.inv' in warning.getvalue()
+    assert 'missing-b.inv' in warning.getvalue()
+
+
+class InventoryServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves :data:`inventory_v2` with an ETag from each path."""
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), InventoryHandler)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.running = self.max_running = 0
+        self.etag = '"v1"'
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+
+class InventoryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, self.headers.get('If-None-Match')))
+            server.running += 1
+            server.max_running = max(server.max_running, server.running)
+        time.sleep(0.2)
+        with server.lock:
+            server.running -= 1
+        if self.headers.get('If-None-Match') == server.etag:
+            self.send_response(304)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header('ETag', server.etag)
+            self.send_header('Content-Length', str(len(inventory_v2)))
+            self.end_headers()
+            self.wfile.write(inventory_v2)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def inventory_server():
+    server = InventoryServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_load_mappings_concurrent(app, status, warning, inventory_server):
+    url = inventory_server.url
+    intersphinx_setup(app)
+    app.config.intersphinx_mapping = {
+        'a': (url + 'a/', None),
+        'b': (url + 'b/', None),
+        'c': (url + 'c/', None),
+    }
+    app.config.intersphinx_fetch_workers = 2
+
+    load_mappings(app)
+    assert sorted(inventory_server.requests) == [
+        ('/a/objects.inv', None), ('/b/objects.inv', None), ('/c/objects.inv', None)]
+    assert inventory_server.max_running == 2
+    assert sorted(app.env.intersphinx_named_inventory) == ['a', 'b', 'c']
+    assert app.env.intersphinx_inventory['py:module']['module1'][2] == \
+        url + 'c/foo.html#module-module1'
+    assert app.env.intersphinx_validators[url + 'a/objects.inv'] == {'ETag': '"v1"'}
+    assert warning.getvalue() == ''
+
+    # cached inventories are not fetched again
+    del inventory_server.requests[:]
+    load_mappings(app)
+    assert inventory_server.requests == []
+
+    # expired ones are revalidated; the cached data is kept if not modified
+    def expire():
+        cache = app.env.intersphinx_cache
+        for uri, (name, _x, invdata) in list(cache.items()):
+            cache[uri] = (name, 0, invdata)
+
+    expire()
+    app.env.intersphinx_inventory = {}
+    load_mappings(app)
+    assert sorted(inventory_server.requests) == [
+        ('/a/objects.inv', '"v1"'), ('/b/objects.inv', '"v1"'), ('/c/objects.inv', '"v1"')]
+    assert app.env.intersphinx_inventory == {}
+    assert app.env.intersphinx_cache[url + 'a/'][2] == \
+        app.env.intersphinx_named_inventory['a']
+
+    # and replaced if modified
+    inventory_server.etag = '"v2"'
+    expire()
+    load_mappings(app)
+    assert app.env.intersphinx_validators[url + 'a/objects.inv'] == {'ETag': '"v2"'}
+    assert 'module1' in app.env.intersphinx_inventory['py:module']
+    assert warning.getvalue() == ''
+
+
+def test_load_mappings_cache_dir(tempdir, app, status, warning, inventory_server):
+    url = inventory_server.url
+    intersphinx_setup(app)
+    app.config.intersphinx_mapping = {'a': (url + 'a/', None)}
+    app.config.intersphinx_cache_dir = tempdir / 'invcache'
+
+    def reset_env():
+        del app.env.intersphinx_cache
+        del app.env.intersphinx_validators
+
+    load_mappings(app)
+    assert inventory_server.requests == [('/a/objects.inv', None)]
+    inv_cache = InventoryCache(tempdir / 'invcache')
+    fetched, validator, invdata = inv_cache.load(url + 'a/', url + 'a/objects.inv')
+    assert validator == {'ETag': '"v1"'}
+    assert invdata == app.env.intersphinx_named_inventory['a']
+
+    # another project with the same mapping uses the cached inventory
+    reset_env()
+    load_mappings(app)
+    assert len(inventory_server.requests) == 1
+    assert app.env.intersphinx_named_inventory['a'] == invdata
+
+    # an expired entry is revalidated
+    inv_cache.save(url + 'a/', url + 'a/objects.inv', 0, validator, invdata)
+    reset_env()
+    load_mappings(app)
+    assert inventory_server.requests[1:] == [('/a/objects.inv', '"v1"')]
+    assert app.env.intersphinx_named_inventory['a'] == invdata
+    assert inv_cache.load(url + 'a/', url + 'a/objects.inv')[0] > 0
+
+    # the entries depend on the base URI of the links
+    assert inv_cache.load(url + 'b/', url + 'a/objects.inv') is None
+    assert warning.getvalue() == ''
+
+
 class TestStripBasicAuth(unittest.TestCase):
     """Tests for sphinx.ext.intersphinx._strip_basic_auth()"""
     def test_auth_stripped(self):
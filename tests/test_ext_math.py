@@ -9,11 +9,16 @@
     :license: BSD, see LICENSE for details.
 """
 
+import os
 import re
+import sys
 
 import pytest
 from util import SkipTest
 
+from sphinx.ext.imgmath import generate_latex, get_image_filename
+from sphinx.util.png import read_png_depth
+
 
 @pytest.mark.sphinx(
     'html', testroot='ext-math',
@@ -50,6 +55,159 @@ def test_imgmath_png(app, status, warning):
     assert re.search(html, content, re.S)
 
 
+@pytest.mark.sphinx('html', testroot='ext-math',
+                    confoverrides={'extensions': ['sphinx.ext.imgmath'],
+                                   'imgmath_batch': True})
+def test_imgmath_batch(app, status, warning):
+    app.builder.build_all()
+    if "LaTeX command 'latex' cannot be run" in warning.getvalue():
+        raise SkipTest('LaTeX command "latex" is not available')
+    if "dvipng command 'dvipng' cannot be run" in warning.getvalue():
+        raise SkipTest('dvipng command "dvipng" is not available')
+
+    # the images of all formulas have been rendered before writing
+    formulas = set(math for docformulas in app.env.imgmath_formulas.values()
+                   for math in docformulas)
+    assert len((app.outdir / '_images' / 'math').listdir()) == len(formulas)
+    content = (app.outdir / 'math.html').text()
+    assert len(re.findall('<img class="math" src="_images/math/\w+.png"', content)) == 2
+
+
+FAKE_LATEX = r'''#!%s
+import re
+import sys
+with open(%r, 'a') as log:
+    log.write('run\n')
+with open('math.tex') as fp:
+    tex = fp.read()
+pages = re.finditer(r'\\setcounter\{page\}\{(\d+)\}(.*?)'
+                    r'\\selectfont (.*?)\n\\endgroup', tex, re.S)
+# like in LaTeX, the equation counter runs on from page to page
+equation = 0
+with open('math.dvi', 'w') as fp:
+    for page in pages:
+        number, setup, math = page.groups()
+        if '\\setcounter{equation}{0}' in setup:
+            equation = 0
+        numbers = ''
+        for env in re.findall(r'\\begin\{(?:equation|align)\}', math):
+            equation += 1
+            numbers += ' (%%d)' %% equation
+        fp.write('%%s\t%%s%%s\n' %% (number, math.replace('\n', ' '), numbers))
+if '\\fail' in tex:
+    sys.exit(1)
+'''
+
+FAKE_DVIPNG = r'''#!%s
+import sys
+args = sys.argv[1:]
+out = args[args.index('-o') + 1]
+with open(args[-1]) as fp:
+    for line in fp:
+        number, math = line.rstrip('\n').split('\t')
+        with open(out.replace('%%d', number), 'wb') as png:
+            # room for the IEND chunk replaced by write_png_depth()
+            png.write(math.encode('utf-8') + b'.' * 12)
+        if '--depth' in args:
+            sys.stdout.write('[%%s depth=%%d] ' %% (number, len(math)))
+'''
+
+
+def make_fake_tools(tempdir):
+    # stand-ins for latex, which lists the pages in math.dvi, numbers their
+    # equations and fails on \fail, and dvipng, which writes the formula of
+    # each page into its image
+    log = tempdir / 'latex.log'
+    fake_latex = tempdir / 'latex'
+    fake_latex.write_text(FAKE_LATEX % (sys.executable, str(log)))
+    os.chmod(fake_latex, 0o755)
+    fake_dvipng = tempdir / 'dvipng'
+    fake_dvipng.write_text(FAKE_DVIPNG % sys.executable)
+    os.chmod(fake_dvipng, 0o755)
+    return log, fake_latex, fake_dvipng
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='needs an executable script')
+def test_imgmath_batch_pages(tempdir, make_app):
+    log, fake_latex, fake_dvipng = make_fake_tools(tempdir)
+    srcdir = tempdir / 'imgmath-batch'
+    srcdir.makedirs()
+    (srcdir / 'conf.py').write_text('')
+    (srcdir / 'contents.rst').write_text(':math:`a^2` :math:`b^{10}` :math:`\\fail` '
+                                         ':math:`c`\n')
+
+    app = make_app('html', srcdir=srcdir,
+                   confoverrides={'extensions': ['sphinx.ext.imgmath'],
+                                  'imgmath_batch': True,
+                                  'imgmath_use_preview': True,
+                                  'imgmath_latex': str(fake_latex),
+                                  'imgmath_dvipng': str(fake_dvipng)})
+    app.builder.build_all()
+    # the batch of four is split in halves until \fail is alone, which is
+    # then rendered by itself and reported
+    assert log.text().count('run') == 6
+    assert 'latex exited with error' in app._warning.getvalue()
+
+    # each page is moved to the image of its formula, with its depth
+    imagedir = app.outdir / '_images' / 'math'
+    content = (app.outdir / 'contents.html').text()
+    for math in ('$a^2$', '$b^{10}$', '$c$'):
+        shasum = get_image_filename(generate_latex(math, app.config), app.config)
+        with open(imagedir / shasum, 'rb') as fp:
+            assert fp.read().startswith(math.encode('utf-8'))
+        assert read_png_depth(imagedir / shasum) == len(math)
+        assert ('<img class="math" src="_images/math/%s" alt="%s" '
+                'style="vertical-align: -%dpx"/>' % (shasum, math[1:-1], len(math))
+                in content)
+    assert len(imagedir.listdir()) == 3
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='needs an executable script')
+def test_imgmath_batch_numbered(tempdir, make_app):
+    log, fake_latex, fake_dvipng = make_fake_tools(tempdir)
+    srcdir = tempdir / 'imgmath-numbered'
+    srcdir.makedirs()
+    (srcdir / 'conf.py').write_text('')
+    (srcdir / 'contents.rst').write_text('.. math:: a^2\n\n'
+                                         '.. math:: b^2\n\n'
+                                         '.. math::\n\n   c^2\n\n   d^2\n')
+
+    app = make_app('html', srcdir=srcdir,
+                   confoverrides={'extensions': ['sphinx.ext.imgmath'],
+                                  'imgmath_batch': True,
+                                  'imgmath_use_preview': True,
+                                  'math_number_all': True,
+                                  'imgmath_latex': str(fake_latex),
+                                  'imgmath_dvipng': str(fake_dvipng)})
+    app.builder.build_all()
+    assert log.text().count('run') == 1
+
+    # all formulas share one run, but each image shows the equation number
+    # of its formula rendered by itself
+    imagedir = app.outdir / '_images' / 'math'
+    formulas = app.env.imgmath_formulas['contents']
+    assert len(formulas) == 3
+    for math in formulas:
+        assert '\\begin{equation}' in math or '\\begin{align}' in math
+        shasum = get_image_filename(generate_latex(math, app.config), app.config)
+        with open(imagedir / shasum, 'rb') as fp:
+            image = fp.read()
+        assert image.startswith((math.replace('\n', ' ') + ' (1)').encode('utf-8'))
+        assert b'(2)' not in image
+
+
+@pytest.mark.sphinx('html', testroot='ext-math',
+                    confoverrides={'extensions': ['sphinx.ext.imgmath']})
+def test_imgmath_formulas(app, status, warning):
+    app.builder.build_all()
+    formulas = app.env.imgmath_formulas['math']
+    assert formulas[:2] == ['$E = m c^2$', '$a^2 + b^2 = c^2$']
+    assert ('\\begin{equation*}\n\\begin{split}a + 1 < b\\end{split}\n'
+            '\\end{equation*}') in formulas
+    # without wrapping
+    assert formulas[-1] == 'a + 1 < b'
+
+
 @pytest.mark.sphinx('html', testroot='ext-math-simple',
                     confoverrides={'extensions': ['sphinx.ext.imgmath'],
                                    'imgmath_image_format': 'svg'})
@@ -15,8 +15,11 @@ from six import BytesIO
 from docutils import frontend, utils
 from docutils.parsers import rst
 
-from sphinx.search import IndexBuilder
+from sphinx.search import IndexBuilder, StemCache, shard_of, pack_postings, unpack_postings
+from sphinx.search.binary import BinaryIndex, decode_varints, encode_varints
+from sphinx.search.en import SearchEnglish
 from sphinx.util import jsdump
+from sphinx.util.parallel import parallel_available
 import pytest
 
 DummyEnvironment = namedtuple('DummyEnvironment', ['version', 'domains'])
@@ -228,3 +231,325 @@ def test_IndexBuilder():
     }
     assert index._objtypes == {('dummy', 'objtype'): 0}
     assert index._objnames == {0: ('dummy', 'objtype', 'objtype')}
+
+
+def test_IndexBuilder_state():
+    env = DummyEnvironment('1.0', {})
+    doc = utils.new_document(b'test data', settings)
+    doc['file'] = 'dummy'
+    parser.parse(FILE_CONTENTS, doc)
+
+    index = IndexBuilder(env, 'en', {}, None)
+    index.feed('docname', 'filename', 'title', doc)
+    index.feed('docname2', 'filename2', 'title2', doc)
+    assert index._doc_terms['docname'] == (
+        {'fermion': 1, 'comment': 1, 'non': 1, 'index': 1, 'test': 1}, {'section_titl'})
+
+    # dump / load the state
+    stream = BytesIO()
+    index.dump_state(stream)
+    stream.seek(0)
+    index2 = IndexBuilder(env, 'en', {}, None)
+    index2.load_state(stream)
+    assert index2._mapping == index._mapping
+    assert index2._doc_terms == index._doc_terms
+
+    # the state of another language is not loaded
+    stream.seek(0)
+    with pytest.raises(ValueError):
+        IndexBuilder(env, 'de', {}, None).load_state(stream)
+
+    # feeding a document again replaces its words
+    doc = utils.new_document(b'test data', settings)
+    doc['file'] = 'dummy'
+    parser.parse('other\n=====\n\nwords\n', doc)
+    index2.feed('docname', 'filename', 'other', doc)
+    assert index2._mapping == {
+        'fermion': {'docname2'},
+        'comment': {'docname2'},
+        'non': {'docname2'},
+        'index': {'docname2'},
+        'test': {'docname2'},
+        'word': {'docname'},
+    }
+    assert index2._title_mapping == {'section_titl': {'docname2'}, 'other': {'docname'}}
+
+    index2.prune(['docname'])
+    assert index2._mapping == {'word': {'docname'}}
+    assert index2._title_mapping == {'other': {'docname'}}
+    assert list(index2._doc_terms) == ['docname']
+
+
+def test_stem_cache():
+    lang = SearchEnglish({})
+    cache = StemCache(lang, maxsize=2)
+    assert cache.stem('Fermions') == 'fermion'
+    assert cache.stem('Fermions') == 'fermion'
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # stems computed in another process are merged
+    other = StemCache(lang)
+    other.stem('bosons')
+    other.take_new()
+    other.stem('quarks')
+    other.stem('bosons')
+    cache.merge(other.take_new())
+    assert len(cache) == 2
+    assert (cache.hits, cache.misses) == (2, 2)
+
+    # the words not used since loading are dropped first
+    stream = BytesIO()
+    cache.dump(stream)
+    stream.seek(0)
+    cache2 = StemCache(lang, maxsize=2)
+    cache2.load(stream)
+    assert len(cache2) == 2
+    cache2.stem('leptons')
+    cache2.stem('quarks')
+    stream = BytesIO()
+    cache2.dump(stream)
+    stream.seek(0)
+    cache3 = StemCache(lang)
+    cache3.load(stream)
+    assert sorted(cache3._stems) == ['leptons', 'quarks']
+    assert (cache3.hits, cache3.misses) == (0, 0)
+
+    # words that another process found in its loaded cache count as used, too
+    stream.seek(0)
+    worker = StemCache(lang)
+    worker.load(stream)
+    worker.stem('quarks')
+    cache3.stem('gluons')
+    cache3.maxsize = 2
+    cache3.merge(worker.take_new())
+    assert (cache3.hits, cache3.misses) == (1, 1)
+    assert cache3._used == set(['gluons', 'quarks'])
+    stream = BytesIO()
+    cache3.dump(stream)
+    stream.seek(0)
+    cache4 = StemCache(lang)
+    cache4.load(stream)
+    assert sorted(cache4._stems) == ['gluons', 'quarks']
+
+    # the stems of other languages are not loaded
+    stream.seek(0)
+    with pytest.raises(ValueError):
+        StemCache(SearchEnglish({'type': 'other'})).load(stream)
+
+
+def test_pack_postings():
+    assert pack_postings({}) == []
+    assert pack_postings({3: 1, 0: 2, 10: 4}) == [0, 2, 3, 1, 7, 4]
+    assert unpack_postings([0, 2, 3, 1, 7, 4]) == {0: 2, 3: 1, 10: 4}
+
+
+def test_IndexBuilder_ranked():
+    env = DummyEnvironment('1.0', {})
+    doc = utils.new_document(b'test data', settings)
+    doc['file'] = 'dummy'
+    parser.parse(FILE_CONTENTS, doc)
+    doc2 = utils.new_document(b'test data', settings)
+    doc2['file'] = 'dummy'
+    parser.parse('title\n=====\n\nfermion fermions test\n', doc2)
+
+    with pytest.raises(ValueError):
+        IndexBuilder(env, 'en', {}, None, 'unknown')
+
+    index = IndexBuilder(env, 'en', {}, None, 'bm25')
+    index.feed('docname', 'filename', 'title', doc)
+    index.feed('docname2', 'filename2', 'title2', doc2)
+    frozen = index.freeze()
+    assert frozen['ranking'] == 'bm25'
+    assert frozen['doclengths'] == [5, 3]
+    assert frozen['terms'] == {'comment': [0, 1],
+                               'fermion': [0, 1, 1, 2],
+                               'index': [0, 1],
+                               'non': [0, 1],
+                               'test': [0, 1, 1, 1]}
+    assert frozen['titleterms'] == {'section_titl': 0, 'titl': 1}
+
+    # dump / load keeps the frequencies
+    stream = BytesIO()
+    index.dump(stream, 'pickle')
+    stream.seek(0)
+    index2 = IndexBuilder(env, 'en', {}, None, 'bm25')
+    index2.load(stream, 'pickle')
+    assert index2._mapping == index._mapping
+    assert index2._doc_terms == index._doc_terms
+    assert index2.freeze() == frozen
+
+
+def test_varints():
+    numbers = [0, 1, 127, 128, 300, 2 ** 32]
+    assert encode_varints([1, 300]) == b'\x01\xac\x02'
+    assert decode_varints(encode_varints(numbers)) == numbers
+
+
+@pytest.mark.parametrize('ranking', [None, 'bm25'])
+def test_IndexBuilder_binary(ranking, tempdir):
+    domain = DummyDomain([('objname', 'objdispname', 'objtype', 'docname', '#anchor', 1)])
+    env = DummyEnvironment('1.0', {'dummy': domain})
+    doc = utils.new_document(b'test data', settings)
+    doc['file'] = 'dummy'
+    parser.parse(FILE_CONTENTS, doc)
+    doc2 = utils.new_document(b'test data', settings)
+    doc2['file'] = 'dummy'
+    parser.parse(u'title\n=====\n\nfermion fermions \u00e9t\u00e9\n', doc2)
+
+    index = IndexBuilder(env, 'en', {}, None, ranking)
+    index.feed('docname', 'filename', 'title', doc)
+    index.feed('docname2', 'filename2', u'\u00e9t\u00e9', doc2)
+    stream = BytesIO()
+    index.dump(stream, 'binary')
+
+    # load
+    stream.seek(0)
+    index2 = IndexBuilder(env, 'en', {}, None, ranking)
+    index2.load(stream, 'binary')
+    assert index2._titles == index._titles
+    assert index2._mapping == index._mapping
+    assert index2._title_mapping == index._title_mapping
+    assert index2.freeze() == index.freeze()
+
+    # query the memory-mapped file
+    (tempdir / 'searchindex.bin').write_bytes(stream.getvalue())
+    binindex = BinaryIndex.open(tempdir / 'searchindex.bin')
+    try:
+        assert len(binindex) == 2
+        assert binindex.frequencies == (ranking is not None)
+        assert binindex.get_document(1) == ('docname2', 'filename2', u'\u00e9t\u00e9')
+        if ranking:
+            assert binindex.find('fermion') == {0: 1, 1: 2}
+        else:
+            assert binindex.find('fermion') == {0: 1, 1: 1}
+        assert binindex.find(u'\u00e9t\u00e9') == {1: 1}
+        assert binindex.find('section_titl') == {}
+        assert binindex.find('section_titl', title=True) == {0: 1}
+        assert binindex.find('missing') == {}
+        assert binindex.count('fermion') == 2
+        assert binindex.meta['envversion'] == '1.0'
+    finally:
+        binindex.close()
+
+    with pytest.raises(ValueError):
+        BinaryIndex(b'Search.setIndex({})')
+
+
+def test_IndexBuilder_freeze_shards():
+    env = DummyEnvironment('1.0', {})
+    doc = utils.new_document(b'test data', settings)
+    doc['file'] = 'dummy'
+    parser.parse(FILE_CONTENTS, doc)
+
+    index = IndexBuilder(env, 'en', {}, None)
+    index.feed('docname', 'filename', 'title', doc)
+    frozen = index.freeze()
+    sharded, shards = index.freeze_shards(3)
+    assert len(shards) == 3
+    assert sharded['shards'] == 3
+    assert 'terms' not in sharded
+    assert 'titleterms' not in sharded
+    for key in ('terms', 'titleterms'):
+        for word, postings in frozen[key].items():
+            assert shards[shard_of(word, 3)][key][word] == postings
+        assert sum(len(shard[key]) for shard in shards) == len(frozen[key])
+
+    # the same hash is computed by searchtools.js
+    assert shard_of(u'fermion', 7) == 4
+    assert shard_of(u'section_titl', 7) == 6
+    assert shard_of(u'\u65e5\u672c\u8a9e', 7) == 5
+
+
+@pytest.mark.sphinx(testroot='search', srcdir='search-shards',
+                    confoverrides={'html_search_shards': 4})
+def test_sharded_search_index(app, status, warning):
+    app.builder.build_all()
+    searchindex = jsload(app.outdir / 'searchindex.js')
+    assert searchindex['shards'] == 4
+    assert 'terms' not in searchindex
+
+    terms = {}
+    for number in range(4):
+        shard = (app.outdir / '_searchindex' / ('shard%d.js' % number)).text()
+        assert shard.startswith('Search.setShard(%d, ' % number)
+        shard = jsdump.loads(shard[len('Search.setShard(%d, ' % number):-1])
+        terms.update(shard['terms'])
+    assert 'findthiskei' in terms
+
+    # shards of a build with more shards are removed
+    (app.outdir / '_searchindex' / 'shard9.js').write_text('')
+    app.builder.build_all()
+    assert not (app.outdir / '_searchindex' / 'shard9.js').exists()
+
+
+@pytest.mark.sphinx(testroot='search', srcdir='search-ranked',
+                    confoverrides={'html_search_ranking': 'bm25'})
+def test_ranked_search_index(app, status, warning):
+    app.builder.build_all()
+    searchindex = jsload(app.outdir / 'searchindex.js')
+    assert searchindex['ranking'] == 'bm25'
+    assert len(searchindex['doclengths']) == len(searchindex['docnames'])
+    postings = searchindex['terms']['findthiskei']
+    assert len(postings) % 2 == 0
+    assert unpack_postings(postings)
+    assert 'bm25' in (app.outdir / '_static' / 'searchtools.js').text()
+
+
+@pytest.mark.skipif(not parallel_available, reason='parallel builds are not available')
+@pytest.mark.sphinx(testroot='search', srcdir='search-parallel')
+def test_parallel_search_index(app, status, warning):
+    app.builder.build_all()
+    serial_index = (app.outdir / 'searchindex.js').text()
+
+    # the write workers collect the words of the documents
+    merged = []
+    merge_doc_data = app.builder.merge_doc_data
+    app.builder.merge_doc_data = lambda docname, data: (merged.append(docname),
+                                                        merge_doc_data(docname, data))
+    app.parallel = 3
+    app.builder.build_all()
+    assert 'waiting for workers' in status.getvalue()
+    assert merged
+    assert app.builder.pending_index_pages == {}
+    assert (app.outdir / 'searchindex.js').text() == serial_index
+
+
+@pytest.mark.sphinx(testroot='search', srcdir='search-stem-cache')
+def test_persistent_stem_cache(app, status, warning):
+    app.builder.build_all()
+    assert (app.doctreedir / 'stemcache-en.pickle').exists()
+    assert 'stem cache: ' in status.getvalue()
+
+    # all words are stemmed already
+    status.truncate(0)
+    app.builder.build_all()
+    assert app.builder.indexer.stem_cache.misses == 0
+    assert app.builder.indexer.stem_cache.hits > 0
+
+
+@pytest.mark.sphinx('pickle', testroot='search', srcdir='search-binary',
+                    confoverrides={'html_search_binary_index': True})
+def test_binary_search_index(app, status, warning):
+    app.builder.build_all()
+    binindex = BinaryIndex.open(app.outdir / 'searchindex.bin')
+    try:
+        assert binindex.find('findthiskei')
+    finally:
+        binindex.close()
+    assert not (app.outdir / 'searchindex.pickle').exists()
+
+
+@pytest.mark.sphinx(testroot='search', srcdir='search-incremental')
+def test_incremental_search_index(app, status, warning):
+    app.builder.build_all()
+    assert (app.doctreedir / 'searchindex-html.pickle').exists()
+
+    (app.srcdir / 'tocitem.rst').write_text(
+        (app.srcdir / 'tocitem.rst').text().replace('lorem', 'quarkword'))
+    app.builder.build_update()
+    assert 'search index couldn\'t be loaded' not in warning.getvalue()
+    searchindex = jsload(app.outdir / 'searchindex.js')
+    assert is_registered_term(searchindex, 'quarkword')
+    assert not is_registered_term(searchindex, 'lorem')
+    # the other documents are still indexed
+    assert is_registered_term(searchindex, 'findthiskei')
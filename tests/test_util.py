@@ -9,10 +9,12 @@
     :license: BSD, see LICENSE for details.
 """
 
+import pickle
+
 import pytest
 
 from sphinx.util import (
-    encode_uri, parselinenos, split_docinfo
+    encode_uri, parselinenos, split_docinfo, DocnameIndexedDict
 )
 
 
@@ -66,3 +68,51 @@ def test_parselinenos():
         parselinenos('abc-def', 10)
     with pytest.raises(ValueError):
         parselinenos('-', 10)
+
+
+def test_docname_indexed_dict():
+    objects = DocnameIndexedDict({'a': ('doc1', 'function'),
+                                  'b': ('doc2', 'class')})
+    objects['c'] = ('doc1', 'class')
+    objects['b'] = ('doc1', 'method')
+    assert objects.keys_of('doc1') == set(['a', 'b', 'c'])
+    assert objects.keys_of('doc2') == set()
+
+    del objects['a']
+    assert objects.pop('c') == ('doc1', 'class')
+    objects.setdefault('d', 'doc3')
+    assert objects.keys_of('doc1') == set(['b'])
+    assert objects.keys_of('doc3') == set(['d'])
+
+    objects = pickle.loads(pickle.dumps(objects, pickle.HIGHEST_PROTOCOL))
+    assert objects.keys_of('doc1') == set(['b'])
+    objects.purge_doc('doc1')
+    assert objects == {'d': 'doc3'}
+
+    other = DocnameIndexedDict({'e': ('doc4', 'data'), 'f': ('doc5', 'data')})
+    objects.merge_other(set(['doc4']), other)
+    objects.merge_other(set(['doc5']), dict(other))
+    assert objects == {'d': 'doc3', 'e': ('doc4', 'data'), 'f': ('doc5', 'data')}
+    assert objects.keys_of('doc5') == set(['f'])
+
+
+def test_docname_indexed_dict_changed():
+    objects = DocnameIndexedDict({'a': ('doc1', 'function'),
+                                  'b': ('doc2', 'class')})
+    assert not objects.changed()
+
+    # removing the entries of a document and adding them back is no change
+    objects.purge_doc('doc1')
+    objects['a'] = ('doc1', 'function')
+    assert not objects.changed()
+    objects['a'] = ('doc1', 'class')
+    assert objects.changed()
+    objects['a'] = ('doc1', 'function')
+    assert not objects.changed()
+
+    objects['c'] = ('doc3', 'data')
+    assert objects.changed()
+    objects.mark_saved()
+    assert not objects.changed()
+    objects.clear()
+    assert objects.changed()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+    test_util_cache
+    ~~~~~~~~~~~~~~~
+
+    Tests sphinx.util.cache functions.
+
+    :copyright: Copyright 2007-2017 by the Sphinx team, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+import pickle
+
+from sphinx.util.cache import LRUCache
+
+
+def test_lru_cache():
+    cache = LRUCache(10)
+    cache.put('b', b'bbbb')
+    cache.put('a', b'aaaa')
+
+    # 'b' is the least recently stored entry
+    cache.put('c', b'cccc')
+    assert 'b' not in cache
+    assert 'a' in cache and 'c' in cache
+    assert cache.size == 8
+
+    # replacing a value updates the size
+    cache.put('a', b'a')
+    assert cache.size == 5
+
+    # values larger than the cache are not stored
+    cache.put('d', b'd' * 11)
+    assert 'd' not in cache
+    assert len(cache) == 2
+
+    cache.discard('c')
+    assert cache.size == 1
+
+
+def test_lru_cache_pickle():
+    cache = LRUCache(10)
+    cache.put('a', b'aaaa')
+    cache.put('b', b'bbbb')
+    cache.take('a')
+    newcache = pickle.loads(pickle.dumps(cache))
+    assert newcache.maxsize == 10
+    assert len(newcache) == 0
+    assert newcache.hits == 0
+
+
+def test_lru_cache_take():
+    cache = LRUCache(10)
+    value = object()
+    cache.put('a', value, 4)
+    cache.put('b', b'bbbb')
+    assert cache.size == 8
+    # the value itself is returned, and only once
+    assert cache.take('a') is value
+    assert cache.take('a') is None
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.size == 4
+    assert 'b' in cache
@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
-from sphinx.util.jsdump import dumps, loads
+import pytest
+from six import StringIO
+
+from sphinx.util.jsdump import dump, dumps, load, loads
 
 
 def test_jsdump():
@@ -18,3 +21,38 @@ def test_jsdump():
     data = {'_foo': 1}
     assert dumps(data) == '{_foo:1}'
     assert data == loads(dumps(data))
+
+
+def test_jsdump_types():
+    data = {'b': [1, 2], 'a': 'x', 'class': None, 1: (True, False), 'c': set(['z', 'y'])}
+    assert dumps(data) == '{"1":[true,false],"class":null,a:"x",b:[1,2],c:["y","z"]}'
+    assert loads(dumps(data)) == {'1': [True, False], 'class': None, 'a': 'x',
+                                  'b': [1, 2], 'c': ['y', 'z']}
+
+    # the items are sorted by their encoding, not by the keys
+    assert dumps({'a': 1, 'a0': 2}) == '{a0:2,a:1}'
+
+    data = [u'"{a:1}"', u'\\', u'tab\there', u'\U0001f600', u',b:']
+    assert dumps(data) == r'["\"{a:1}\"","\\","tab\there","\ud83d\ude00",",b:"]'
+    assert loads(dumps(data)) == data
+
+
+def test_jsdump_dump():
+    data = {'terms': {'word': [1, 2], 'other': 3}, 'titles': ['a', 'b']}
+    stream = StringIO()
+    dump(data, stream)
+    assert stream.getvalue() == dumps(data)
+    assert load(StringIO(stream.getvalue())) == data
+
+
+def test_jsdump_loads_lenient():
+    # like the former loader, data after the object and missing closing
+    # brackets are accepted
+    assert loads('{a:[1,2]}, more') == {'a': [1, 2]}
+    assert loads('{a:[1,2]') == {'a': [1, 2]}
+
+
+def test_jsdump_loads_errors():
+    for data in ('', '{a:b}', '{"a" 1}'):
+        with pytest.raises(ValueError):
+            loads(data)
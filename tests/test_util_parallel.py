@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+    test_util_parallel
+    ~~~~~~~~~~~~~~~~~~
+
+    Tests sphinx.util.parallel functions.
+
+    :copyright: Copyright 2007-2017 by the Sphinx team, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+import os
+import threading
+from contextlib import contextmanager
+
+import pytest
+
+from sphinx.errors import SphinxParallelError
+from sphinx.util.parallel import ConcurrentTasks, ParallelPool, SerialTasks, \
+    make_chunks, parallel_available
+
+pytestmark = pytest.mark.skipif(not parallel_available,
+                                reason='parallel builds are not available')
+
+
+def test_parallel_pool():
+    seen = []
+
+    def task(arg):
+        seen.append(arg)
+        return os.getpid(), len(seen)
+
+    results = {}
+
+    def collect(arg, result):
+        results[arg] = result
+
+    pool = ParallelPool(2)
+    for i in range(20):
+        pool.add_task(task, i, collect)
+    pool.join()
+
+    assert sorted(results) == list(range(20))
+    # the tasks ran in at most two processes, neither of them this one
+    pids = set(pid for pid, _ in results.values())
+    assert 1 <= len(pids) <= 2
+    assert os.getpid() not in pids
+    # the workers are reused and keep their state between tasks
+    assert max(count for _, count in results.values()) > 1
+    assert seen == []
+
+
+def test_parallel_pool_error():
+    def task(arg):
+        if arg == 3:
+            raise ValueError('broken task')
+        return arg
+
+    pool = ParallelPool(2)
+    with pytest.raises(SphinxParallelError) as excinfo:
+        for i in range(5):
+            pool.add_task(task, i)
+        pool.join()
+    assert 'broken task' in str(excinfo.value)
+
+
+def test_parallel_pool_worker_died():
+    def task(arg):
+        if arg == 3:
+            os._exit(1)
+        return arg
+
+    pool = ParallelPool(2)
+    with pytest.raises(SphinxParallelError) as excinfo:
+        for i in range(5):
+            pool.add_task(task, i)
+        pool.join()
+    assert 'exit code 1' in str(excinfo.value)
+
+
+def test_parallel_pool_same_function():
+    pool = ParallelPool(1)
+    pool.add_task(len, 'abc')
+    with pytest.raises(ValueError):
+        pool.add_task(sorted, 'abc')
+    pool.join()
+
+
+def test_concurrent_tasks():
+    log = []
+
+    def task(arg):
+        name, wait_for, done = arg
+        log.append(('start', name))
+        if wait_for is not None:
+            # only set if the other task can run at the same time
+            assert wait_for.wait(10)
+        log.append(('end', name))
+        if done is not None:
+            done.set()
+        return os.getpid()
+
+    results = {}
+
+    def collect(arg, result):
+        results[arg[0]] = result
+
+    after_fast_done = threading.Event()
+    tasks = ConcurrentTasks(4)
+    slow = tasks.add_task(task, ('slow', after_fast_done, None), collect, depends=())
+    fast = tasks.add_task(task, ('fast', None, None), collect, depends=())
+    tasks.add_task(task, ('after-fast', None, after_fast_done), collect, depends=(fast,))
+    tasks.add_task(task, ('last', None, None), collect)
+    tasks.add_task(task, ('process', None, None), collect, process=True, depends=(slow,))
+    assert log == []  # nothing runs before join()
+    tasks.join()
+
+    # independent tasks do not wait for each other ...
+    assert log.index(('end', 'after-fast')) < log.index(('end', 'slow'))
+    # ... but undeclared dependencies mean all previous tasks
+    assert log[-2:] == [('start', 'last'), ('end', 'last')]
+    assert results['slow'] == os.getpid()
+    # a process task does not change the state of this process
+    assert results['process'] != os.getpid()
+    assert ('start', 'process') not in log
+
+    # join() can be called again for new tasks
+    tasks.add_task(task, ('again', None, None), collect, depends=(slow,))
+    tasks.join()
+    assert log[-1] == ('end', 'again')
+
+
+def test_concurrent_tasks_thread_context():
+    log = []
+
+    @contextmanager
+    def context():
+        log.append('enter')
+        yield
+        log.append('exit')
+
+    tasks = ConcurrentTasks(2, thread_context=context)
+    tasks.add_task(log.append, 'thread')
+    tasks.add_task(log.append, 'process', process=True)
+    tasks.join()
+    # process tasks do not run in the context
+    assert log == ['enter', 'thread', 'exit']
+
+
+def test_concurrent_tasks_error():
+    def task():
+        raise ValueError('broken task')
+
+    tasks = ConcurrentTasks(2)
+    tasks.add_task(task)
+    with pytest.raises(ValueError):
+        tasks.join()
+
+    tasks = ConcurrentTasks(2)
+    tasks.add_task(task, process=True)
+    with pytest.raises(SphinxParallelError) as excinfo:
+        tasks.join()
+    assert 'broken task' in str(excinfo.value)
+
+
+def test_serial_tasks():
+    log = []
+    tasks = SerialTasks()
+    first = tasks.add_task(log.append, 1)
+    tasks.add_task(log.append, 2, depends=(first,), process=True)
+    assert log == [1, 2]
+
+
+def test_make_chunks():
+    args = ['doc%d' % i for i in range(10)]
+    assert make_chunks(args, 2) == [args[:5], args[5:]]
+    # without any known cost, the chunks are made by count
+    assert make_chunks(args, 2, costs={}) == [args[:5], args[5:]]
+
+
+def test_make_chunks_by_cost():
+    args = ['doc%d' % i for i in range(10)]
+    costs = dict((arg, 1) for arg in args)
+    costs['doc0'] = costs['doc1'] = 8
+    chunks = make_chunks(args, 2, costs=costs)
+    assert sorted(sum(chunks, [])) == args
+    # the two expensive docs are spread over the chunks
+    assert [sum(costs[arg] for arg in chunk) for chunk in chunks] == [12, 12]
+
+    # the largest chunks come first, unknown costs count as average
+    costs = {'doc0': 10, 'doc1': 1}
+    chunks = make_chunks(args, 5, costs=costs)
+    assert chunks[0][0] == 'doc0'
+    assert sorted(sum(chunks, [])) == args
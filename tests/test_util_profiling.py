@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+    test_util_profiling
+    ~~~~~~~~~~~~~~~~~~~
+
+    Tests sphinx.util.profiling functions.
+
+    :copyright: Copyright 2007-2017 by the Sphinx team, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+import json
+import threading
+
+import pytest
+
+from sphinx.util.parallel import ConcurrentTasks, SerialTasks
+from sphinx.util.profiling import BuildProfiler
+
+from util import tempdir
+
+
+def test_build_profiler():
+    profiler = BuildProfiler()
+    with profiler.phase('read'):
+        pass
+    with profiler.phase('read'):
+        pass
+    profiler.add_documents('read', ['a', 'b'], {'a': 2.0, 'c': 1.0})
+    profiler.add_handler('doctree-read', test_build_profiler, 0.5)
+    profiler.add_handler('doctree-read', test_build_profiler, 0.25)
+    for item in profiler.timed_iterator(['x', 'y'], 'copying... ', str):
+        pass
+
+    report = profiler.get_report()
+    assert list(report['phases']) == ['read']
+    assert report['documents'] == {'a': {'read': 2.0}}
+    assert report['handlers'] == [{
+        'event': 'doctree-read',
+        'handler': 'test_util_profiling.test_build_profiler',
+        'calls': 2, 'time': 0.75}]
+    assert report['loops'][0]['summary'] == 'copying...'
+    assert report['loops'][0]['items'] == 2
+    assert profiler.summary(1)[-2:] == [
+        'event handlers:',
+        '     0.750s  test_util_profiling.test_build_profiler (doctree-read, 2 calls)']
+
+
+def test_build_profiler_threads():
+    profiler = BuildProfiler()
+
+    def add():
+        for i in range(1000):
+            profiler.add_handler('build-finished', add, 0.001)
+            profiler.add_loop_item('copying...', str(i), 0.001)
+
+    threads = [threading.Thread(target=add) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report = profiler.get_report()
+    # no update is lost
+    assert report['handlers'][0]['calls'] == 4000
+    assert report['loops'][0]['items'] == 4000
+
+
+@pytest.mark.parametrize('tasks', [SerialTasks(), ConcurrentTasks(2)])
+def test_timed_tasks(tasks):
+    results = []
+
+    def task(arg):
+        return arg * 2
+
+    profiler = BuildProfiler()
+    tasks = profiler.wrap_tasks(tasks)
+    tasks.add_task(task, 1, lambda *args: results.append(args[-1]))
+    tasks.add_task(task, 2)
+    tasks.join()
+    assert results == [2]
+    assert profiler.get_report()['tasks'][0]['calls'] == 2
+
+
+@pytest.mark.sphinx('dummy', srcdir='root-profile', freshenv=True)
+def test_profile_build(app):
+    app.profile = tempdir / 'profile.json'
+    app.profiler = BuildProfiler()
+    app.build(force_all=True)
+    with open(app.profile) as f:
+        report = json.load(f)
+    assert 'read' in report['phases']
+    assert 'write' in report['phases']
+    assert report['documents']['contents']['read'] > 0
+    assert any(handler['event'] == 'doctree-read' for handler in report['handlers'])
+    assert 'build profile written to' in app._status.getvalue()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Benchmark for the doctree storages
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Compare the write and read throughput and the disk size of the doctree
+    storages of sphinx.environment.storage on the doctrees of a project.
+
+    Usage: bench_doctrees.py [doctreedir]
+
+    Without a doctree directory, the Sphinx documentation is built with the
+    dummy builder into a temporary directory first.
+
+    :copyright: Copyright 2007-2017 by the Sphinx team, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from six.moves import cPickle as pickle  # noqa: E402
+
+from sphinx import build_main  # noqa: E402
+from sphinx.environment.storage import PickleStorage, CompactStorage, \
+    load_doctree  # noqa: E402
+
+
+def read_doctrees(doctreedir):
+    doctrees = []
+    for root, dirs, files in os.walk(doctreedir):
+        for filename in files:
+            if filename.endswith('.doctree'):
+                with open(path.join(root, filename), 'rb') as f:
+                    doctrees.append(load_doctree(f.read()))
+    return doctrees
+
+
+def measure(func, items, repeat=3):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        results = [func(item) for item in items]
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return best, results
+
+
+def main(argv):
+    tempdir = None
+    if len(argv) > 1:
+        doctreedir = argv[1]
+    else:
+        tempdir = tempfile.mkdtemp()
+        docdir = path.join(path.dirname(path.dirname(path.abspath(__file__))), 'doc')
+        doctreedir = path.join(tempdir, 'doctrees')
+        build_main(['sphinx-build', '-q', '-b', 'dummy', '-d', doctreedir,
+                    docdir, path.join(tempdir, 'out')])
+    try:
+        doctrees = read_doctrees(doctreedir)
+    finally:
+        if tempdir:
+            shutil.rmtree(tempdir)
+    nodecount = sum(len(doctree.traverse()) for doctree in doctrees)
+    print('%d doctrees, %d nodes' % (len(doctrees), nodecount))
+    print()
+    print('%-22s %10s %10s %10s' % ('storage', 'write', 'read', 'size'))
+
+    def report(name, dumptime, loadtime, datas):
+        size = sum(len(data) for data in datas)
+        print('%-22s %8.0f/s %8.0f/s %8d KB' % (name, nodecount / dumptime,
+                                                nodecount / loadtime, size // 1024))
+
+    # plain pickle without pausing the garbage collector, as done before
+    dumptime, datas = measure(lambda d: pickle.dumps(d, pickle.HIGHEST_PROTOCOL),
+                              doctrees)
+    loadtime, _ = measure(pickle.loads, datas)
+    report('pickle (gc enabled)', dumptime, loadtime, datas)
+
+    for storage in (PickleStorage, CompactStorage):
+        for compress in (False, True):
+            name = storage.name + (' + zlib' if compress else '')
+            dumptime, datas = measure(storage(compress=compress).dumps, doctrees)
+            loadtime, _ = measure(load_doctree, datas)
+            report(name, dumptime, loadtime, datas)
+    print()
+    print('(throughput in nodes per second)')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Benchmark for sphinx.util.jsdump
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Measure how long dumping and loading a large search index with
+    sphinx.util.jsdump takes, compared to the json module.
+
+    Usage: bench_jsdump.py [searchindex.js]
+
+    Without a search index, a random one with 15000 documents and 200000 words
+    is generated.
+
+    :copyright: Copyright 2007-2017 by the Sphinx team, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+from __future__ import print_function
+
+import io
+import sys
+import json
+import time
+import random
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from sphinx.search import js_index  # noqa: E402
+from sphinx.util import jsdump  # noqa: E402
+
+
+def make_index(ndocs=15000, nwords=200000, seed=0):
+    rnd = random.Random(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    docnames = tuple('section%d/page%d' % (i // 100, i) for i in range(ndocs))
+    terms = {}
+    for i in range(nwords):
+        word = ''.join(rnd.choice(letters) for j in range(rnd.randint(3, 12)))
+        # few words occur in many documents
+        docs = sorted(rnd.sample(range(ndocs), min(ndocs, int(rnd.paretovariate(1.2)))))
+        terms[word + str(i)] = len(docs) == 1 and docs[0] or docs
+    objects = {}
+    for i in range(ndocs // 2):
+        objects.setdefault('pkg.mod%d' % (i % 300), {})['Name%d' % i] = \
+            (i, i % 5, 1, i % 3 and 'anchor-%d' % i or '')
+    return dict(docnames=docnames, filenames=[d + '.rst' for d in docnames],
+                titles=tuple(u'Title \xe9 "%d"' % i for i in range(ndocs)),
+                terms=terms, titleterms=dict(list(terms.items())[:nwords // 20]),
+                objects=objects, objtypes={0: 'py:function', 1: 'py:class'},
+                objnames={0: ('py', 'function', 'Python function'),
+                          1: ('py', 'class', 'Python class')},
+                envversion=51)
+
+
+def measure(func, arg, repeat=3):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = func(arg)
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return best, result
+
+
+def main(argv):
+    if len(argv) > 1:
+        with io.open(argv[1], encoding='utf-8') as f:
+            index = js_index.loads(f.read())
+    else:
+        index = make_index()
+
+    print('%-10s %10s %10s %10s' % ('', 'dumps', 'loads', 'size'))
+    dumptime, data = measure(jsdump.dumps, index)
+    loadtime, _ = measure(jsdump.loads, data)
+    print('%-10s %9.3fs %9.3fs %8d KB' % ('jsdump', dumptime, loadtime, len(data) // 1024))
+    dumptime, data = measure(lambda obj: json.dumps(obj, sort_keys=True,
+                                                    separators=(',', ':')), index)
+    loadtime, _ = measure(json.loads, data)
+    print('%-10s %9.3fs %9.3fs %8d KB' % ('json', dumptime, loadtime, len(data) // 1024))
+
+
+if __name__ == '__main__':
+    main(sys.argv)